@@ -5,7 +5,10 @@ CREATE TABLE visdrone_files (
     filename   TEXT        NOT NULL,  -- 檔名
     rel_path   TEXT        NOT NULL,  -- 相對路徑（從 datasets/ 底下開始）
     abs_path   TEXT        NOT NULL,  -- 絕對路徑（完整 Windows 路徑）
-    created_at TIMESTAMPTZ DEFAULT now()
+    size_bytes BIGINT,                -- 檔案大小，重新索引時用來判斷有沒有變
+    mtime      DOUBLE PRECISION,      -- 檔案修改時間（epoch 秒）
+    created_at TIMESTAMPTZ DEFAULT now(),
+    updated_at TIMESTAMPTZ DEFAULT now()  -- 最後一次內容有變動的時間
 );
 
 -- 避免重複插入同一個檔案
@@ -0,0 +1,24 @@
+-- 推論效能測試結果（benchmark.py），每個 engine × imgsz × batch × threads 組合一列
+CREATE TABLE benchmarks (
+    id              SERIAL PRIMARY KEY,
+    created_at      TIMESTAMPTZ DEFAULT now(),
+    git_commit      TEXT,              -- 測試時的 commit（有未提交修改會加 -dirty）
+    weights_path    TEXT,
+    weights_sha256  TEXT,
+    train_run_id    INTEGER REFERENCES train_runs(id) ON DELETE SET NULL,  -- 權重來自哪次訓練
+    host            TEXT,              -- 測試機器
+    engine          TEXT    NOT NULL,  -- torch / onnx / onnx-int8
+    imgsz           INTEGER NOT NULL,
+    batch           INTEGER NOT NULL,
+    threads         INTEGER NOT NULL,
+    n_images        INTEGER,           -- 量測用的影像張數（含重複輪數）
+    p50_ms          REAL,              -- 每個 batch 的延遲百分位數
+    p95_ms          REAL,
+    p99_ms          REAL,
+    img_per_s       REAL,
+    peak_rss_mb     REAL,              -- 子程序的最高常駐記憶體
+    notes           TEXT
+);
+
+CREATE INDEX ix_benchmarks_commit  ON benchmarks(git_commit, created_at DESC);
+CREATE INDEX ix_benchmarks_weights ON benchmarks(weights_sha256, created_at DESC);
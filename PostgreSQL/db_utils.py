@@ -1,5 +1,17 @@
+import atexit
+import hashlib
+import io
 import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from pathlib import Path
+
 import psycopg2
+from psycopg2 import pool
+from psycopg2.extras import execute_values
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -11,36 +23,264 @@ DB_CONFIG = {
     "password": os.getenv("PGPASSWORD", ""),
 }
 
-import psycopg2  # 你前面其實已經有這行，如果有就不用再加
+# ========= 連線池設定 =========
+POOL_MIN_CONN = int(os.getenv("PGPOOL_MIN", "1"))
+POOL_MAX_CONN = int(os.getenv("PGPOOL_MAX", "5"))
+# 連線都借出去時最多等幾秒（ThreadedConnectionPool 本身不會等，直接丟 PoolError）
+POOL_WAIT_SECONDS = float(os.getenv("PGPOOL_WAIT", "30"))
+
+_pool = None
+_pool_lock = threading.Lock()
+# 同時借出的連線數不超過 POOL_MAX_CONN，多的呼叫端在這裡排隊
+_pool_slots = threading.BoundedSemaphore(POOL_MAX_CONN)
 
-def insert_raw_image(img_bytes, filename, content_type, width, height):
-    """
-    將一張原始圖片（binary）寫進 raw_images 表，回傳 image_id。
-    """
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        INSERT INTO raw_images (filename, content_type, width, height, bytes)
-        VALUES (%s, %s, %s, %s, %s)
-        RETURNING id;
-        """,
-        (filename, content_type, width, height, psycopg2.Binary(img_bytes)),
-    )
-    image_id = cur.fetchone()[0]
-    conn.commit()
-    cur.close()
-    conn.close()
-    return image_id
 
 def get_conn():
     """
     建立一個新的 PostgreSQL 連線。
     呼叫端記得用完要關閉：cur.close(); conn.close()
+    一般情況請改用 pooled_conn()，不用每次重新握手。
     """
     return psycopg2.connect(**DB_CONFIG)
 
 
+def get_pool():
+    """第一次用到時才建立 ThreadedConnectionPool（多執行緒共用）"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = pool.ThreadedConnectionPool(POOL_MIN_CONN, POOL_MAX_CONN, **DB_CONFIG)
+    return _pool
+
+
+@contextmanager
+def pooled_conn():
+    """
+    從連線池借一條連線，區塊結束自動 commit（出錯就 rollback）並歸還。
+    連線都被借走時會等到有人歸還（最多 POOL_WAIT_SECONDS 秒，逾時丟 PoolError）。
+    用法：
+        with pooled_conn() as conn, conn.cursor() as cur:
+            cur.execute(...)
+    """
+    if not _pool_slots.acquire(timeout=POOL_WAIT_SECONDS):
+        raise pool.PoolError(f"等了 {POOL_WAIT_SECONDS:.0f} 秒還是借不到連線（PGPOOL_MAX={POOL_MAX_CONN}）")
+    try:
+        p = get_pool()
+        conn = p.getconn()
+    except Exception:
+        _pool_slots.release()
+        raise
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        # 連線已經斷掉就直接丟掉，不要放回池子
+        p.putconn(conn, close=bool(conn.closed))
+        _pool_slots.release()
+
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+
+
+# ========= 原始影像存放（image_blobs 去重複） =========
+# inline = image_blobs.bytes；file = 以內容雜湊命名的檔案；lo = PostgreSQL large object
+RAW_IMAGE_STORAGE = os.getenv("RAW_IMAGE_STORAGE", "inline")
+BLOB_STORE_DIR = Path(os.getenv("BLOB_STORE_DIR", Path(__file__).resolve().parents[1] / "blob_store"))
+BLOB_CHUNK_SIZE = 1024 * 1024
+
+
+def blob_digest(img_bytes):
+    """影像內容的 SHA-256（hex），也是 image_blobs 的主鍵"""
+    return hashlib.sha256(img_bytes).hexdigest()
+
+
+def _blob_file_path(sha256):
+    return Path(sha256[:2]) / sha256[2:4] / sha256
+
+
+def _write_blob_file(sha256, img_bytes):
+    """寫進內容定址的檔案庫（先寫暫存檔再 rename，同內容已存在就跳過）"""
+    rel_path = _blob_file_path(sha256)
+    path = BLOB_STORE_DIR / rel_path
+    if not path.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f"{sha256}.{os.getpid()}.{threading.get_ident()}.tmp")
+        view = memoryview(img_bytes)
+        with open(tmp, "wb") as f:
+            for start in range(0, len(view), BLOB_CHUNK_SIZE):
+                f.write(view[start:start + BLOB_CHUNK_SIZE])
+        os.replace(tmp, path)
+    return rel_path.as_posix()
+
+
+def _write_large_object(conn, img_bytes):
+    lobj = conn.lobject(0, "wb")
+    view = memoryview(img_bytes)
+    for start in range(0, len(view), BLOB_CHUNK_SIZE):
+        lobj.write(view[start:start + BLOB_CHUNK_SIZE])
+    oid = lobj.oid
+    lobj.close()
+    return oid
+
+
+def ensure_blobs(conn, blobs, storage=None):
+    """
+    確保每個 (sha256, img_bytes, thumbnail) 都已存在 image_blobs。
+    先用一個查詢找出已經有的，只有新內容才真的傳 bytes。
+    """
+    storage = storage or RAW_IMAGE_STORAGE
+    unique = {}
+    for sha256, img_bytes, thumbnail in blobs:
+        unique.setdefault(sha256, (img_bytes, thumbnail))
+    if not unique:
+        return
+
+    with conn.cursor() as cur:
+        cur.execute("SELECT sha256 FROM image_blobs WHERE sha256 = ANY(%s)", (list(unique),))
+        existing = {row[0] for row in cur.fetchall()}
+
+        for sha256, (img_bytes, thumbnail) in unique.items():
+            if sha256 in existing:
+                continue
+            inline_bytes = file_path = lo_oid = None
+            if storage == "file":
+                file_path = _write_blob_file(sha256, img_bytes)
+            elif storage == "lo":
+                lo_oid = _write_large_object(conn, img_bytes)
+            else:
+                inline_bytes = psycopg2.Binary(img_bytes)
+            cur.execute(
+                """
+                INSERT INTO image_blobs (sha256, size_bytes, storage, bytes, file_path, lo_oid, thumbnail)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+                ON CONFLICT (sha256) DO NOTHING
+                RETURNING sha256;
+                """,
+                (
+                    sha256,
+                    len(img_bytes),
+                    storage if storage in ("file", "lo") else "inline",
+                    inline_bytes,
+                    file_path,
+                    lo_oid,
+                    psycopg2.Binary(thumbnail) if thumbnail is not None else None,
+                ),
+            )
+            # 別的連線剛好先寫進同一份內容：把自己多建的 large object 刪掉
+            if cur.fetchone() is None and lo_oid is not None:
+                conn.lobject(lo_oid).unlink()
+
+
+def insert_raw_image(img_bytes, filename, content_type, width, height, thumbnail=None):
+    """
+    將一張原始圖片寫進 raw_images 表，回傳 image_id。
+    bytes 依內容雜湊存在 image_blobs，同一張圖重複上傳只存一份。
+    """
+    sha256 = blob_digest(img_bytes)
+    with pooled_conn() as conn:
+        ensure_blobs(conn, [(sha256, img_bytes, thumbnail)])
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO raw_images (filename, content_type, width, height, blob_sha256)
+                VALUES (%s, %s, %s, %s, %s)
+                RETURNING id;
+                """,
+                (filename, content_type, width, height, sha256),
+            )
+            image_id = cur.fetchone()[0]
+    return image_id
+
+
+def iter_raw_image_bytes(image_id, chunk_size=BLOB_CHUNK_SIZE):
+    """
+    逐塊讀回一張 raw_images 的原始內容（generator），
+    不管存在哪一種 storage，記憶體都只用到 chunk_size。
+    """
+    with pooled_conn() as conn, conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT b.sha256, b.storage, b.file_path, b.lo_oid
+            FROM raw_images r
+            LEFT JOIN image_blobs b ON b.sha256 = r.blob_sha256
+            WHERE r.id = %s;
+            """,
+            (image_id,),
+        )
+        row = cur.fetchone()
+        if row is None:
+            raise KeyError(f"raw_images 沒有 id={image_id}")
+        sha256, storage, file_path, lo_oid = row
+
+        if storage == "file":
+            with open(BLOB_STORE_DIR / file_path, "rb") as f:
+                for chunk in iter(lambda: f.read(chunk_size), b""):
+                    yield chunk
+            return
+        if storage == "lo":
+            lobj = conn.lobject(lo_oid, "rb")
+            try:
+                for chunk in iter(lambda: lobj.read(chunk_size), b""):
+                    yield chunk
+            finally:
+                lobj.close()
+            return
+
+        # inline（或舊資料直接放在 raw_images.bytes）：用 substring 分段取
+        if sha256 is not None:
+            query = "SELECT substring(bytes FROM %s FOR %s) FROM image_blobs WHERE sha256 = %s"
+            key = sha256
+        else:
+            query = "SELECT substring(bytes FROM %s FOR %s) FROM raw_images WHERE id = %s"
+            key = image_id
+        offset = 1  # PostgreSQL 的 substring 從 1 開始
+        while True:
+            cur.execute(query, (offset, chunk_size, key))
+            chunk = cur.fetchone()[0]
+            if not chunk:
+                return
+            yield bytes(chunk)
+            if len(chunk) < chunk_size:
+                return
+            offset += chunk_size
+
+
+def export_raw_image(image_id, out_path):
+    """把 raw_images 的一張圖串流寫到檔案，回傳寫入的 bytes 數"""
+    total = 0
+    with open(out_path, "wb") as f:
+        for chunk in iter_raw_image_bytes(image_id):
+            f.write(chunk)
+            total += len(chunk)
+    return total
+
+
+def get_raw_image_thumbnail(image_id):
+    """取回 raw_images 的縮圖 JPEG bytes（沒有就回傳 None）"""
+    with pooled_conn() as conn, conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT b.thumbnail
+            FROM raw_images r
+            JOIN image_blobs b ON b.sha256 = r.blob_sha256
+            WHERE r.id = %s;
+            """,
+            (image_id,),
+        )
+        row = cur.fetchone()
+    return bytes(row[0]) if row and row[0] is not None else None
+
+
 def write_log(level, source, message, run_id=None, detail=None):
     """
     把一筆 log 寫進 app_logs 表。
@@ -56,18 +296,14 @@ def write_log(level, source, message, run_id=None, detail=None):
         detail    TEXT
     );
     """
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        INSERT INTO app_logs (level, source, run_id, message, detail)
-        VALUES (%s, %s, %s, %s, %s)
-        """,
-        (level, source, run_id, message, detail),
-    )
-    conn.commit()
-    cur.close()
-    conn.close()
+    with pooled_conn() as conn, conn.cursor() as cur:
+        cur.execute(
+            """
+            INSERT INTO app_logs (level, source, run_id, message, detail)
+            VALUES (%s, %s, %s, %s, %s)
+            """,
+            (level, source, run_id, message, detail),
+        )
 
 
 def insert_train_run(
@@ -103,21 +339,17 @@ def insert_train_run(
         notes         TEXT
     );
     """
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        INSERT INTO train_runs
-        (model_name, data_yaml, epochs, imgsz, batch, lr0, train_imgs, val_imgs, notes)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-        RETURNING id;
-        """,
-        (model_name, data_yaml, epochs, imgsz, batch, lr0, train_imgs, val_imgs, notes),
-    )
-    run_id = cur.fetchone()[0]
-    conn.commit()
-    cur.close()
-    conn.close()
+    with pooled_conn() as conn, conn.cursor() as cur:
+        cur.execute(
+            """
+            INSERT INTO train_runs
+            (model_name, data_yaml, epochs, imgsz, batch, lr0, train_imgs, val_imgs, notes)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+            RETURNING id;
+            """,
+            (model_name, data_yaml, epochs, imgsz, batch, lr0, train_imgs, val_imgs, notes),
+        )
+        run_id = cur.fetchone()[0]
     return run_id
 
 
@@ -127,23 +359,453 @@ def update_train_run_finished(run_id, weights_path=None, best_map50=None, best_m
     - finished_at 設為 now()
     - 若有提供 weights_path / mAP，則一併更新
     """
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
+    with pooled_conn() as conn, conn.cursor() as cur:
+        cur.execute(
+            """
+            UPDATE train_runs
+            SET
+                finished_at = now(),
+                weights_path = COALESCE(%s, weights_path),
+                best_map50 = COALESCE(%s, best_map50),
+                best_map5095 = COALESCE(%s, best_map5095)
+            WHERE id = %s;
+            """,
+            (weights_path, best_map50, best_map5095, run_id),
+        )
+
+
+# 每個 epoch 一列（表結構見 train_epochs.sql），由背景寫入器批次寫入
+TRAIN_EPOCH_COLUMNS = (
+    "run_id", "epoch", "epoch_seconds", "train_seconds", "val_seconds",
+    "data_wait_seconds", "compute_seconds", "n_batches", "n_images", "img_per_s", "peak_rss_mb",
+    "box_loss", "cls_loss", "dfl_loss", "map50", "map5095", "precision", "recall", "lr",
+)
+
+
+def fetch_train_epochs(run_id):
+    """某次訓練的所有 epoch（依 epoch 排序），回傳 list[dict]"""
+    with pooled_conn() as conn, conn.cursor() as cur:
+        cur.execute(
+            f"SELECT {', '.join(TRAIN_EPOCH_COLUMNS)} FROM train_epochs WHERE run_id = %s ORDER BY epoch",
+            (run_id,),
+        )
+        return [dict(zip(TRAIN_EPOCH_COLUMNS, r)) for r in cur.fetchall()]
+
+
+def insert_model_artifact(kind, path, sha256, train_run_id=None, size_bytes=None, imgsz=None,
+                          calib_images=None, map50=None, map5095=None, latency_ms=None, notes=None):
+    """
+    記錄一個部署用的模型檔（ONNX / INT8 量化）與它在 val set 的 mAP、延遲，回傳 artifact id。
+    表結構見 model_artifacts.sql。
+    """
+    with pooled_conn() as conn, conn.cursor() as cur:
+        cur.execute(
+            """
+            INSERT INTO model_artifacts
+            (train_run_id, kind, path, sha256, size_bytes, imgsz, calib_images,
+             map50, map5095, latency_ms, notes)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+            RETURNING id;
+            """,
+            (train_run_id, kind, str(path), sha256, size_bytes, imgsz, calib_images,
+             map50, map5095, latency_ms, notes),
+        )
+        return cur.fetchone()[0]
+
+
+def model_artifacts_for_run(train_run_id):
+    """
+    某個訓練的所有部署檔，連同來源權重的 mAP 一起比較：
+    [(kind, imgsz, map50, map5095, latency_ms, path, 來源 best_map50, 來源 best_map5095), ...]
+    """
+    with pooled_conn() as conn, conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT a.kind, a.imgsz, a.map50, a.map5095, a.latency_ms, a.path,
+                   r.best_map50, r.best_map5095
+            FROM model_artifacts a
+            LEFT JOIN train_runs r ON r.id = a.train_run_id
+            WHERE a.train_run_id = %s
+            ORDER BY a.created_at DESC;
+            """,
+            (train_run_id,),
+        )
+        return cur.fetchall()
+
+
+# ========= benchmarks 表 =========
+BENCHMARK_COLUMNS = (
+    "git_commit", "weights_path", "weights_sha256", "train_run_id", "host",
+    "engine", "imgsz", "batch", "threads", "n_images",
+    "p50_ms", "p95_ms", "p99_ms", "img_per_s", "peak_rss_mb", "notes",
+)
+
+
+def insert_benchmarks(rows):
+    """寫入一組測速結果（list[dict]，key 為 BENCHMARK_COLUMNS，缺的當 NULL），回傳 id 清單"""
+    values = [tuple(row.get(c) for c in BENCHMARK_COLUMNS) for row in rows]
+    if not values:
+        return []
+    with pooled_conn() as conn, conn.cursor() as cur:
+        ids = execute_values(
+            cur,
+            f"INSERT INTO benchmarks ({', '.join(BENCHMARK_COLUMNS)}) VALUES %s RETURNING id",
+            values,
+            fetch=True,
+        )
+    return [r[0] for r in ids]
+
+
+def fetch_benchmarks(git_commit=None, weights_sha256=None):
+    """
+    某個 commit（或權重）最近一次的測速結果，每個 engine / imgsz / batch / threads 組合取最新一筆，
+    回傳 list[dict]。
+    """
+    if git_commit is None and weights_sha256 is None:
+        raise ValueError("git_commit 和 weights_sha256 至少要給一個")
+    with pooled_conn() as conn, conn.cursor() as cur:
+        cur.execute(
+            f"""
+            SELECT DISTINCT ON (engine, imgsz, batch, threads) {', '.join(BENCHMARK_COLUMNS)}
+            FROM benchmarks
+            WHERE (%(commit)s::text IS NULL OR git_commit LIKE %(commit)s || '%%')
+              AND (%(weights)s::text IS NULL OR weights_sha256 LIKE %(weights)s || '%%')
+            ORDER BY engine, imgsz, batch, threads, created_at DESC;
+            """,
+            {"commit": git_commit, "weights": weights_sha256},
+        )
+        return [dict(zip(BENCHMARK_COLUMNS, row)) for row in cur.fetchall()]
+
+
+# ========= detections 表 =========
+# COPY 時的欄位順序；DataFrame 有哪些欄位就寫哪些
+DETECTION_COLUMNS = (
+    "raw_image_id", "file_id", "run_id", "image", "cls", "score",
+    "x1", "y1", "x2", "y2", "lon", "lat", "frame", "track_id",
+)
+_DETECTION_INT_COLUMNS = ("raw_image_id", "file_id", "run_id", "cls", "frame", "track_id")
+
+
+def copy_detections(df, run_id=None, conn=None):
+    """
+    用一次 COPY 把 DataFrame 的偵測結果寫進 detections，回傳寫入筆數。
+    df 至少要有 image, cls, score, x1, y1, x2, y2；其他 DETECTION_COLUMNS 欄位選填。
+    """
+    if run_id is not None and "run_id" not in df.columns:
+        df = df.assign(run_id=run_id)
+    cols = [c for c in DETECTION_COLUMNS if c in df.columns]
+    out = df[cols].copy()
+    for c in _DETECTION_INT_COLUMNS:
+        if c in out.columns:
+            out[c] = out[c].astype("Int64")  # 有 NULL 也不會變成 3.0 這種浮點字串
+
+    buf = io.StringIO()
+    out.to_csv(buf, index=False, header=False, na_rep="")
+    buf.seek(0)
+    sql = f"COPY detections ({', '.join(cols)}) FROM STDIN WITH (FORMAT csv)"
+
+    if conn is not None:
+        with conn.cursor() as cur:
+            cur.copy_expert(sql, buf)
+    else:
+        with pooled_conn() as conn, conn.cursor() as cur:
+            cur.copy_expert(sql, buf)
+    return len(out)
+
+
+def link_detection_files(conn=None):
+    """把還沒對應到 visdrone_files 的偵測結果，用檔名補上 file_id，回傳更新筆數"""
+    sql = """
+        UPDATE detections d
+        SET file_id = f.id
+        FROM visdrone_files f
+        WHERE d.file_id IS NULL
+          AND d.raw_image_id IS NULL
+          AND f.file_type = 'image'
+          AND f.filename = d.image;
+    """
+    if conn is not None:
+        with conn.cursor() as cur:
+            cur.execute(sql)
+            return cur.rowcount
+    with pooled_conn() as conn, conn.cursor() as cur:
+        cur.execute(sql)
+        return cur.rowcount
+
+
+def detection_class_counts(run_id=None, image=None):
+    """每個類別的偵測數量：[(cls, count), ...]，可用 run_id / image 篩選"""
+    with pooled_conn() as conn, conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT cls, count(*)
+            FROM detections
+            WHERE (%(run_id)s::int IS NULL OR run_id = %(run_id)s)
+              AND (%(image)s::text IS NULL OR image = %(image)s)
+            GROUP BY cls
+            ORDER BY cls;
+            """,
+            {"run_id": run_id, "image": image},
+        )
+        return cur.fetchall()
+
+
+def top_detections(k=10, cls=None, run_id=None):
+    """分數最高的 k 筆：[(id, image, cls, score, x1, y1, x2, y2), ...]"""
+    with pooled_conn() as conn, conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT id, image, cls, score, x1, y1, x2, y2
+            FROM detections
+            WHERE (%(cls)s::smallint IS NULL OR cls = %(cls)s)
+              AND (%(run_id)s::int IS NULL OR run_id = %(run_id)s)
+            ORDER BY score DESC
+            LIMIT %(k)s;
+            """,
+            {"k": k, "cls": cls, "run_id": run_id},
+        )
+        return cur.fetchall()
+
+
+def detections_for_image(image=None, raw_image_id=None, cls=None):
+    """一張影像的所有框（用檔名或 raw_image_id 查），依分數由高到低"""
+    if image is None and raw_image_id is None:
+        raise ValueError("image 和 raw_image_id 至少要給一個")
+    with pooled_conn() as conn, conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT id, image, cls, score, x1, y1, x2, y2, lon, lat
+            FROM detections
+            WHERE (%(image)s::text IS NULL OR image = %(image)s)
+              AND (%(raw_image_id)s::bigint IS NULL OR raw_image_id = %(raw_image_id)s)
+              AND (%(cls)s::smallint IS NULL OR cls = %(cls)s)
+            ORDER BY score DESC;
+            """,
+            {"image": image, "raw_image_id": raw_image_id, "cls": cls},
+        )
+        return cur.fetchall()
+
+
+def fetch_detections(run_id=None):
+    """
+    資料集影像的所有偵測結果（不含 app 上傳的影像與影片影格），給 evaluate.py 算 mAP：
+    [(image, cls, score, x1, y1, x2, y2), ...]
+    """
+    with pooled_conn() as conn, conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT image, cls, score, x1, y1, x2, y2
+            FROM detections
+            WHERE raw_image_id IS NULL
+              AND frame IS NULL
+              AND (%(run_id)s::int IS NULL OR run_id = %(run_id)s);
+            """,
+            {"run_id": run_id},
+        )
+        return cur.fetchall()
+
+
+def visdrone_files_fingerprint(split, file_type="annotation"):
+    """
+    visdrone_files 裡某個 split / 類型的指紋（筆數、總大小、mtime 總和、最後更新時間），
+    增量索引（load_visdrone_to_pg.py）有新增 / 修改 / 刪除時這個值就會變。
+    """
+    with pooled_conn() as conn, conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT count(*), coalesce(sum(size_bytes), 0), coalesce(sum(mtime), 0), max(updated_at)
+            FROM visdrone_files
+            WHERE split = %s AND file_type = %s;
+            """,
+            (split, file_type),
+        )
+        count, total_size, mtime_sum, updated_at = cur.fetchone()
+    return f"db:{count}:{total_size}:{float(mtime_sum):.3f}:{updated_at.isoformat() if updated_at else ''}"
+
+
+# ========= 背景批次寫入器 =========
+# 推論路徑上的 log / raw_images 先丟進佇列，由背景執行緒合併成多列 INSERT。
+WRITER_QUEUE_SIZE = int(os.getenv("PGWRITER_QUEUE", "1000"))
+WRITER_BATCH_SIZE = int(os.getenv("PGWRITER_BATCH", "100"))
+WRITER_FLUSH_SECONDS = float(os.getenv("PGWRITER_FLUSH_SECONDS", "1.0"))
+
+# 背景寫入器可以寫的表：table -> 欄位順序（submit 的 row 要照這個順序）
+WRITER_TABLES = {
+    "app_logs": ("level", "source", "run_id", "message", "detail"),
+    "raw_images": ("filename", "content_type", "width", "height", "blob_sha256"),
+    "train_epochs": TRAIN_EPOCH_COLUMNS,
+    "metrics": ("host", "pid", "stage", "labels", "window_seconds", "count", "sum_ms", "max_ms", "p50_ms", "p95_ms"),
+}
+
+# INSERT 之前要先做的事：table -> fn(conn, [extra, ...])，跟 INSERT 在同一個 transaction
+WRITER_PREPARE = {
+    "raw_images": ensure_blobs,
+}
+
+_STOP = object()
+
+
+class BatchWriter:
+    """
+    有上限佇列的背景寫入執行緒：
+    - submit() 永遠不會卡住，佇列滿了就丟掉並計數
+    - 湊滿 batch_size 筆或距離第一筆超過 flush_seconds 就 flush
+    - 每張表一個 multi-row INSERT ... RETURNING id，id 透過 Future 回傳；
+      整批失敗時逐筆重試，一筆壞資料不會拖累同一批其他的列
+    """
+
+    def __init__(self, max_queue=WRITER_QUEUE_SIZE, batch_size=WRITER_BATCH_SIZE,
+                 flush_seconds=WRITER_FLUSH_SECONDS):
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = threading.Thread(target=self._run, name="pg-batch-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, table, row, extra=None):
+        """
+        排入一列，回傳 Future（結果為新列的 id）；佇列滿或已關閉則回傳 None。
+        extra 會交給 WRITER_PREPARE[table]（例如 raw_images 的影像內容）。
         """
-        UPDATE train_runs
-        SET
-            finished_at = now(),
-            weights_path = COALESCE(%s, weights_path),
-            best_map50 = COALESCE(%s, best_map50),
-            best_map5095 = COALESCE(%s, best_map5095)
-        WHERE id = %s;
-        """,
-        (weights_path, best_map50, best_map5095, run_id),
+        if table not in WRITER_TABLES:
+            raise ValueError(f"BatchWriter 不支援的表：{table}")
+        if not self._thread.is_alive():
+            return None
+        fut = Future()
+        try:
+            self._queue.put_nowait((table, tuple(row), extra, fut))
+        except queue.Full:
+            self.dropped += 1
+            print(f"[DB] 寫入佇列已滿，丟棄一筆 {table}（累計 {self.dropped}）")
+            return None
+        return fut
+
+    def _run(self):
+        pending = {}
+        count = 0
+        deadline = None
+        while True:
+            timeout = None if count == 0 else max(0.0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is _STOP:
+                self._flush(pending)
+                return
+            if item is not None:
+                table, row, extra, fut = item
+                pending.setdefault(table, []).append((row, extra, fut))
+                count += 1
+                if count == 1:
+                    deadline = time.monotonic() + self.flush_seconds
+
+            if count and (count >= self.batch_size or time.monotonic() >= deadline):
+                self._flush(pending)
+                pending = {}
+                count = 0
+
+    def _insert(self, table, items):
+        """items 在同一個 transaction 裡寫入，回傳跟 items 同順序的新 id"""
+        with pooled_conn() as conn:
+            prepare = WRITER_PREPARE.get(table)
+            if prepare is not None:
+                prepare(conn, [extra for _, extra, _ in items if extra is not None])
+            with conn.cursor() as cur:
+                ids = execute_values(
+                    cur,
+                    f"INSERT INTO {table} ({', '.join(WRITER_TABLES[table])}) VALUES %s RETURNING id",
+                    [row for row, _, _ in items],
+                    page_size=len(items),
+                    fetch=True,
+                )
+            # id 靠位置對回 Future：整批是單一個 INSERT ... VALUES（page_size = 筆數），
+            # PostgreSQL 的 RETURNING 依 VALUES 的順序回傳。筆數對不上就整批 rollback，不要把 id 配錯列
+            if len(ids) != len(items):
+                raise RuntimeError(f"INSERT {table} 回傳 {len(ids)} 個 id，預期 {len(items)} 個")
+        return [new_id for (new_id,) in ids]
+
+    def _flush(self, pending):
+        for table, items in pending.items():
+            try:
+                ids = self._insert(table, items)
+            except Exception as e:
+                # 連不上 DB 的話逐筆重試也一樣；其他錯誤（run_id 違反 FK、值太長…）
+                # 可能只是其中一筆的問題，改成一筆一個 transaction，只讓有問題的那筆失敗
+                if len(items) > 1 and not isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError,
+                                                         pool.PoolError)):
+                    print(f"[DB] 批次寫入 {table} 失敗（{len(items)} 筆），改成逐筆寫入：{e}")
+                    for item in items:
+                        self._flush({table: [item]})
+                    continue
+                print(f"[DB] 批次寫入 {table} 失敗（{len(items)} 筆）：{e}")
+                for _, _, fut in items:
+                    fut.set_exception(e)
+                continue
+            for (_, _, fut), new_id in zip(items, ids):
+                fut.set_result(new_id)
+
+    def shutdown(self, timeout=10.0):
+        """送出停止訊號並等佇列裡剩下的資料寫完"""
+        if not self._thread.is_alive():
+            return
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            print("[DB] 關閉寫入器逾時，佇列裡的資料可能沒寫完")
+            return
+        self._thread.join(timeout)
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_writer():
+    """整個 process 共用一個 BatchWriter，結束時自動 drain"""
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = BatchWriter()
+                atexit.register(shutdown_writer)
+    return _writer
+
+
+def shutdown_writer(timeout=10.0):
+    global _writer
+    with _writer_lock:
+        writer, _writer = _writer, None
+    if writer is not None:
+        writer.shutdown(timeout)
+
+
+def write_log_async(level, source, message, run_id=None, detail=None):
+    """write_log 的非阻塞版本，回傳 Future 或 None（佇列滿）"""
+    return get_writer().submit("app_logs", (level, source, run_id, message, detail))
+
+
+def write_metrics_async(rows):
+    """ui_playground/metrics.py 的視窗統計（每列依 WRITER_TABLES["metrics"] 的欄位順序），回傳 Future 清單"""
+    writer = get_writer()
+    return [writer.submit("metrics", row) for row in rows]
+
+
+def write_train_epoch_async(row):
+    """train_epochs 的一列（dict，key 為 TRAIN_EPOCH_COLUMNS，缺的當 NULL），回傳 Future 或 None"""
+    return get_writer().submit("train_epochs", tuple(row.get(c) for c in TRAIN_EPOCH_COLUMNS))
+
+
+def insert_raw_image_async(img_bytes, filename, content_type, width, height, thumbnail=None):
+    """insert_raw_image 的非阻塞版本，Future.result() 可拿到 image_id"""
+    sha256 = blob_digest(img_bytes)
+    return get_writer().submit(
+        "raw_images",
+        (filename, content_type, width, height, sha256),
+        extra=(sha256, img_bytes, thumbnail),
     )
-    conn.commit()
-    cur.close()
-    conn.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,25 @@
+CREATE TABLE detections (
+    id            BIGSERIAL PRIMARY KEY,
+    created_at    TIMESTAMPTZ DEFAULT now(),
+    raw_image_id  BIGINT  REFERENCES raw_images(id) ON DELETE CASCADE,       -- 從 app 上傳的影像
+    file_id       INTEGER REFERENCES visdrone_files(id) ON DELETE SET NULL,  -- 資料集裡的影像
+    run_id        INTEGER REFERENCES train_runs(id) ON DELETE SET NULL,      -- 產生這筆結果的權重
+    image         TEXT     NOT NULL,   -- 影像檔名
+    cls           SMALLINT NOT NULL,   -- YOLO 類別 id（0~9）
+    score         REAL     NOT NULL,   -- 信心分數
+    x1            REAL     NOT NULL,   -- pixel 座標
+    y1            REAL     NOT NULL,
+    x2            REAL     NOT NULL,
+    y2            REAL     NOT NULL,
+    lon           DOUBLE PRECISION,    -- 框中心經緯度（有做 geo 才有）
+    lat           DOUBLE PRECISION,
+    frame         INTEGER,             -- 影片的影格編號（靜態影像為 NULL）
+    track_id      INTEGER              -- 影片追蹤的物件 id
+);
+
+CREATE INDEX ix_detections_image_cls     ON detections(image, cls);
+CREATE INDEX ix_detections_raw_image_cls ON detections(raw_image_id, cls);
+CREATE INDEX ix_detections_file          ON detections(file_id);
+CREATE INDEX ix_detections_score         ON detections(score DESC);
+CREATE INDEX ix_detections_lat_lon       ON detections(lat, lon) WHERE lat IS NOT NULL;
+CREATE INDEX ix_detections_video_frame   ON detections(image, frame) WHERE frame IS NOT NULL;
@@ -0,0 +1,5 @@
+-- 舊的 detections 表補上影片用的欄位（video_infer.py 會寫 frame / track_id）
+ALTER TABLE detections ADD COLUMN IF NOT EXISTS frame    INTEGER;
+ALTER TABLE detections ADD COLUMN IF NOT EXISTS track_id INTEGER;
+
+CREATE INDEX IF NOT EXISTS ix_detections_video_frame ON detections(image, frame) WHERE frame IS NOT NULL;
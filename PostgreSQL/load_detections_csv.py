@@ -0,0 +1,41 @@
+import argparse
+import time
+
+import pandas as pd
+
+from db_utils import copy_detections, link_detection_files, pooled_conn
+
+# CSV 欄位 -> detections 欄位（notebook 輸出的 detections_pixel.csv / detections_fake_geo.csv）
+CSV_COLUMNS = {
+    "image": "image",
+    "x1": "x1",
+    "y1": "y1",
+    "x2": "x2",
+    "y2": "y2",
+    "score": "score",
+    "cls": "cls",
+    "lon": "lon",
+    "lat": "lat",
+}
+
+
+def load_detections_csv(csv_path, run_id=None):
+    """把一個偵測結果 CSV 用單一 COPY 匯入 detections，並用檔名對應 visdrone_files"""
+    t0 = time.perf_counter()
+    df = pd.read_csv(csv_path)
+    df = df[[c for c in CSV_COLUMNS if c in df.columns]].rename(columns=CSV_COLUMNS)
+
+    with pooled_conn() as conn:
+        n_rows = copy_detections(df, run_id=run_id, conn=conn)
+        n_linked = link_detection_files(conn)
+
+    print(f"✅ 匯入 {n_rows} 筆偵測結果（對應到 visdrone_files {n_linked} 筆），耗時 {time.perf_counter() - t0:.2f}s")
+    return n_rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="把偵測結果 CSV 匯入 detections 表")
+    parser.add_argument("csv_path", help="例如 results/detections_fake_geo.csv")
+    parser.add_argument("--run-id", type=int, default=None, help="產生這批結果的 train_runs.id")
+    args = parser.parse_args()
+    load_detections_csv(args.csv_path, run_id=args.run_id)
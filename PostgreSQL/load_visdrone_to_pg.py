@@ -1,4 +1,9 @@
+import csv
+import io
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import psycopg2
 
 # ===== 1. 路徑設定 =====
@@ -29,53 +34,140 @@ def get_conn():
     return psycopg2.connect(**DB_CONFIG)
 
 
-def insert_visdrone_files():
-    """掃描資料夾，寫入 visdrone_files 表"""
-    conn = get_conn()
-    cur = conn.cursor()
+# 各類型要收的副檔名
+FILE_EXTS = {
+    "image": (".jpg", ".jpeg", ".png"),
+    "annotation": (".txt", ".xml"),
+}
 
-    total = 0  # 計算總共處理多少檔案
+STAGE_COLUMNS = ("split", "file_type", "filename", "rel_path", "abs_path", "size_bytes", "mtime")
+
+
+def scan_folder(split, file_type, folder):
+    """
+    用 os.scandir 掃一個資料夾（包含子資料夾），
+    回傳 {rel_path: (split, file_type, filename, rel_path, abs_path, size_bytes, mtime)}。
+    資料夾不存在回傳 None（這個分類就不做刪除比對）。
+    """
+    if not os.path.isdir(folder):
+        print(f"⚠️ 找不到資料夾，略過：{folder}")
+        return None
+
+    exts = FILE_EXTS.get(file_type, ())
+    rows = {}
+    stack = [folder]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                    continue
+                # 根據類型簡單過濾副檔名
+                if not entry.name.lower().endswith(exts):
+                    continue
+                st = entry.stat()
+                # 從 DATA_ROOT 開始的相對路徑，把 Windows 的 \ 換成 /
+                rel_path = os.path.relpath(entry.path, DATA_ROOT).replace("\\", "/")
+                rows[rel_path] = (split, file_type, entry.name, rel_path, entry.path, st.st_size, st.st_mtime)
+    return rows
+
+
+def scan_all(dir_configs=DIR_CONFIGS):
+    """每個 (split, file_type) 資料夾各開一個執行緒平行掃描"""
+    with ThreadPoolExecutor(max_workers=len(dir_configs)) as pool:
+        results = pool.map(lambda cfg: scan_folder(*cfg), dir_configs)
+        return {(split, file_type): rows for (split, file_type, _), rows in zip(dir_configs, results)}
+
+
+def fetch_existing(cur):
+    """DB 目前的狀態：{(split, file_type): {rel_path: (id, abs_path, size_bytes, mtime)}}"""
+    cur.execute("SELECT id, split, file_type, rel_path, abs_path, size_bytes, mtime FROM visdrone_files")
+    existing = {}
+    for file_id, split, file_type, rel_path, abs_path, size_bytes, mtime in cur:
+        existing.setdefault((split, file_type), {})[rel_path] = (file_id, abs_path, size_bytes, mtime)
+    return existing
+
+
+def copy_to_stage(cur, rows):
+    """把變動的列用 COPY 一次灌進暫存表"""
+    cur.execute(
+        """
+        CREATE TEMP TABLE visdrone_stage (
+            split      TEXT,
+            file_type  TEXT,
+            filename   TEXT,
+            rel_path   TEXT,
+            abs_path   TEXT,
+            size_bytes BIGINT,
+            mtime      DOUBLE PRECISION
+        ) ON COMMIT DROP
+        """
+    )
+    buf = io.StringIO()
+    csv.writer(buf).writerows(rows)
+    buf.seek(0)
+    cur.copy_expert(f"COPY visdrone_stage ({', '.join(STAGE_COLUMNS)}) FROM STDIN WITH (FORMAT csv)", buf)
 
-    for split, file_type, folder in DIR_CONFIGS:
-        print(f"\n=== 處理 {split} / {file_type} / {folder} ===")
 
-        # os.walk 會走訪資料夾底下所有檔案（包含子資料夾）
-        for root, dirs, files in os.walk(folder):
-            for fname in files:
-                # 根據類型簡單過濾副檔名
-                if file_type == "image":
-                    if not fname.lower().endswith((".jpg", ".jpeg", ".png")):
-                        continue
-                elif file_type == "annotation":
-                    if not fname.lower().endswith((".txt", ".xml")):
-                        continue
-
-                # 絕對路徑
-                abs_path = os.path.join(root, fname)
-                # 從 DATA_ROOT 開始的相對路徑
-                rel_path = os.path.relpath(abs_path, DATA_ROOT)
-                # 把 Windows 的 \ 換成 /，看起來比較一致
-                rel_path = rel_path.replace("\\", "/")
-
-                # 印出要寫進去的資訊（讓你看過程）
-                print(f"插入：{split} | {file_type} | {rel_path}")
-
-                # 寫進資料庫
-                cur.execute(
-                    """
-                    INSERT INTO visdrone_files (split, file_type, filename, rel_path, abs_path)
-                    VALUES (%s, %s, %s, %s, %s)
-                    ON CONFLICT (split, file_type, rel_path) DO NOTHING
-                    """,
-                    (split, file_type, fname, rel_path, abs_path)
-                )
-
-                total += 1
+def insert_visdrone_files():
+    """
+    掃描資料夾，增量同步 visdrone_files 表：
+    只有新增 / 大小或 mtime 改變 / 已刪除的檔案才會動到 DB。
+    """
+    t0 = time.perf_counter()
+    scanned = scan_all()
+    t_scan = time.perf_counter() - t0
+
+    conn = get_conn()
+    cur = conn.cursor()
+    existing = fetch_existing(cur)
+
+    changed = []
+    deleted_ids = []
+    total = 0
+    for key, rows in scanned.items():
+        if rows is None:
+            continue
+        total += len(rows)
+        old = existing.get(key, {})
+        for rel_path, row in rows.items():
+            prev = old.get(rel_path)
+            # prev = (id, abs_path, size_bytes, mtime)
+            if prev is None or prev[1:] != (row[4], row[5], row[6]):
+                changed.append(row)
+        deleted_ids.extend(prev[0] for rel_path, prev in old.items() if rel_path not in rows)
+
+    inserted = updated = 0
+    if changed:
+        copy_to_stage(cur, changed)
+        cur.execute(
+            """
+            INSERT INTO visdrone_files (split, file_type, filename, rel_path, abs_path, size_bytes, mtime)
+            SELECT split, file_type, filename, rel_path, abs_path, size_bytes, mtime
+            FROM visdrone_stage
+            ON CONFLICT (split, file_type, rel_path) DO UPDATE
+            SET abs_path   = EXCLUDED.abs_path,
+                size_bytes = EXCLUDED.size_bytes,
+                mtime      = EXCLUDED.mtime,
+                updated_at = now()
+            RETURNING (xmax = 0) AS inserted
+            """
+        )
+        flags = [row[0] for row in cur.fetchall()]
+        inserted = sum(flags)
+        updated = len(flags) - inserted
+    if deleted_ids:
+        cur.execute("DELETE FROM visdrone_files WHERE id = ANY(%s)", (deleted_ids,))
 
     conn.commit()
     cur.close()
     conn.close()
-    print(f"\n✅ 完成，嘗試插入 {total} 筆資料（重複的會被跳過）")
+    print(
+        f"✅ 完成，掃描 {total} 個檔案（{t_scan:.2f}s）："
+        f"新增 {inserted}、更新 {updated}、刪除 {len(deleted_ids)}，"
+        f"總耗時 {time.perf_counter() - t0:.2f}s"
+    )
+    return {"scanned": total, "inserted": inserted, "updated": updated, "deleted": len(deleted_ids)}
 
 
 if __name__ == "__main__":
@@ -0,0 +1,18 @@
+-- 各處理階段的耗時統計（ui_playground/metrics.py 每隔一段時間 flush 一次），
+-- 每個 process × 階段 × 標籤一列，只存這段期間的摘要，不存每次的原始值
+CREATE TABLE metrics (
+    id              SERIAL PRIMARY KEY,
+    ts              TIMESTAMPTZ DEFAULT now(),  -- flush 時間（這段期間的結尾）
+    host            TEXT    NOT NULL,
+    pid             INTEGER NOT NULL,
+    stage           TEXT    NOT NULL,  -- read / decode / save_raw_image / preprocess / forward / postprocess / render / dataframe …
+    labels          TEXT,              -- 例如 engine=onnx
+    window_seconds  REAL    NOT NULL,  -- 這段期間的長度
+    count           INTEGER NOT NULL,
+    sum_ms          REAL    NOT NULL,
+    max_ms          REAL,
+    p50_ms          REAL,              -- 從 histogram bucket 內插估出來的
+    p95_ms          REAL
+);
+
+CREATE INDEX ix_metrics_stage_ts ON metrics(stage, ts DESC);
@@ -0,0 +1,18 @@
+-- 由訓練結果衍生出來的部署檔（ONNX / INT8 量化模型），連回來源的 train_runs
+CREATE TABLE model_artifacts (
+    id             SERIAL PRIMARY KEY,
+    created_at     TIMESTAMPTZ DEFAULT now(),
+    train_run_id   INTEGER REFERENCES train_runs(id) ON DELETE SET NULL,  -- 來源訓練（權重）
+    kind           TEXT    NOT NULL,   -- onnx-fp32 / onnx-int8-dynamic / onnx-int8-static
+    path           TEXT    NOT NULL,   -- 檔案路徑
+    sha256         TEXT    NOT NULL,
+    size_bytes     BIGINT,
+    imgsz          INTEGER,
+    calib_images   INTEGER,            -- 靜態量化用的校正影像張數
+    map50          REAL,               -- 在 val set 量到的 mAP@0.50
+    map5095        REAL,               -- 在 val set 量到的 mAP@0.50:0.95
+    latency_ms     REAL,               -- 單張 CPU 推論延遲（p50）
+    notes          TEXT
+);
+
+CREATE INDEX ix_model_artifacts_run_kind ON model_artifacts(train_run_id, kind, created_at DESC);
@@ -1,3 +1,18 @@
+-- 影像內容只存一份：同一張圖重複上傳只會多一筆 raw_images，不會多一份 bytes
+CREATE TABLE image_blobs (
+    sha256       TEXT PRIMARY KEY,          -- 影像內容的 SHA-256（hex）
+    size_bytes   BIGINT      NOT NULL,
+    storage      TEXT        NOT NULL,      -- 'inline' / 'file' / 'lo'
+    bytes        BYTEA,                     -- storage = 'inline' 時才有
+    file_path    TEXT,                      -- storage = 'file'：BLOB_STORE_DIR 底下的相對路徑
+    lo_oid       OID,                       -- storage = 'lo'：PostgreSQL large object
+    thumbnail    BYTEA,                     -- 小縮圖 JPEG（列表 / 預覽用）
+    created_at   TIMESTAMPTZ DEFAULT now()
+);
+
+-- JPEG/PNG 本來就壓縮過，關掉 TOAST 壓縮，substring() 才能只讀需要的那幾塊
+ALTER TABLE image_blobs ALTER COLUMN bytes SET STORAGE EXTERNAL;
+
 CREATE TABLE raw_images (
     id           BIGSERIAL PRIMARY KEY,
     uploaded_at  TIMESTAMPTZ DEFAULT now(),
@@ -5,5 +20,8 @@ CREATE TABLE raw_images (
     content_type TEXT,
     width        INTEGER,
     height       INTEGER,
-    bytes        BYTEA NOT NULL
+    blob_sha256  TEXT REFERENCES image_blobs(sha256),
+    bytes        BYTEA                      -- 舊資料用，新寫入一律放 image_blobs
 );
+
+CREATE INDEX ix_raw_images_blob ON raw_images(blob_sha256);
@@ -0,0 +1,36 @@
+-- 既有資料庫從「raw_images.bytes 直接存影像」升級到 image_blobs 去重複存放
+CREATE TABLE IF NOT EXISTS image_blobs (
+    sha256       TEXT PRIMARY KEY,
+    size_bytes   BIGINT      NOT NULL,
+    storage      TEXT        NOT NULL,
+    bytes        BYTEA,
+    file_path    TEXT,
+    lo_oid       OID,
+    thumbnail    BYTEA,
+    created_at   TIMESTAMPTZ DEFAULT now()
+);
+ALTER TABLE image_blobs ALTER COLUMN bytes SET STORAGE EXTERNAL;
+
+ALTER TABLE raw_images ADD COLUMN IF NOT EXISTS blob_sha256 TEXT REFERENCES image_blobs(sha256);
+ALTER TABLE raw_images ALTER COLUMN bytes DROP NOT NULL;
+CREATE INDEX IF NOT EXISTS ix_raw_images_blob ON raw_images(blob_sha256);
+
+-- 把舊的 inline bytes 搬進 image_blobs（需要 pgcrypto 的 digest()）
+CREATE EXTENSION IF NOT EXISTS pgcrypto;
+
+INSERT INTO image_blobs (sha256, size_bytes, storage, bytes)
+SELECT DISTINCT ON (h) h, length(bytes), 'inline', bytes
+FROM (
+    SELECT encode(digest(bytes, 'sha256'), 'hex') AS h, bytes
+    FROM raw_images
+    WHERE blob_sha256 IS NULL AND bytes IS NOT NULL
+) s
+ON CONFLICT (sha256) DO NOTHING;
+
+UPDATE raw_images
+SET blob_sha256 = encode(digest(bytes, 'sha256'), 'hex'),
+    bytes = NULL
+WHERE blob_sha256 IS NULL AND bytes IS NOT NULL;
+
+-- 回收被清掉的空間
+VACUUM FULL raw_images;
@@ -0,0 +1,26 @@
+-- 訓練過程每個 epoch 一列（train_visdrone.py 的 callback 寫入），找慢的 epoch / 跨 run 的吞吐量退步用
+CREATE TABLE train_epochs (
+    id                 SERIAL PRIMARY KEY,
+    run_id             INTEGER NOT NULL REFERENCES train_runs(id) ON DELETE CASCADE,
+    epoch              INTEGER NOT NULL,   -- 從 1 開始
+    created_at         TIMESTAMPTZ DEFAULT now(),
+    epoch_seconds      REAL,               -- 訓練 + 驗證
+    train_seconds      REAL,
+    val_seconds        REAL,
+    data_wait_seconds  REAL,               -- 等 DataLoader 給下一個 batch 的時間
+    compute_seconds    REAL,               -- forward / backward / optimizer step
+    n_batches          INTEGER,
+    n_images           INTEGER,
+    img_per_s          REAL,               -- n_images / train_seconds
+    peak_rss_mb        REAL,               -- 主程序到目前為止的最高常駐記憶體
+    box_loss           REAL,
+    cls_loss           REAL,
+    dfl_loss           REAL,
+    map50              REAL,               -- 這個 epoch 的 val mAP@0.50
+    map5095            REAL,
+    precision          REAL,
+    recall             REAL,
+    lr                 REAL
+);
+
+CREATE INDEX ix_train_epochs_run ON train_epochs(run_id, epoch);
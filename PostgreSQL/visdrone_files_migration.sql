@@ -0,0 +1,4 @@
+-- 既有的 visdrone_files 加上增量索引需要的欄位
+ALTER TABLE visdrone_files ADD COLUMN IF NOT EXISTS size_bytes BIGINT;
+ALTER TABLE visdrone_files ADD COLUMN IF NOT EXISTS mtime      DOUBLE PRECISION;
+ALTER TABLE visdrone_files ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ DEFAULT now();
@@ -0,0 +1,290 @@
+# ui_playground/ann_cache.py
+# 把一個 split 的所有 VisDrone 標註編譯成一次性的欄位式二進位快取（每欄一個 .npy，可 memmap），
+# 類別分布、框大小分布、每張圖框數都直接對 memmap 做 numpy 運算，不用再讀幾千個 txt。
+#
+#   python ann_cache.py                      # 建立 / 更新 train、val 的快取並印出統計
+#   cache = load_or_build("D:/Sandy/VisDrone/datasets/VisDrone2019-DET-val")
+#   cache.class_histogram()
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import yaml
+
+from convert_labels import DATA_YAML, DEFAULT_SPLITS, IMAGE_EXTS, default_data_root, image_size, parse_annotation
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+sys.path.append(str(PROJECT_ROOT / "PostgreSQL"))
+
+CACHE_VERSION = 1
+CACHE_DIRNAME = "annotations.cache"
+
+# 每個欄位一個檔案：欄位名 -> dtype（順序同 VisDrone 標註，前面多一個影像 index）
+COLUMNS = {
+    "img": np.uint32,
+    "x": np.int32,
+    "y": np.int32,
+    "w": np.int32,
+    "h": np.int32,
+    "score": np.uint8,
+    "cls": np.uint8,
+    "trunc": np.uint8,
+    "occ": np.uint8,
+}
+_ANN_FIELDS = ("x", "y", "w", "h", "score", "cls", "trunc", "occ")
+
+
+def _visdrone_names():
+    """VisDrone 原始類別 0~11：0 = ignored regions、1~10 = config 的 names、11 = others"""
+    with open(DATA_YAML, "r", encoding="utf-8") as f:
+        return ["ignored"] + list(yaml.safe_load(f)["names"]) + ["others"]
+
+
+VISDRONE_NAMES = _visdrone_names()
+
+
+def _split_key(split_dir):
+    """VisDrone2019-DET-train → train（visdrone_files.split 的值）"""
+    name = os.path.basename(os.path.normpath(split_dir))
+    return name.rsplit("-", 1)[-1].lower()
+
+
+def _fs_fingerprint(ann_dir):
+    """沒有 DB 時的指紋：標註檔數、總大小、mtime 總和（只 stat 不讀內容）"""
+    count = total = 0
+    mtime_sum = 0.0
+    with os.scandir(ann_dir) as it:
+        for e in it:
+            if e.is_file() and e.name.endswith(".txt"):
+                st = e.stat()
+                count += 1
+                total += st.st_size
+                mtime_sum += st.st_mtime
+    return f"fs:{count}:{total}:{mtime_sum:.3f}"
+
+
+def dataset_fingerprint(split_dir, use_db=True):
+    """優先用 visdrone_files 的指紋，DB 不能用時退回檔案系統"""
+    if use_db:
+        try:
+            from db_utils import visdrone_files_fingerprint
+
+            return visdrone_files_fingerprint(_split_key(split_dir))
+        except Exception as e:
+            print(f"[CACHE] 無法從 visdrone_files 取得指紋，改用檔案系統：{e}")
+    return _fs_fingerprint(os.path.join(split_dir, "annotations"))
+
+
+def _parse_one(task):
+    """(img_path, ann_path) → (width, height, (N, 8) int32 標註陣列)"""
+    img_path, ann_path = task
+    try:
+        w, h = image_size(img_path)
+    except Exception:
+        w, h = 0, 0
+    rows = parse_annotation(ann_path) if os.path.exists(ann_path) else []
+    return w, h, np.asarray(rows, dtype=np.int32).reshape(-1, 8)
+
+
+def _save_atomic(path, arr):
+    tmp = f"{path}.tmp.npy"
+    np.save(tmp, arr)
+    os.replace(tmp, path)
+
+
+def build_cache(split_dir, cache_dir=None, fingerprint=None, workers=None):
+    """平行解析所有標註，寫出欄位檔 + 檔名字串表 + meta.json（最後寫，代表快取完整）"""
+    t0 = time.perf_counter()
+    cache_dir = Path(cache_dir or Path(split_dir) / CACHE_DIRNAME)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    meta_path = cache_dir / "meta.json"
+    if meta_path.exists():
+        meta_path.unlink()
+
+    img_dir = os.path.join(split_dir, "images")
+    ann_dir = os.path.join(split_dir, "annotations")
+    with os.scandir(img_dir) as it:
+        names = sorted(e.name for e in it if e.is_file() and e.name.lower().endswith(IMAGE_EXTS))
+    tasks = [
+        (os.path.join(img_dir, n), os.path.join(ann_dir, os.path.splitext(n)[0] + ".txt")) for n in names
+    ]
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        parsed = list(pool.map(_parse_one, tasks, chunksize=64))
+
+    counts = np.array([len(a) for _, _, a in parsed], dtype=np.int64)
+    anns = np.concatenate([a for _, _, a in parsed]) if counts.sum() else np.zeros((0, 8), dtype=np.int32)
+    columns = {"img": np.repeat(np.arange(len(names), dtype=np.uint32), counts)}
+    for i, field in enumerate(_ANN_FIELDS):
+        columns[field] = anns[:, i]
+    for field, dtype in COLUMNS.items():
+        _save_atomic(cache_dir / f"{field}.npy", np.ascontiguousarray(columns[field], dtype=dtype))
+
+    # 影像 i 的框是 [img_offsets[i], img_offsets[i + 1])
+    _save_atomic(cache_dir / "img_offsets.npy", np.concatenate([[0], np.cumsum(counts)]).astype(np.int64))
+    _save_atomic(cache_dir / "img_size.npy", np.array([(w, h) for w, h, _ in parsed], dtype=np.int32).reshape(-1, 2))
+
+    # 檔名字串表：utf-8 接在一起 + offsets
+    encoded = [n.encode("utf-8") for n in names]
+    _save_atomic(cache_dir / "names_offsets.npy", np.concatenate([[0], np.cumsum([len(b) for b in encoded])]).astype(np.int64))
+    with open(cache_dir / "names.bin.tmp", "wb") as f:
+        f.write(b"".join(encoded))
+    os.replace(cache_dir / "names.bin.tmp", cache_dir / "names.bin")
+
+    meta = {
+        "version": CACHE_VERSION,
+        "fingerprint": fingerprint,
+        "split_dir": str(split_dir),
+        "n_images": len(names),
+        "n_boxes": int(counts.sum()),
+        "build_seconds": round(time.perf_counter() - t0, 2),
+    }
+    with open(cache_dir / "meta.json.tmp", "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    os.replace(cache_dir / "meta.json.tmp", meta_path)
+    print(f"[CACHE] {os.path.basename(split_dir)}：{meta['n_images']} 張、{meta['n_boxes']} 個框，{meta['build_seconds']}s")
+    return AnnotationCache(cache_dir)
+
+
+class AnnotationCache:
+    """已編譯的標註快取：每個欄位都是唯讀 memmap（boxes 依影像排序）"""
+
+    def __init__(self, cache_dir):
+        self.cache_dir = Path(cache_dir)
+        with open(self.cache_dir / "meta.json", "r", encoding="utf-8") as f:
+            self.meta = json.load(f)
+        self.columns = {field: np.load(self.cache_dir / f"{field}.npy", mmap_mode="r") for field in COLUMNS}
+        self.img_offsets = np.load(self.cache_dir / "img_offsets.npy", mmap_mode="r")
+        self.img_size = np.load(self.cache_dir / "img_size.npy", mmap_mode="r")
+        self._names_offsets = np.load(self.cache_dir / "names_offsets.npy")
+        self._names_blob = None
+
+    def __getattr__(self, name):
+        # cache.cls / cache.w ... 直接取欄位
+        columns = self.__dict__.get("columns", {})
+        if name in columns:
+            return columns[name]
+        raise AttributeError(name)
+
+    @property
+    def n_images(self):
+        return int(self.meta["n_images"])
+
+    def __len__(self):
+        return int(self.meta["n_boxes"])
+
+    def image_name(self, i):
+        if self._names_blob is None:
+            self._names_blob = (self.cache_dir / "names.bin").read_bytes()
+        return self._names_blob[self._names_offsets[i]:self._names_offsets[i + 1]].decode("utf-8")
+
+    def image_names(self):
+        return [self.image_name(i) for i in range(self.n_images)]
+
+    def image_index(self):
+        """檔名 → 影像 index"""
+        return {name: i for i, name in enumerate(self.image_names())}
+
+    def boxes_for_image(self, i):
+        """影像 i 的所有框：{欄位: 陣列}（memmap 的切片，不複製）"""
+        lo, hi = int(self.img_offsets[i]), int(self.img_offsets[i + 1])
+        return {field: col[lo:hi] for field, col in self.columns.items()}
+
+    def valid_mask(self):
+        """真正的物件框：score != 0 且類別 1~10（排除 ignored regions / others）"""
+        cls = self.columns["cls"]
+        return (self.columns["score"] != 0) & (cls >= 1) & (cls <= 10)
+
+    def class_histogram(self, valid_only=False):
+        """VisDrone 原始類別 0~11 各有幾個框"""
+        cls = self.columns["cls"]
+        if valid_only:
+            cls = cls[self.valid_mask()]
+        return np.bincount(cls, minlength=len(VISDRONE_NAMES))
+
+    def per_image_counts(self, cls=None, valid_only=True):
+        """每張影像的框數（可指定單一或多個原始類別）"""
+        mask = self.valid_mask() if valid_only else np.ones(len(self), dtype=bool)
+        if cls is not None:
+            mask &= np.isin(self.columns["cls"], np.atleast_1d(cls))
+        return np.bincount(self.columns["img"][mask], minlength=self.n_images)
+
+    def box_size_histogram(self, bins=(0, 8, 16, 32, 64, 96, 128, 256, 512, 4096), by_class=True, valid_only=True):
+        """
+        框大小（sqrt(w * h)，pixel）的分布。
+        by_class=True 回傳 (len(VISDRONE_NAMES), len(bins) - 1) 的計數，否則一維。
+        """
+        mask = self.valid_mask() if valid_only else np.ones(len(self), dtype=bool)
+        w = self.columns["w"][mask].astype(np.float64)
+        h = self.columns["h"][mask].astype(np.float64)
+        size = np.sqrt(np.clip(w * h, 0, None))
+        bins = np.asarray(bins, dtype=np.float64)
+        bin_idx = np.clip(np.searchsorted(bins, size, side="right") - 1, 0, len(bins) - 2)
+        if not by_class:
+            return np.bincount(bin_idx, minlength=len(bins) - 1)
+        cls = self.columns["cls"][mask].astype(np.int64)
+        flat = cls * (len(bins) - 1) + bin_idx
+        return np.bincount(flat, minlength=len(VISDRONE_NAMES) * (len(bins) - 1)).reshape(len(VISDRONE_NAMES), -1)
+
+    def size_summary(self, valid_only=True):
+        """每個類別的框數、寬高中位數、小物件（< 32x32）比例"""
+        mask = self.valid_mask() if valid_only else np.ones(len(self), dtype=bool)
+        cls = self.columns["cls"][mask]
+        w = self.columns["w"][mask]
+        h = self.columns["h"][mask]
+        out = {}
+        for c in np.unique(cls):
+            sel = cls == c
+            area = w[sel].astype(np.int64) * h[sel]
+            out[VISDRONE_NAMES[c]] = {
+                "count": int(sel.sum()),
+                "median_w": float(np.median(w[sel])),
+                "median_h": float(np.median(h[sel])),
+                "small_ratio": float((area < 32 * 32).mean()),
+            }
+        return out
+
+
+def load_or_build(split_dir, cache_dir=None, use_db=True, workers=None, force=False):
+    """快取存在且指紋相同就直接 memmap 載入，否則重建"""
+    cache_dir = Path(cache_dir or Path(split_dir) / CACHE_DIRNAME)
+    fingerprint = dataset_fingerprint(split_dir, use_db=use_db)
+    meta_path = cache_dir / "meta.json"
+    if not force and meta_path.exists():
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("version") == CACHE_VERSION and meta.get("fingerprint") == fingerprint:
+            return AnnotationCache(cache_dir)
+        print(f"[CACHE] {os.path.basename(os.path.normpath(split_dir))} 的標註有變動，重新建立快取")
+    return build_cache(split_dir, cache_dir=cache_dir, fingerprint=fingerprint, workers=workers)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="建立 VisDrone 標註的二進位快取並印出統計")
+    parser.add_argument("--root", default=None, help="資料集根目錄（預設讀 config/visdrone.yaml 的 path）")
+    parser.add_argument("--splits", nargs="+", default=list(DEFAULT_SPLITS))
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--no-db", action="store_true", help="不查 visdrone_files，直接用檔案系統判斷有沒有變")
+    parser.add_argument("--force", action="store_true", help="強制重建")
+    args = parser.parse_args()
+
+    root = args.root or default_data_root()
+    for split in args.splits:
+        t0 = time.perf_counter()
+        cache = load_or_build(os.path.join(root, split), use_db=not args.no_db, workers=args.workers, force=args.force)
+        hist = cache.class_histogram()
+        per_image = cache.per_image_counts()
+        elapsed = (time.perf_counter() - t0) * 1000
+        print(f"\n=== {split}：{cache.n_images} 張影像、{len(cache)} 個框（{elapsed:.0f} ms）===")
+        for name, n in zip(VISDRONE_NAMES, hist):
+            print(f"  {name:<16}{n:>8}")
+        print(f"  每張影像框數：平均 {per_image.mean():.1f}、中位數 {np.median(per_image):.0f}、最多 {per_image.max()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,10 +2,53 @@
 # & "C:/Users/Sandy/AppData/Local/Programs/Python/Python311/python.exe" -m streamlit run app.py
 
 import io
+import os
+import queue
+import time
 import pandas as pd
 import streamlit as st
 from PIL import Image
-from backend import CLASS_MAP, run_inference, save_raw_image, safe_log
+from backend import (
+    CLASS_MAP,
+    DISPLAY_MAX_SIDE,
+    INFER_BATCH_SIZE,
+    encode_jpeg,
+    image_digest,
+    open_reduced,
+    render_detections,
+    run_inference_batch,
+    save_detections,
+    save_raw_image,
+    safe_log,
+    shrink,
+)
+from infer_server import InferenceServer
+from metrics import REGISTRY, span, start_exporters, trace
+
+# 1 = 推論交給 infer_server 的 worker process（多人同時用不會互卡），0 = 在 Streamlit 執行緒裡直接跑
+USE_INFER_SERVER = os.getenv("VISDRONE_INFER_SERVER", "1") == "1"
+# 模型一律用這個 conf 跑，slider 只是在結果上再過濾（所以 slider 的下限就是它）
+FLOOR_CONF = 0.1
+# 結果影像一頁幾張（只畫目前這頁，影像再多記憶體也不會跟著長）
+GALLERY_PAGE_SIZE = int(os.getenv("VISDRONE_GALLERY_PAGE_SIZE", "12"))
+
+
+@st.cache_resource
+def get_infer_server():
+    """整個 Streamlit 程序共用一個推論伺服器（所有 session、每次 rerun 都是同一個）"""
+    server = InferenceServer()
+    REGISTRY.register_gauge("visdrone_infer_queue_depth", server.queue_depth, "推論佇列裡還沒送進 worker 的影像數")
+    return server
+
+
+@st.cache_resource
+def start_metrics():
+    """各階段耗時的 Prometheus 端點 + 定期寫進 metrics 表，整個程序只開一次"""
+    start_exporters()
+    return True
+
+
+start_metrics()
 
 # ================== Streamlit Page Config ==================
 st.set_page_config(
@@ -171,8 +214,8 @@ with left:
     )
 
     if uploaded_files:
-        first_bytes = uploaded_files[0].getvalue()
-        first_img = Image.open(io.BytesIO(first_bytes)).convert("RGB")
+        # 預覽只解碼到顯示大小（JPEG 用 draft 模式），不做全尺寸解碼
+        first_img, _ = open_reduced(uploaded_files[0].getvalue())
         st.markdown('<div class="img-frame">', unsafe_allow_html=True)
         st.image(first_img, caption=f"預覽：{uploaded_files[0].name}", use_container_width=True)
         st.markdown("</div>", unsafe_allow_html=True)
@@ -199,14 +242,18 @@ with right:
         selected_ids = [cid for cid, name in CLASS_MAP.items() if name in selected_names]
     else:
         selected_ids = []
+    classes_ids = None if len(selected_ids) == 0 else selected_ids
 
     st.markdown('<div class="param-label">輸入影像尺寸 (imgsz)</div>', unsafe_allow_html=True)
     imgsz = st.slider("imgsz", 320, 1280, 640, 160, label_visibility="collapsed")
     st.caption("送進模型前會 resize 到這個大小。")
 
+    tiled = st.checkbox("切塊推論（高解析度小物件）", value=False)
+    st.caption("大圖切成重疊的 tile 各自推論再合併，imgsz 變成每塊的大小；先低解析度掃過，沒東西的 tile 會跳過。")
+
     st.markdown('<div class="param-label">信心閾值 (conf)</div>', unsafe_allow_html=True)
-    conf = st.slider("conf", 0.1, 0.9, 0.25, 0.05, label_visibility="collapsed")
-    st.caption("只保留置信度 ≥ conf 的框。")
+    conf = st.slider("conf", FLOOR_CONF, 0.9, 0.25, 0.05, label_visibility="collapsed")
+    st.caption("只保留置信度 ≥ conf 的框。調整 conf / 類別不會重跑模型。")
 
     st.markdown("</div>", unsafe_allow_html=True)
 
@@ -228,65 +275,240 @@ with prog_col:
 # ================== 下方：結果（左圖右表） ==================
 result_col, table_col = st.columns([2, 1])
 
-if run_button and uploaded_files:
-    n_files = len(uploaded_files)
-    safe_log("INFO", "app.py", f"開始偵測，共 {n_files} 張影像")
 
-    all_rows = []
-    results_images = []
+def upload_digest(f):
+    """
+    上傳檔 bytes 的 image_digest，算過就記在 session_state（以 file_id 為 key，舊版 streamlit 用檔名 + 大小），
+    調 conf / 類別的每次 rerun 不用把整批上傳重新 SHA-256 一遍。
+    """
+    key = getattr(f, "file_id", None) or (f.name, f.size)
+    digests = st.session_state.setdefault("upload_digests", {})
+    if key not in digests:
+        digests[key] = image_digest(f.getvalue())
+    return digests[key]
+
+
+# 模型只在 (這組上傳, imgsz, 切塊) 變了才重跑：用最低的 conf、不過濾類別跑一次，
+# 完整結果放在 session_state，之後調 conf / 類別只是在記憶體裡重新過濾、重畫。
+if uploaded_files:
+    upload_digests = [upload_digest(f) for f in uploaded_files]
+    results_key = (tuple(zip((f.name for f in uploaded_files), upload_digests)), imgsz, tiled)
+else:
+    upload_digests, results_key = [], None
+cached_results = st.session_state.get("results")
+# 按過一次之後，換 imgsz / 換上傳的影像會自動重跑，不用再按按鈕
+needs_run = bool(uploaded_files) and (run_button or cached_results is not None) and (
+    cached_results is None or cached_results["key"] != results_key
+)
 
-    progress_text.markdown("⏱️ 正在處理影像…")
-    progress_bar.progress(0.0)
 
-    classes_ids = None if len(selected_ids) == 0 else selected_ids
+def show_grid(tiles):
+    """tiles = [(檔名, 畫好框的影像), ...]，兩欄排列"""
+    for i in range(0, len(tiles), 2):
+        cols = st.columns(2)
+        for col, (name, img_pred) in zip(cols, tiles[i:i + 2]):
+            with col:
+                st.markdown('<div class="img-frame">', unsafe_allow_html=True)
+                st.image(img_pred, caption=name, use_container_width=True, output_format="JPEG")
+                st.markdown("</div>", unsafe_allow_html=True)
+
+
+def render_item(item, conf, classes):
+    """session 裡的一筆結果（縮圖 JPEG + 原尺寸座標的框）→ 依目前 conf / 類別畫好的縮圖"""
+    _, display_jpeg, scale, det = item
+    display = Image.open(io.BytesIO(display_jpeg))
+    return render_detections(display, det.filter(conf, classes), scale=scale)
+
+
+if needs_run:
+    n_files = len(uploaded_files)
+    safe_log("INFO", "app.py", f"開始偵測，共 {n_files} 張影像")
 
-    for idx, f in enumerate(uploaded_files):
-        # 讀取上傳的原始 bytes
-        img_bytes = f.getvalue()
-        img = Image.open(io.BytesIO(img_bytes)).convert("RGB")
-        width, height = img.size
-        content_type = getattr(f, "type", None) or "image/jpeg"
-
-        # === 後端：把原始圖片寫進 raw_images（非結構化資料塞 DB） ===
-        image_id = save_raw_image(
-            img_bytes=img_bytes,
-            filename=f.name,
-            content_type=content_type,
-            width=width,
-            height=height,
-        )
-
-        # 後端：YOLO 偵測
-        plotted_img, df_boxes = run_inference(img, imgsz, conf, f.name, classes_ids)
-
-        # 前端：整理顯示用資料
-        results_images.append((f.name, plotted_img))
-        if not df_boxes.empty:
-            # 這裡你之後要接 detections table，也可以把 image_id 加進 df_boxes
-            all_rows.append(df_boxes)
-
-        pct = int((idx + 1) / n_files * 100)
-        progress_bar.progress((idx + 1) / n_files)
-        progress_text.markdown(f"✅ 已完成 {idx + 1}/{n_files} 張影像（{pct}%）")
-
-    safe_log("INFO", "app.py", "偵測流程完成")
-
-    # 左邊：所有偵測影像
+    # 每張只留縮圖 JPEG 和框的陣列：[(檔名, 縮圖 JPEG, 縮圖寬 / 原圖寬, 未過濾的 Detections)]，
+    # 跟 uploaded_files 同順序，偵測失敗的是 None
+    items = [None] * n_files
+    live_tiles = []  # 第一頁先邊跑邊顯示
+    with result_col:
+        live = st.empty()
+
+    # 已經存進 DB 的上傳（以 digest 為 key）：換 imgsz / 切塊自動重跑時，
+    # raw_images 沿用第一次的那筆，偵測結果也不再 COPY 一份重複的進 detections
+    saved_images = st.session_state.setdefault("saved_images", {})
+    saved_detections = st.session_state.setdefault("saved_detections", set())
+
+    # 這次請求每個階段的耗時（也會累積進 metrics 的 histogram）
+    with trace() as req:
+        progress_text.markdown("⏱️ 正在處理影像…")
+        progress_bar.progress(0.0)
+
+        def read_upload(f, digest, full=False):
+            """
+            讀取上傳檔並解碼一次，把原始圖片排進 raw_images（非結構化資料塞 DB，同一個 digest 只存一次）。
+            full=True 才解碼成全尺寸（要在這個程序跑模型時），否則只解碼到顯示大小。
+            回傳 (bytes, 全尺寸影像或 None, 顯示用縮圖 JPEG, 縮圖寬 / 原圖寬, raw_images 的 Future)
+            """
+            with span("read"):
+                img_bytes = f.getvalue()
+            with span("decode"):
+                if full:
+                    img = Image.open(io.BytesIO(img_bytes)).convert("RGB")
+                    size = img.size
+                    display = shrink(img, (DISPLAY_MAX_SIDE, DISPLAY_MAX_SIDE))
+                else:
+                    img = None
+                    display, size = open_reduced(img_bytes)
+            image_future = saved_images.get(digest)
+            if image_future is None:
+                content_type = getattr(f, "type", None) or "image/jpeg"
+                with span("save_raw_image"):
+                    image_future = saved_images[digest] = save_raw_image(
+                        img_bytes=img_bytes,
+                        filename=f.name,
+                        content_type=content_type,
+                        width=size[0],
+                        height=size[1],
+                        img=display,  # 縮圖從顯示用的影像再縮，不用碰全尺寸
+                    )
+            return img_bytes, img, encode_jpeg(display), display.width / size[0], image_future
+
+        def collect(idx, f, display_jpeg, scale, det, image_future):
+            items[idx] = (f.name, display_jpeg, scale, det)
+            if idx < GALLERY_PAGE_SIZE:
+                live_tiles.append((f.name, render_item(items[idx], conf, classes_ids)))
+                with live.container():
+                    show_grid(live_tiles)
+            # 後端：raw_images 拿到 image_id 後，偵測結果（FLOOR_CONF 以上、全部類別）COPY 進 detections，
+            # 同一張上傳只存第一次的結果
+            digest = upload_digests[idx]
+            if image_future is not None and digest not in saved_detections:
+                saved_detections.add(digest)
+                if len(det):
+                    save_detections(det, image_future)
+
+        if USE_INFER_SERVER:
+            # 送進推論伺服器（worker process 跑模型，自己解碼原始 bytes），這裡只輪詢進度
+            uploads = [read_upload(f, d) for f, d in zip(uploaded_files, upload_digests)]
+            server = get_infer_server()
+            try:
+                job = server.submit(
+                    [img_bytes for img_bytes, *_ in uploads],
+                    [f.name for f in uploaded_files],
+                    imgsz=imgsz,
+                    conf=FLOOR_CONF,
+                    classes=None,
+                    tiled=tiled,
+                    # 少量上傳優先，大批上傳的人不會擋住只傳幾張的人
+                    priority=0 if n_files <= INFER_BATCH_SIZE else 1,
+                    digests=upload_digests,
+                    timeout=10,
+                )
+            except queue.Full:
+                progress_text.markdown("⚠️ 目前排隊的影像太多，請稍後再試。")
+                safe_log("WARN", "app.py", f"推論佇列已滿，拒收 {n_files} 張影像")
+                st.stop()
+
+            # 哪張先跑完就先收，不用等整批
+            waiting = list(range(n_files))
+            while waiting:
+                still_waiting = []
+                for idx in waiting:
+                    fut = job.futures[idx]
+                    if not fut.done():
+                        still_waiting.append(idx)
+                        continue
+                    f = uploaded_files[idx]
+                    _, _, display_jpeg, scale, image_future = uploads[idx]
+                    try:
+                        det = fut.result()
+                    except Exception as e:
+                        st.error(f"{f.name} 偵測失敗：{e}")
+                        safe_log("ERROR", "app.py", f"偵測失敗 file={f.name}", detail=str(e))
+                        continue
+                    collect(idx, f, display_jpeg, scale, det, image_future)
+                waiting = still_waiting
+                done, total = job.progress()
+                progress_bar.progress(done / total)
+                progress_text.markdown(
+                    f"⏱️ 已完成 {done}/{total} 張影像（{int(done / total * 100)}%）· 排隊中 {server.queue_depth()} 張"
+                )
+                if waiting:
+                    time.sleep(0.2)
+            req.extend(job.spans)  # worker 那邊的解碼 / 前處理 / forward…
+        else:
+            for start in range(0, n_files, INFER_BATCH_SIZE):
+                # 全尺寸影像只活在這一批裡
+                batch_files = uploaded_files[start:start + INFER_BATCH_SIZE]
+                batch_digests = upload_digests[start:start + INFER_BATCH_SIZE]
+                uploads = [read_upload(f, d, full=True) for f, d in zip(batch_files, batch_digests)]
+
+                # 後端：YOLO 偵測（整批一次 forward）
+                batch_outputs = run_inference_batch(
+                    [img for _, img, *_ in uploads],
+                    imgsz,
+                    FLOOR_CONF,
+                    None,
+                    filenames=[f.name for f in batch_files],
+                    digests=batch_digests,
+                    tiled=tiled,
+                )
+                for k, (f, det, (_, _, display_jpeg, scale, image_future)) in enumerate(
+                    zip(batch_files, batch_outputs, uploads)
+                ):
+                    collect(start + k, f, display_jpeg, scale, det, image_future)
+
+                done = start + len(batch_files)
+                pct = int(done / n_files * 100)
+                progress_bar.progress(done / n_files)
+                progress_text.markdown(f"✅ 已完成 {done}/{n_files} 張影像（{pct}%）")
+            del uploads, batch_outputs
+
+    live.empty()
+    st.session_state["results"] = cached_results = {
+        "key": results_key,
+        "items": items,
+        "elapsed": req.elapsed,
+    }
+    safe_log("INFO", "app.py", f"偵測流程完成（{req.elapsed:.2f}s）", detail=req.summary())
+
+if cached_results is not None and cached_results["key"] == results_key:
+    # 依目前的 conf / 類別過濾（不碰模型也不碰 DB）
+    # (在 uploaded_files 裡的位置, 結果)
+    result_items = [(idx, item) for idx, item in enumerate(cached_results["items"]) if item is not None]
+    filtered = {idx: det.filter(conf, classes_ids) for idx, (_, _, _, det) in result_items}
+    n_boxes = sum(len(det) for det in filtered.values())
+    progress_bar.progress(1.0)
+    progress_text.markdown(
+        f"✅ 已完成 {len(result_items)} 張影像 · 偵測耗時 {cached_results['elapsed']:.1f}s · "
+        f"conf ≥ {conf:.2f} 共 {n_boxes} 個框"
+    )
+
+    # 左邊：偵測影像（分頁，只畫這一頁）
     with result_col:
         st.markdown('<div class="card">', unsafe_allow_html=True)
-        st.markdown('<div class="card-title">📸 偵測結果影像（全部）</div>', unsafe_allow_html=True)
-
-        if results_images:
-            for i in range(0, len(results_images), 2):
-                cols = st.columns(2)
-                for j in range(2):
-                    idx2 = i + j
-                    if idx2 < len(results_images):
-                        name, img_pred = results_images[idx2]
-                        with cols[j]:
-                            st.markdown('<div class="img-frame">', unsafe_allow_html=True)
-                            st.image(img_pred, caption=name, use_container_width=True)
-                            st.markdown("</div>", unsafe_allow_html=True)
+        st.markdown('<div class="card-title">📸 偵測結果影像</div>', unsafe_allow_html=True)
+
+        if result_items:
+            n_pages = (len(result_items) + GALLERY_PAGE_SIZE - 1) // GALLERY_PAGE_SIZE
+            page = 1
+            if n_pages > 1:
+                page = st.number_input(f"頁數（共 {n_pages} 頁）", 1, n_pages, 1, 1)
+            page_items = result_items[(page - 1) * GALLERY_PAGE_SIZE:page * GALLERY_PAGE_SIZE]
+            show_grid([(item[0], render_item(item, conf, classes_ids)) for _, item in page_items])
+
+            # 原尺寸只在使用者點選時才從上傳的 bytes 解碼、畫框
+            pick = st.selectbox(
+                "檢視原尺寸",
+                [None] + [idx for idx, _ in result_items],
+                format_func=lambda idx: "（不顯示）" if idx is None else uploaded_files[idx].name,
+            )
+            if pick is not None:
+                full = Image.open(io.BytesIO(uploaded_files[pick].getvalue())).convert("RGB")
+                st.image(
+                    render_detections(full, filtered[pick]),
+                    caption=f"{uploaded_files[pick].name}（原尺寸）",
+                    output_format="JPEG",
+                )
+                del full
         else:
             st.write("沒有任何影像產生偵測結果。")
 
@@ -297,8 +519,10 @@ if run_button and uploaded_files:
         st.markdown('<div class="card">', unsafe_allow_html=True)
         st.markdown('<div class="card-title">📊 Bounding Boxes（所有影像彙整）</div>', unsafe_allow_html=True)
 
+        all_rows = [det.to_dataframe() for det in filtered.values() if len(det)]
         if all_rows:
-            df_all = pd.concat(all_rows, ignore_index=True)
+            with span("dataframe"):
+                df_all = pd.concat(all_rows, ignore_index=True)
             st.dataframe(df_all, hide_index=True, use_container_width=True)
 
             csv_buf = io.StringIO()
@@ -1,45 +1,66 @@
 # ui_playground/backend.py
+import hashlib
+import io
 import os
+import shutil
 import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
 from pathlib import Path
 from functools import lru_cache
+from typing import Optional
 
 import numpy as np
 import pandas as pd
 from PIL import Image
 from ultralytics import YOLO
 
+from georef import georeference_boxes
+from metrics import muted, observe, span
+
 # ========= 路徑與 PostgreSQL 工具 =========
 PROJECT_ROOT = Path(__file__).resolve().parents[1]
 POSTGRESQL_DIR = PROJECT_ROOT / "PostgreSQL"
 sys.path.append(str(POSTGRESQL_DIR))
 
 try:
-    from db_utils import insert_raw_image, write_log
+    from db_utils import copy_detections, insert_raw_image_async, write_log_async
 except ImportError:
-    insert_raw_image = None
-    write_log = None
+    copy_detections = None
+    insert_raw_image_async = None
+    write_log_async = None
 
 
 def safe_log(level, source, message, run_id=None, detail=None):
-    """寫 log 進 DB，失敗就只印在 console，不讓整個 app 掛掉。"""
-    if write_log is None:
+    """
+    寫 log 進 DB，失敗就只印在 console，不讓整個 app 掛掉。
+    實際寫入由 db_utils 的背景寫入器批次處理，這裡不會等 PostgreSQL。
+    """
+    if write_log_async is None:
         return
     try:
-        write_log(level, source, message, run_id, detail)
+        write_log_async(level, source, message, run_id, detail)
     except Exception as e:
         print(f"[LOG ERROR] {e}")
 
 
 # ========= YOLO 權重與類別 =========
 MODELS_DIR = PROJECT_ROOT / "models"
-if (MODELS_DIR / "best.pt").exists():
+if os.getenv("VISDRONE_WEIGHTS"):  # 明確指定權重（測速 / 比較不同權重時用）
+    WEIGHTS_PATH = Path(os.environ["VISDRONE_WEIGHTS"])
+elif (MODELS_DIR / "best.pt").exists():
     WEIGHTS_PATH = MODELS_DIR / "best.pt"
 elif (MODELS_DIR / "yolov8n.pt").exists():
     WEIGHTS_PATH = MODELS_DIR / "yolov8n.pt"
 else:
     WEIGHTS_PATH = PROJECT_ROOT / "ui_playground" / "yolov8n.pt"
 
+# 目前權重對應的 train_runs.id（寫 detections 時用，沒設就留 NULL）
+MODEL_RUN_ID = int(os.environ["VISDRONE_RUN_ID"]) if os.getenv("VISDRONE_RUN_ID") else None
+
 # 強制用 CPU，避免本機 CUDA 相容問題（要用 GPU 再把這行拿掉）
 os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
 
@@ -57,29 +78,216 @@ CLASS_MAP = {
     9: "motor",  
 }
 
-def save_raw_image(img_bytes, filename, content_type, width, height):
+# CLASS_MAP 的向量化查表版本：cls id 直接當 index 取 label
+_LABEL_LUT = np.array([CLASS_MAP.get(i, str(i)) for i in range(max(CLASS_MAP) + 1)], dtype=object)
+
+
+def lookup_labels(cls_ids):
+    """把整個 cls id 陣列一次轉成 label（不在 CLASS_MAP 裡的就用數字字串）"""
+    cls_ids = np.asarray(cls_ids, dtype=np.int64)
+    known = (cls_ids >= 0) & (cls_ids < len(_LABEL_LUT))
+    labels = _LABEL_LUT[np.where(known, cls_ids, 0)]
+    if not known.all():
+        labels = labels.copy()
+        labels[~known] = cls_ids[~known].astype(str)
+    return labels
+
+
+@dataclass
+class Detections:
+    """
+    單張影像的偵測結果（struct-of-arrays）：
+    xyxy (N, 4) float32、conf (N,) float32、cls (N,) int16，
+    需要表格時再呼叫 to_dataframe()。
+    """
+
+    file: str
+    xyxy: np.ndarray = field(default_factory=lambda: np.zeros((0, 4), dtype=np.float32))
+    conf: np.ndarray = field(default_factory=lambda: np.zeros(0, dtype=np.float32))
+    cls: np.ndarray = field(default_factory=lambda: np.zeros(0, dtype=np.int16))
+    plotted: Optional[Image.Image] = None
+    lonlat: Optional[np.ndarray] = None  # (N, 2) 框中心的 [lon, lat]，有做 georef 才有
+
+    def __len__(self):
+        return len(self.conf)
+
+    @property
+    def labels(self):
+        return lookup_labels(self.cls)
+
+    def filter(self, conf=None, classes=None):
+        """依 conf 下限與類別（None = 全部）過濾，回傳新的 Detections，不用重跑模型"""
+        mask = np.ones(len(self), dtype=bool)
+        if conf is not None:
+            mask &= self.conf >= conf
+        if classes is not None:
+            mask &= np.isin(self.cls, np.asarray(list(classes), dtype=np.int16))
+        return Detections(
+            file=self.file,
+            xyxy=self.xyxy[mask],
+            conf=self.conf[mask],
+            cls=self.cls[mask],
+            lonlat=None if self.lonlat is None else self.lonlat[mask],
+        )
+
+    def to_dataframe(self):
+        """轉成跟以前 run_inference 一樣欄位的 DataFrame（有經緯度時多 lon, lat 兩欄）"""
+        with span("dataframe"):
+            return self._build_dataframe()
+
+    def _build_dataframe(self):
+        df = pd.DataFrame(
+            {
+                "file": np.full(len(self), self.file, dtype=object),
+                "cls": self.cls.astype(np.int64),
+                "label": self.labels,
+                "conf": self.conf.astype(np.float64),
+                "xmin": self.xyxy[:, 0].astype(np.float64),
+                "ymin": self.xyxy[:, 1].astype(np.float64),
+                "xmax": self.xyxy[:, 2].astype(np.float64),
+                "ymax": self.xyxy[:, 3].astype(np.float64),
+            }
+        )
+        if self.lonlat is not None:
+            df["lon"] = self.lonlat[:, 0]
+            df["lat"] = self.lonlat[:, 1]
+        return df
+
+THUMBNAIL_SIZE = (256, 256)
+
+
+# 前端顯示用的縮圖最長邊（pixel），原圖只在使用者要看原尺寸時才解碼
+DISPLAY_MAX_SIDE = int(os.getenv("VISDRONE_DISPLAY_MAX_SIDE", "960"))
+
+
+def shrink(img: Image.Image, size) -> Image.Image:
+    """縮到 size 以內的新影像（原圖不動）"""
+    # 先用 reduce 做整數倍縮小，不用為了縮圖複製一份全尺寸影像
+    factor = max(1, min(img.width // size[0], img.height // size[1]) // 2)
+    out = img.reduce(factor) if factor > 1 else img.copy()
+    out.thumbnail(size)
+    return out
+
+
+def encode_jpeg(img: Image.Image, quality=85) -> bytes:
+    buf = io.BytesIO()
+    img.convert("RGB").save(buf, format="JPEG", quality=quality)
+    return buf.getvalue()
+
+
+def open_reduced(img_bytes, max_side=DISPLAY_MAX_SIDE):
     """
-    將一張原始圖片寫進 raw_images 表，回傳 image_id。
-    若沒有 db_utils 或發生錯誤，回傳 None。
+    只解碼到顯示需要的大小，回傳 (RGB 影像, 原圖 (寬, 高))。
+    JPEG 用 draft 模式在解碼時就縮 1/2、1/4、1/8，不會先產生全尺寸影像；其他格式解碼後再縮。
+    """
+    img = Image.open(io.BytesIO(img_bytes))
+    size = img.size
+    img.draft("RGB", (max_side, max_side))
+    img = img.convert("RGB")
+    img.thumbnail((max_side, max_side))
+    return img, size
+
+
+def make_thumbnail(img: Image.Image, size=THUMBNAIL_SIZE) -> bytes:
+    """把已解碼的影像縮成小 JPEG（存進 image_blobs.thumbnail）"""
+    return encode_jpeg(shrink(img, size), quality=80)
+
+
+def save_raw_image(img_bytes, filename, content_type, width, height, img: Optional[Image.Image] = None):
     """
-    if insert_raw_image is None:
+    將一張原始圖片排進 raw_images 的背景寫入佇列，回傳 Future（.result() 為 image_id）。
+    同內容的圖片在 DB 只存一份；有傳 img（已解碼的影像）就順便存縮圖。
+    若沒有 db_utils 或佇列已滿，回傳 None。呼叫端不會被 DB 卡住。
+    """
+    if insert_raw_image_async is None:
         print("[DB] insert_raw_image 未匯入，略過 raw_images 寫入。")
         return None
 
     try:
-        image_id = insert_raw_image(
+        fut = insert_raw_image_async(
             img_bytes=img_bytes,
             filename=filename,
             content_type=content_type,
             width=width,
             height=height,
+            thumbnail=make_thumbnail(img) if img is not None else None,
         )
-        safe_log("INFO", "backend.py", f"raw_images 寫入成功 image_id={image_id}, file={filename}")
-        return image_id
     except Exception as e:
         print(f"[DB] 寫入 raw_images 失敗：{e}")
         safe_log("ERROR", "backend.py", f"raw_images 寫入失敗 file={filename}", detail=str(e))
         return None
+    if fut is None:
+        safe_log("WARN", "backend.py", f"raw_images 寫入佇列已滿，略過 file={filename}")
+        return None
+
+    def _on_done(f):
+        exc = f.exception()
+        if exc is None:
+            safe_log("INFO", "backend.py", f"raw_images 寫入成功 image_id={f.result()}, file={filename}")
+        else:
+            print(f"[DB] 寫入 raw_images 失敗：{exc}")
+            safe_log("ERROR", "backend.py", f"raw_images 寫入失敗 file={filename}", detail=str(exc))
+
+    fut.add_done_callback(_on_done)
+    return fut
+
+
+def detections_table(dets, raw_image_ids=None, run_id=MODEL_RUN_ID):
+    """
+    把多張影像的 Detections 接成一個 detections 表格式的 DataFrame
+    （欄位：raw_image_id, run_id, image, cls, score, x1, y1, x2, y2），整段都是陣列運算。
+    """
+    dets = list(dets)
+    counts = np.array([len(d) for d in dets], dtype=np.int64)
+    total = int(counts.sum())
+    xyxy = np.concatenate([d.xyxy for d in dets]) if total else np.zeros((0, 4), dtype=np.float32)
+    table = pd.DataFrame(
+        {
+            "image": np.repeat(np.array([d.file for d in dets], dtype=object), counts),
+            "cls": np.concatenate([d.cls for d in dets]) if total else np.zeros(0, dtype=np.int16),
+            "score": np.concatenate([d.conf for d in dets]) if total else np.zeros(0, dtype=np.float32),
+            "x1": xyxy[:, 0],
+            "y1": xyxy[:, 1],
+            "x2": xyxy[:, 2],
+            "y2": xyxy[:, 3],
+        }
+    )
+    if raw_image_ids is not None:
+        table.insert(0, "raw_image_id", pd.array(np.repeat(np.array(raw_image_ids, dtype=object), counts), dtype="Int64"))
+    table.insert(0, "run_id", pd.array([run_id] * total, dtype="Int64"))
+    if dets and all(d.lonlat is not None for d in dets):
+        lonlat = np.concatenate([d.lonlat for d in dets]) if total else np.zeros((0, 2))
+        table["xc"] = (table["x1"] + table["x2"]) / 2.0
+        table["yc"] = (table["y1"] + table["y2"]) / 2.0
+        table["lon"] = lonlat[:, 0]
+        table["lat"] = lonlat[:, 1]
+    return table
+
+
+def save_detections(det: Detections, image_future=None):
+    """
+    把一張影像的偵測結果 COPY 進 detections。
+    有 raw_images 的 Future 時，等 image_id 出來（在背景寫入執行緒）才寫，不會卡住呼叫端。
+    """
+    if copy_detections is None or not len(det):
+        return
+
+    def _copy(image_id):
+        try:
+            copy_detections(detections_table([det], raw_image_ids=[image_id]))
+        except Exception as e:
+            print(f"[DB] 寫入 detections 失敗：{e}")
+            safe_log("ERROR", "backend.py", f"detections 寫入失敗 file={det.file}", detail=str(e))
+
+    if image_future is None:
+        _copy(None)
+        return
+
+    def _on_image_saved(f):
+        if f.exception() is None:
+            _copy(f.result())
+
+    image_future.add_done_callback(_on_image_saved)
 
 
 @lru_cache(maxsize=1)
@@ -89,44 +297,772 @@ def load_model():
     return YOLO(str(WEIGHTS_PATH))
 
 
-def run_inference(img: Image.Image, imgsz: int, conf: float, filename: str, classes_ids):
+# 推論引擎：torch = ultralytics PyTorch（預設）、onnx = 匯出 ONNX 後用 onnxruntime 跑、
+# onnx-int8 = INT8 量化後的 ONNX（見 quantize_model.py）
+INFER_ENGINE = os.getenv("VISDRONE_ENGINE", "torch").lower()
+# 每個推論呼叫用的 CPU 執行緒數（0 = 交給 runtime 決定，通常是實體核心數）
+INFER_THREADS = int(os.getenv("VISDRONE_INFER_THREADS", "0"))
+WARMUP_IMGSZ = int(os.getenv("VISDRONE_WARMUP_IMGSZ", "640"))
+
+
+# 一次送進模型的影像張數（CPU 上 batch 太大反而會吃光記憶體）
+INFER_BATCH_SIZE = int(os.getenv("VISDRONE_INFER_BATCH", "8"))
+
+
+def _iter_batches(items, batch_size):
+    """把序列切成固定大小的批次（最後一批可能比較小）"""
+    for start in range(0, len(items), batch_size):
+        yield start, items[start:start + batch_size]
+
+
+def _result_to_detections(r, filename):
+    """把 ultralytics 的單張 Results 一次取成 numpy 陣列（不逐框跑 Python 迴圈）"""
+    det = Detections(file=filename)
+    if r.boxes is not None and len(r.boxes):
+        det.xyxy = r.boxes.xyxy.cpu().numpy().astype(np.float32, copy=False)
+        det.conf = r.boxes.conf.cpu().numpy().astype(np.float32, copy=False)
+        det.cls = r.boxes.cls.cpu().numpy().astype(np.int16)
+    return det
+
+
+def render_detections(img, det: Detections, scale=1.0) -> Image.Image:
+    """
+    只用 Detections 的陣列在影像上畫框，回傳 PIL.Image。
+    不需要 ultralytics 的 Results，所以 cache 命中時也能直接畫。
+    img 是縮小過的顯示用影像時，scale = 顯示寬 / 原圖寬，框座標跟著縮。
+    """
+    from ultralytics.utils.plotting import Annotator, colors
+
+    with span("render"):
+        annotator = Annotator(np.array(img))
+        for xyxy, score, cls_id, label in zip(det.xyxy * scale, det.conf, det.cls, det.labels):
+            annotator.box_label(xyxy.tolist(), f"{label} {score:.2f}", color=colors(int(cls_id), False))
+        return Image.fromarray(annotator.result())
+
+
+# ========= 推論結果快取 =========
+# key = (影像 SHA-256, 權重 SHA-256, imgsz, conf, 類別過濾)
+RESULT_CACHE_MAX_BYTES = int(os.getenv("VISDRONE_RESULT_CACHE_MB", "64")) * 1024 * 1024
+# 設定這個資料夾才會開 disk 層（Streamlit 重開也還在）
+RESULT_CACHE_DIR = os.getenv("VISDRONE_RESULT_CACHE_DIR")
+RESULT_CACHE_DISK_MAX_BYTES = int(os.getenv("VISDRONE_RESULT_CACHE_DISK_MB", "512")) * 1024 * 1024
+
+
+def image_digest(data) -> str:
+    """
+    影像內容的 SHA-256。
+    傳 bytes（上傳檔原始內容）最快；傳 PIL.Image / ndarray 則對像素 + 尺寸做雜湊。
+    """
+    h = hashlib.sha256()
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        h.update(data)
+    else:
+        arr = np.ascontiguousarray(np.asarray(data))
+        h.update(str(arr.shape).encode())
+        h.update(arr.data)
+    return h.hexdigest()
+
+
+@lru_cache(maxsize=None)
+def weights_digest(path=None) -> str:
+    """權重檔的 SHA-256（每個檔案只算一次）"""
+    h = hashlib.sha256()
+    with open(path or WEIGHTS_PATH, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def make_cache_key(img_digest, imgsz, conf, classes, mode=None) -> str:
+    """mode 是推論方式的額外描述（例如切塊參數），一般整張推論不加"""
+    if classes is None:
+        cls_part = "all"
+    else:
+        cls_part = ",".join(str(c) for c in sorted({int(c) for c in classes})) or "none"
+    key = f"{img_digest}|{weights_digest()}|{int(imgsz)}|{float(conf):.4f}|{cls_part}"
+    return f"{key}|{mode}" if mode else key
+
+
+class ResultCache:
+    """
+    兩層的推論結果快取：
+    - 記憶體層：OrderedDict 做 LRU，依陣列總 bytes 淘汰
+    - disk 層（選用）：每個 key 一個 .npz，依檔案總大小淘汰最久沒用到的
+    只存 (xyxy, conf, cls) 陣列，檔名由呼叫端決定。
+    """
+
+    def __init__(self, max_bytes=RESULT_CACHE_MAX_BYTES, disk_dir=RESULT_CACHE_DIR,
+                 disk_max_bytes=RESULT_CACHE_DISK_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.disk_dir = Path(disk_dir) if disk_dir else None
+        self.disk_max_bytes = disk_max_bytes
+        self._mem = OrderedDict()
+        self._mem_bytes = 0
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {"mem_hits": 0, "disk_hits": 0, "misses": 0, "mem_evictions": 0, "disk_evictions": 0}
+        if self.disk_dir is not None:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+            self._disk_bytes = sum(p.stat().st_size for p in self.disk_dir.glob("*/*.npz"))
+
+    def _disk_path(self, key):
+        name = hashlib.sha256(key.encode()).hexdigest()
+        return self.disk_dir / name[:2] / f"{name}.npz"
+
+    def _mem_put(self, key, arrays):
+        size = sum(a.nbytes for a in arrays)
+        if size > self.max_bytes:
+            return
+        old = self._mem.pop(key, None)
+        if old is not None:
+            self._mem_bytes -= sum(a.nbytes for a in old)
+        self._mem[key] = arrays
+        self._mem_bytes += size
+        while self._mem_bytes > self.max_bytes:
+            _, evicted = self._mem.popitem(last=False)
+            self._mem_bytes -= sum(a.nbytes for a in evicted)
+            self.stats["mem_evictions"] += 1
+
+    def get(self, key):
+        """回傳 (xyxy, conf, cls) 或 None"""
+        with self._lock:
+            arrays = self._mem.get(key)
+            if arrays is not None:
+                self._mem.move_to_end(key)
+                self.stats["mem_hits"] += 1
+                return arrays
+
+        if self.disk_dir is not None:
+            path = self._disk_path(key)
+            try:
+                with np.load(path) as npz:
+                    arrays = (npz["xyxy"], npz["conf"], npz["cls"])
+                os.utime(path)  # 更新 mtime 當作最近使用時間
+            except (OSError, KeyError, ValueError):
+                arrays = None
+            if arrays is not None:
+                with self._lock:
+                    self.stats["disk_hits"] += 1
+                    self._mem_put(key, arrays)
+                return arrays
+
+        with self._lock:
+            self.stats["misses"] += 1
+        return None
+
+    def put(self, key, det: Detections, disk=True):
+        """disk=False 只放記憶體層（例如 disk 層已經由別的 process 寫過）"""
+        arrays = (det.xyxy, det.conf, det.cls)
+        with self._lock:
+            self._mem_put(key, arrays)
+        if self.disk_dir is None or not disk:
+            return
+        path = self._disk_path(key)
+        path.parent.mkdir(exist_ok=True)
+        tmp = path.with_name(f"{path.stem}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            with open(tmp, "wb") as f:
+                np.savez(f, xyxy=det.xyxy, conf=det.conf, cls=det.cls)
+            existed = path.exists()
+            old_size = path.stat().st_size if existed else 0
+            os.replace(tmp, path)
+            with self._lock:
+                self._disk_bytes += path.stat().st_size - old_size
+                over = self._disk_bytes > self.disk_max_bytes
+            if over:
+                self._evict_disk()
+        except OSError as e:
+            print(f"[CACHE] 寫入 disk 快取失敗：{e}")
+            tmp.unlink(missing_ok=True)
+
+    def _evict_disk(self):
+        """刪掉最久沒用到的檔案，直到總大小降到上限的 90%"""
+        files = []
+        for p in self.disk_dir.glob("*/*.npz"):
+            try:
+                st = p.stat()
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, p))
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        target = int(self.disk_max_bytes * 0.9)
+        evicted = 0
+        for _, size, p in files:
+            if total <= target:
+                break
+            p.unlink(missing_ok=True)
+            total -= size
+            evicted += 1
+        with self._lock:
+            self._disk_bytes = total
+            self.stats["disk_evictions"] += evicted
+
+    def clear(self):
+        with self._lock:
+            self._mem.clear()
+            self._mem_bytes = 0
+
+
+RESULT_CACHE = ResultCache()
+
+
+def cache_stats():
+    """回傳快取命中/未命中次數與目前大小"""
+    with RESULT_CACHE._lock:
+        stats = dict(RESULT_CACHE.stats)
+        stats["mem_entries"] = len(RESULT_CACHE._mem)
+        stats["mem_bytes"] = RESULT_CACHE._mem_bytes
+        stats["disk_bytes"] = RESULT_CACHE._disk_bytes
+    return stats
+
+
+def _image_size(img):
+    """PIL.Image 或 ndarray 的 (width, height)"""
+    if isinstance(img, Image.Image):
+        return img.size
+    return img.shape[1], img.shape[0]
+
+
+# ========= 推論引擎 =========
+NMS_IOU = 0.7  # 跟 ultralytics predict 的預設 iou 一樣
+MAX_DET = 300
+
+
+def nms_numpy(xyxy, scores, cls_ids, threshold=0.5, metric="iou"):
+    """
+    numpy 的類別分開 NMS，回傳要保留的 index（依分數由高到低）。
+    metric="ios" 用「交集 / 較小框面積」，適合合併被 tile 邊界切掉一半的框。
+    """
+    xyxy = np.asarray(xyxy, dtype=np.float32).reshape(-1, 4)
+    if len(xyxy) == 0:
+        return np.zeros(0, dtype=np.int64)
+    # 不同類別的框平移到互不重疊的位置，一次 NMS 就等於每個類別各做一次
+    offset = np.asarray(cls_ids, dtype=np.float32)[:, None] * (float(xyxy.max()) + 1.0)
+    boxes = xyxy + offset
+    areas = (boxes[:, 2] - boxes[:, 0]).clip(0) * (boxes[:, 3] - boxes[:, 1]).clip(0)
+    order = np.argsort(-np.asarray(scores), kind="stable")
+    keep = []
+    while len(order):
+        i, rest = order[0], order[1:]
+        keep.append(i)
+        if not len(rest):
+            break
+        w = (np.minimum(boxes[i, 2], boxes[rest, 2]) - np.maximum(boxes[i, 0], boxes[rest, 0])).clip(0)
+        h = (np.minimum(boxes[i, 3], boxes[rest, 3]) - np.maximum(boxes[i, 1], boxes[rest, 1])).clip(0)
+        inter = w * h
+        if metric == "ios":
+            overlap = inter / np.maximum(np.minimum(areas[i], areas[rest]), 1e-6)
+        else:
+            overlap = inter / np.maximum(areas[i] + areas[rest] - inter, 1e-6)
+        order = rest[overlap <= threshold]
+    return np.asarray(keep, dtype=np.int64)
+
+
+def letterbox(arr, imgsz):
+    """
+    RGB ndarray → 等比例縮放後置中補灰邊的 imgsz × imgsz（跟 ultralytics 的 LetterBox 一樣），
+    回傳 (影像, 縮放比例, (pad_x, pad_y))。
+    """
+    import cv2
+
+    h, w = arr.shape[:2]
+    r = min(imgsz / h, imgsz / w)
+    new_w, new_h = int(round(w * r)), int(round(h * r))
+    if (new_w, new_h) != (w, h):
+        arr = cv2.resize(arr, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+    pad_x, pad_y = (imgsz - new_w) / 2, (imgsz - new_h) / 2
+    top, left = int(round(pad_y - 0.1)), int(round(pad_x - 0.1))
+    out = np.full((imgsz, imgsz, 3), 114, dtype=np.uint8)
+    out[top:top + new_h, left:left + new_w] = arr
+    return out, r, (left, top)
+
+
+def decode_yolo_output(pred, ratio, pad, orig_size, conf, classes=None, iou=NMS_IOU, max_det=MAX_DET):
+    """
+    YOLOv8 輸出頭 (4 + nc, anchors) → 原圖座標的 (xyxy, conf, cls)。
+    conf 過濾、類別過濾、NMS 都用 numpy 做。
+    """
+    pred = pred.T  # (anchors, 4 + nc)
+    class_scores = pred[:, 4:]
+    cls_ids = class_scores.argmax(axis=1)
+    scores = class_scores[np.arange(len(cls_ids)), cls_ids]
+    mask = scores >= conf
+    if classes is not None:
+        mask &= np.isin(cls_ids, np.asarray(list(classes), dtype=np.int64))
+    boxes, scores, cls_ids = pred[mask, :4], scores[mask], cls_ids[mask]
+
+    xyxy = np.empty_like(boxes)
+    xyxy[:, :2] = boxes[:, :2] - boxes[:, 2:] / 2
+    xyxy[:, 2:] = boxes[:, :2] + boxes[:, 2:] / 2
+    keep = nms_numpy(xyxy, scores, cls_ids, threshold=iou)[:max_det]
+    xyxy, scores, cls_ids = xyxy[keep], scores[keep], cls_ids[keep]
+
+    xyxy[:, [0, 2]] -= pad[0]
+    xyxy[:, [1, 3]] -= pad[1]
+    xyxy /= ratio
+    xyxy[:, [0, 2]] = xyxy[:, [0, 2]].clip(0, orig_size[0])
+    xyxy[:, [1, 3]] = xyxy[:, [1, 3]].clip(0, orig_size[1])
+    return xyxy.astype(np.float32), scores.astype(np.float32), cls_ids.astype(np.int16)
+
+
+class TorchEngine:
+    """ultralytics 的 PyTorch 模型（一定能用的 fallback）"""
+
+    name = "torch"
+
+    def __init__(self, weights=WEIGHTS_PATH, threads=INFER_THREADS):
+        if threads:
+            import torch
+
+            torch.set_num_threads(threads)
+        if Path(weights) == Path(WEIGHTS_PATH):
+            self.model = load_model()
+        else:
+            print(f"[MODEL] loading weights from: {weights}")
+            self.model = YOLO(str(weights))
+
+    def detect(self, arrays, imgsz, conf, classes, filenames):
+        """一批 RGB ndarray → list[Detections]（整批一次 forward）"""
+        results = self.model.predict(
+            # ultralytics 把 ndarray 當 BGR（cv2 慣例），PIL 轉出來的是 RGB，要先反轉通道
+            source=[np.ascontiguousarray(np.asarray(a)[..., ::-1]) for a in arrays],
+            imgsz=imgsz,
+            conf=conf,
+            device="cpu",
+            classes=classes,  # None = 不過濾
+            batch=len(arrays),
+            verbose=False,
+            save=False,
+        )
+        # predict 內部已經分段計時（每張圖的平均 ms），換回整批的秒數記下來
+        speed = results[0].speed if results else {}
+        for stage, key in (("preprocess", "preprocess"), ("forward", "inference")):
+            if speed.get(key) is not None:
+                observe(stage, speed[key] * len(results) / 1000, engine=self.name)
+        t0 = time.perf_counter()
+        dets = [_result_to_detections(r, name) for r, name in zip(results, filenames)]
+        # postprocess = ultralytics 的 NMS + 取出框的陣列
+        nms_seconds = (speed.get("postprocess") or 0.0) * len(results) / 1000
+        observe("postprocess", nms_seconds + time.perf_counter() - t0, engine=self.name)
+        return dets
+
+    def warmup(self, imgsz=WARMUP_IMGSZ):
+        self.detect([np.zeros((imgsz, imgsz, 3), dtype=np.uint8)], imgsz, 0.25, None, ["warmup"])
+
+
+def onnx_path_for(weights, imgsz):
+    """匯出的 ONNX 放在權重旁邊的 .engines/，檔名帶權重 hash 與 imgsz，權重換了自然會重新匯出"""
+    weights = Path(weights)
+    return weights.parent / ".engines" / f"{weights.stem}-{weights_digest(str(weights))[:12]}-{int(imgsz)}.onnx"
+
+
+def export_onnx(weights, imgsz):
+    """
+    best.pt → ONNX（已經匯出過就直接用），回傳 .onnx 路徑。
+    YOLO.export 固定寫到權重旁邊的 <stem>.onnx，infer_server 的多個 worker 同時暖機會互相蓋掉，
+    所以每個 process 先把權重複製到自己的暫存目錄再匯出，最後 os.replace 過去（同一個檔案系統，不會讀到一半的檔）。
+    """
+    target = onnx_path_for(weights, imgsz)
+    if target.exists():
+        return target
+    target.parent.mkdir(parents=True, exist_ok=True)
+    print(f"[ENGINE] 匯出 ONNX：{weights} imgsz={imgsz}")
+    with tempfile.TemporaryDirectory(dir=target.parent, prefix=".export-") as tmp_dir:
+        local = Path(tmp_dir) / Path(weights).name
+        shutil.copy2(weights, local)
+        # dynamic=True：batch 維度可變，一個檔案就能跑任何 batch 大小
+        exported = YOLO(str(local)).export(format="onnx", imgsz=int(imgsz), dynamic=True, simplify=True)
+        os.replace(exported, target)
+    return target
+
+
+class OnnxEngine:
+    """
+    onnxruntime CPU 推論：每個 imgsz 一個 session（第一次用到才匯出 / 建立），
+    前處理（letterbox）與後處理（NMS）都是 numpy，不需要 torch。
+    給 model_path 就固定用那個 .onnx（不匯出、不挑版本），量測某個特定檔案時用。
+    """
+
+    name = "onnx"
+
+    def __init__(self, weights=WEIGHTS_PATH, threads=INFER_THREADS, model_path=None):
+        import onnxruntime as ort
+
+        self._ort = ort
+        self.weights = weights
+        self.threads = threads
+        self.model_path = model_path
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def _model_path(self, imgsz):
+        return export_onnx(self.weights, imgsz)
+
+    def session(self, imgsz):
+        with self._lock:
+            sess = self._sessions.get(imgsz)
+            if sess is None:
+                opts = self._ort.SessionOptions()
+                opts.graph_optimization_level = self._ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+                opts.execution_mode = self._ort.ExecutionMode.ORT_SEQUENTIAL
+                opts.intra_op_num_threads = self.threads
+                opts.inter_op_num_threads = 1
+                path = self.model_path or self._model_path(imgsz)
+                sess = self._ort.InferenceSession(str(path), sess_options=opts, providers=["CPUExecutionProvider"])
+                self._sessions[imgsz] = sess
+            return sess
+
+    def detect(self, arrays, imgsz, conf, classes, filenames):
+        imgsz = int(imgsz)
+        sess = self.session(imgsz)
+        with span("preprocess", engine=self.name):
+            batch = np.empty((len(arrays), 3, imgsz, imgsz), dtype=np.float32)
+            metas = []
+            for k, a in enumerate(arrays):
+                a = np.asarray(a)
+                boxed, ratio, pad = letterbox(a, imgsz)
+                batch[k] = boxed.transpose(2, 0, 1)
+                metas.append((ratio, pad, (a.shape[1], a.shape[0])))
+            batch /= 255.0
+        with span("forward", engine=self.name):
+            preds = sess.run(None, {sess.get_inputs()[0].name: batch})[0]
+        outputs = []
+        with span("postprocess", engine=self.name):
+            for pred, (ratio, pad, size), name in zip(preds, metas, filenames):
+                xyxy, scores, cls_ids = decode_yolo_output(pred, ratio, pad, size, conf, classes)
+                outputs.append(Detections(file=name, xyxy=xyxy, conf=scores, cls=cls_ids))
+        return outputs
+
+    def warmup(self, imgsz=WARMUP_IMGSZ):
+        self.detect([np.zeros((imgsz, imgsz, 3), dtype=np.uint8)], imgsz, 0.25, None, ["warmup"])
+
+
+def quantized_path_for(weights, imgsz, mode):
+    """INT8 量化後的 ONNX 路徑（mode = static / dynamic），跟 FP32 的放在一起"""
+    fp32 = onnx_path_for(weights, imgsz)
+    return fp32.with_name(f"{fp32.stem}-int8-{mode}.onnx")
+
+
+def quantize_dynamic_onnx(weights, imgsz):
+    """動態量化（只量化權重、不用校正資料），已經有就直接用"""
+    target = quantized_path_for(weights, imgsz, "dynamic")
+    if target.exists():
+        return target
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    src = export_onnx(weights, imgsz)
+    print(f"[ENGINE] 動態 INT8 量化：{src.name}")
+    # 暫存檔名帶 pid，多個 worker 同時量化不會寫到同一個檔
+    tmp = target.with_name(f"{target.stem}.{os.getpid()}.tmp.onnx")
+    try:
+        quantize_dynamic(str(src), str(tmp), weight_type=QuantType.QUInt8)
+        os.replace(tmp, target)
+    finally:
+        tmp.unlink(missing_ok=True)
+    return target
+
+
+class Int8OnnxEngine(OnnxEngine):
+    """
+    INT8 量化的 ONNX：優先用 quantize_model.py 以 val 影像校正產生的 static 版本，
+    沒有的話現場做 dynamic 量化（不用校正資料，但通常比 static 慢）。
+    """
+
+    name = "onnx-int8"
+
+    def _model_path(self, imgsz):
+        static = quantized_path_for(self.weights, imgsz, "static")
+        if static.exists():
+            return static
+        return quantize_dynamic_onnx(self.weights, imgsz)
+
+
+ENGINES = {"torch": TorchEngine, "onnx": OnnxEngine, "onnx-int8": Int8OnnxEngine}
+
+
+@lru_cache(maxsize=None)
+def load_engine(name=None):
+    """
+    依名稱（預設 VISDRONE_ENGINE）建立推論引擎並先跑一張空白圖暖機，
+    第一個使用者的請求不用等 session 初始化。非 torch 的引擎載入失敗時退回 torch。
+    """
+    name = (name or INFER_ENGINE).lower()
+    if name not in ENGINES:
+        raise ValueError(f"不支援的推論引擎：{name}（可用：{', '.join(ENGINES)}）")
+    try:
+        engine = ENGINES[name]()
+        with muted():  # 第一次 forward 特別慢，不算進延遲統計
+            engine.warmup()
+    except Exception as e:
+        if name == "torch":
+            raise
+        print(f"[ENGINE] {name} 載入失敗，改用 torch：{e}")
+        safe_log("WARN", "backend.py", f"推論引擎 {name} 載入失敗，改用 torch", detail=str(e))
+        return load_engine("torch")
+    print(f"[ENGINE] 使用 {engine.name} 引擎")
+    return engine
+
+
+def benchmark_engines(images, imgsz=640, names=None, runs=20, batch_size=1, engines=None):
+    """
+    在同一批影像上比較各引擎的延遲（暖機後計時），回傳 DataFrame：
+    engine, imgsz, batch, p50_ms, p95_ms, img_per_s。
+    預設依 names 用 load_engine 建（WEIGHTS_PATH 的模型）；engines 給 {名稱: 引擎物件} 時直接量那些物件。
+    """
+    rows = []
+    arrays = [np.asarray(img) for img in images][:batch_size] or [np.zeros((imgsz, imgsz, 3), dtype=np.uint8)]
+    filenames = [f"bench_{i}" for i in range(len(arrays))]
+    if engines is None:
+        engines = {}
+        for name in names or list(ENGINES):
+            engine = load_engine(name)
+            if engine.name == name:  # 載入失敗退回別的引擎，不算這一項
+                engines[name] = engine
+    for name, engine in engines.items():
+        engine.detect(arrays, imgsz, 0.25, None, filenames)
+        times = []
+        for _ in range(runs):
+            t0 = time.perf_counter()
+            engine.detect(arrays, imgsz, 0.25, None, filenames)
+            times.append(time.perf_counter() - t0)
+        times = np.array(times)
+        rows.append(
+            {
+                "engine": name,
+                "imgsz": imgsz,
+                "batch": len(arrays),
+                "p50_ms": round(float(np.percentile(times, 50)) * 1000, 2),
+                "p95_ms": round(float(np.percentile(times, 95)) * 1000, 2),
+                "img_per_s": round(len(arrays) / float(times.mean()), 2),
+            }
+        )
+    return pd.DataFrame(rows)
+
+
+# ========= 切塊（tiled）推論 =========
+# 高解析度空拍圖切成重疊的 tile，每塊用原解析度送進模型，小物件不會被整張縮小後消失。
+TILE_SIZE = int(os.getenv("VISDRONE_TILE_SIZE", "640"))  # tile 在原圖上的邊長（pixel）
+TILE_OVERLAP = float(os.getenv("VISDRONE_TILE_OVERLAP", "0.2"))  # 相鄰 tile 重疊比例
+TILE_BATCH_SIZE = int(os.getenv("VISDRONE_TILE_BATCH", "16"))  # 一次 forward 的 tile 數
+# 先用低解析度整張跑一次：找出有東西的區域（沒有候選框的 tile 直接跳過），大物件也從這裡來
+PREPASS_IMGSZ = int(os.getenv("VISDRONE_PREPASS_IMGSZ", "320"))
+PREPASS_CONF = float(os.getenv("VISDRONE_PREPASS_CONF", "0.05"))
+TILE_MERGE_IOS = 0.6  # 跨 tile 合併時，重疊面積 / 較小框面積超過這個值就視為同一個物件
+TILE_PREPASS_IOU = 0.5  # prepass 的框跟 tile 的框 IoU 超過這個值就是同一個物件，留 tile 的（解析度較高）
+
+
+def make_tiles(width, height, tile_size=TILE_SIZE, overlap=TILE_OVERLAP):
+    """
+    回傳 (T, 4) int 陣列，每列是一個 tile 的 x0, y0, x1, y1。
+    最後一排 / 一列貼齊影像邊緣（往內移，不補黑邊），影像比 tile 小的方向就只有一塊。
+    """
+
+    def starts(length):
+        if length <= tile_size:
+            return np.array([0])
+        stride = max(1, int(tile_size * (1.0 - overlap)))
+        n = int(np.ceil((length - tile_size) / stride)) + 1
+        return np.minimum(np.arange(n) * stride, length - tile_size)
+
+    xs, ys = starts(width), starts(height)
+    x0, y0 = np.meshgrid(xs, ys)
+    x0, y0 = x0.ravel(), y0.ravel()
+    return np.column_stack([x0, y0, np.minimum(x0 + tile_size, width), np.minimum(y0 + tile_size, height)])
+
+
+def tiles_with_candidates(tiles, xyxy, margin=0):
+    """(T,) bool：哪些 tile 跟任何一個候選框（往外擴 margin pixel）有交集"""
+    if len(xyxy) == 0:
+        return np.zeros(len(tiles), dtype=bool)
+    boxes = np.asarray(xyxy, dtype=np.float32)
+    t = tiles[:, None, :].astype(np.float32)
+    hit = (
+        (boxes[None, :, 0] - margin < t[..., 2])
+        & (boxes[None, :, 2] + margin > t[..., 0])
+        & (boxes[None, :, 1] - margin < t[..., 3])
+        & (boxes[None, :, 3] + margin > t[..., 1])
+    )
+    return hit.any(axis=1)
+
+
+def _overlaps_same_class(xyxy, cls_ids, ref_xyxy, ref_cls, threshold):
+    """xyxy 的每個框，跟任一個同類別的 ref 框 IoU 超過 threshold 就是 True"""
+    a = np.asarray(xyxy, dtype=np.float32).reshape(-1, 4)
+    b = np.asarray(ref_xyxy, dtype=np.float32).reshape(-1, 4)
+    w = (np.minimum(a[:, None, 2], b[None, :, 2]) - np.maximum(a[:, None, 0], b[None, :, 0])).clip(0)
+    h = (np.minimum(a[:, None, 3], b[None, :, 3]) - np.maximum(a[:, None, 1], b[None, :, 1])).clip(0)
+    inter = w * h
+    area_a = (a[:, 2] - a[:, 0]).clip(0) * (a[:, 3] - a[:, 1]).clip(0)
+    area_b = (b[:, 2] - b[:, 0]).clip(0) * (b[:, 3] - b[:, 1]).clip(0)
+    iou = inter / np.maximum(area_a[:, None] + area_b[None, :] - inter, 1e-6)
+    same = np.asarray(cls_ids)[:, None] == np.asarray(ref_cls)[None, :]
+    return ((iou > threshold) & same).any(axis=1)
+
+
+def tiled_detect(engine, images, filenames, imgsz, conf, classes, tile_size=TILE_SIZE, overlap=TILE_OVERLAP,
+                 prepass_imgsz=PREPASS_IMGSZ, tile_batch=TILE_BATCH_SIZE):
+    """
+    多張影像的切塊推論，回傳 list[Detections]：
+    1. 整批影像用 prepass_imgsz 跑一次低解析度 forward（很便宜）
+    2. 每張切成重疊 tile，prepass 沒有任何候選框的 tile 跳過
+    3. 所有影像剩下的 tile 接在一起，每 tile_batch 塊一次 forward（imgsz = 每塊的模型輸入大小）
+    4. tile 的框平移回原圖座標，先彼此做跨 tile NMS（IoS，合併被 tile 邊界切開的框）
+    5. 再加上 prepass 的框（大物件），跟 tile 的框重複（IoU）的丟掉
+    prepass 的框不能進第 4 步：IoS 下整個被包住的小框算 1.0，一個粗略的大框（整群行人、
+    一排車）會把裡面分數較低的小物件全部壓掉，切塊就白做了。
+    """
+    arrays = [np.asarray(img) for img in images]
+    prepass_dets = engine.detect(arrays, prepass_imgsz, min(PREPASS_CONF, conf), classes, filenames)
+
+    # (影像 index, x0, y0, tile 影像)
+    jobs = []
+    for i, (arr, pre) in enumerate(zip(arrays, prepass_dets)):
+        tiles = make_tiles(arr.shape[1], arr.shape[0], tile_size, overlap)
+        active = tiles_with_candidates(tiles, pre.xyxy, margin=tile_size * overlap / 2)
+        for x0, y0, x1, y1 in tiles[active]:
+            jobs.append((i, int(x0), int(y0), arr[y0:y1, x0:x1]))
+
+    parts = [[] for _ in arrays]
+    for start in range(0, len(jobs), tile_batch):
+        chunk = jobs[start:start + tile_batch]
+        dets = engine.detect(
+            [np.ascontiguousarray(tile) for _, _, _, tile in chunk], imgsz, conf, classes,
+            [filenames[i] for i, _, _, _ in chunk],
+        )
+        for (i, x0, y0, _), d in zip(chunk, dets):
+            if len(d):
+                parts[i].append((d.xyxy + np.array([x0, y0, x0, y0], dtype=np.float32), d.conf, d.cls))
+
+    outputs = []
+    for name, pre, image_parts in zip(filenames, prepass_dets, parts):
+        if image_parts:
+            xyxy = np.concatenate([p[0] for p in image_parts]).astype(np.float32, copy=False)
+            scores = np.concatenate([p[1] for p in image_parts]).astype(np.float32, copy=False)
+            cls_ids = np.concatenate([p[2] for p in image_parts]).astype(np.int16, copy=False)
+            keep = nms_numpy(xyxy, scores, cls_ids, threshold=TILE_MERGE_IOS, metric="ios")
+            xyxy, scores, cls_ids = xyxy[keep], scores[keep], cls_ids[keep]
+        else:
+            xyxy, scores, cls_ids = np.zeros((0, 4), np.float32), np.zeros(0, np.float32), np.zeros(0, np.int16)
+
+        # prepass 用較低的 conf 找候選，最終結果還是依 conf 過濾
+        mask = pre.conf >= conf
+        pre_xyxy, pre_conf, pre_cls = pre.xyxy[mask], pre.conf[mask], pre.cls[mask]
+        if len(pre_xyxy) and len(xyxy):
+            mask = ~_overlaps_same_class(pre_xyxy, pre_cls, xyxy, cls_ids, TILE_PREPASS_IOU)
+            pre_xyxy, pre_conf, pre_cls = pre_xyxy[mask], pre_conf[mask], pre_cls[mask]
+
+        xyxy = np.concatenate([xyxy, pre_xyxy]).astype(np.float32, copy=False)
+        scores = np.concatenate([scores, pre_conf]).astype(np.float32, copy=False)
+        cls_ids = np.concatenate([cls_ids, pre_cls]).astype(np.int16, copy=False)
+        order = np.argsort(-scores, kind="stable")
+        outputs.append(Detections(file=name, xyxy=xyxy[order], conf=scores[order], cls=cls_ids[order]))
+    return outputs
+
+
+def cache_mode(engine_name, tiled=False):
+    """快取 key 的 mode：不同引擎 / 切塊設定的結果不一定完全相同，分開快取"""
+    if tiled:
+        return f"{engine_name}|tile{TILE_SIZE}-{TILE_OVERLAP:.2f}-pre{PREPASS_IMGSZ}-iou{TILE_PREPASS_IOU:.2f}"
+    return engine_name
+
+
+def run_inference_batch(images, imgsz: int, conf: float, classes, filenames=None, batch_size=None,
+                        plot=False, digests=None, use_cache=True, georef=None, tiled=False, image_paths=None):
+    """
+    多張圖片的批次 YOLO 推論：
+    每 batch_size 張一起 letterbox、只做一次 forward，
+    回傳 list[Detections]，順序與輸入相同。
+    plot=False 時不畫框，只要框的批次呼叫端可以省下畫圖時間。
+    digests 可傳入每張圖原始 bytes 的 image_digest()，沒給就用像素算；
+    已經在 RESULT_CACHE 裡的圖片不會再送進模型。
+    georef 給 georef.TransformRegistry 時，會替每個框中心算好經緯度（Detections.lonlat）；
+    image_paths 是每張圖的來源路徑（可含 None），registry 沒有明確設定時會找旁邊的 <stem>.geo.json。
+    tiled=True 時改用切塊推論（見 tiled_detect），imgsz 變成每個 tile 的模型輸入大小。
+    """
+    images = list(images)
+    if filenames is None:
+        filenames = [f"image_{i}" for i in range(len(images))]
+    if len(filenames) != len(images):
+        raise ValueError("filenames 的數量必須和 images 一樣")
+    if image_paths is not None and len(image_paths) != len(images):
+        raise ValueError("image_paths 的數量必須和 images 一樣")
+    batch_size = max(1, int(batch_size or INFER_BATCH_SIZE))
+
+    engine = load_engine()
+    mode = cache_mode(engine.name, tiled)
+    outputs = [None] * len(images)
+    keys = [None] * len(images)
+    pending = []  # 快取沒命中、需要真的跑模型的 index
+    with span("cache_lookup"):
+        for i, img in enumerate(images):
+            if use_cache:
+                digest = digests[i] if digests is not None else image_digest(img)
+                keys[i] = make_cache_key(digest, imgsz, conf, classes, mode=mode)
+                cached = RESULT_CACHE.get(keys[i])
+                if cached is not None:
+                    xyxy, scores, cls_ids = cached
+                    outputs[i] = Detections(file=filenames[i], xyxy=xyxy, conf=scores, cls=cls_ids)
+                    continue
+            pending.append(i)
+
+    if pending:
+        for _, chunk in _iter_batches(pending, batch_size):
+            chunk_images = [images[i] for i in chunk]
+            chunk_names = [filenames[i] for i in chunk]
+            if tiled:
+                dets = tiled_detect(engine, chunk_images, chunk_names, imgsz, conf, classes)
+            else:
+                # 整批一起 letterbox 成同一個 tensor，只做一次 forward
+                dets = engine.detect(chunk_images, imgsz, conf, classes, chunk_names)
+            for i, det in zip(chunk, dets):
+                outputs[i] = det
+                if use_cache:
+                    RESULT_CACHE.put(keys[i], det)
+
+    if georef is not None:
+        paths = image_paths if image_paths is not None else [None] * len(images)
+        for img, det, path in zip(images, outputs, paths):
+            transform = georef.get(det.file, image_path=path, size=_image_size(img))
+            det.lonlat = georeference_boxes(det.xyxy, transform)
+
+    if plot:
+        for img, det in zip(images, outputs):
+            det.plotted = render_detections(img, det)
+    return outputs
+
+
+def run_inference(img: Image.Image, imgsz: int, conf: float, filename: str, classes_ids, georef=None,
+                  tiled=False):
     """
     單張圖片的 YOLO 推論：
     傳入 PIL.Image，回傳 (畫好框的 PIL.Image, bounding boxes 的 DataFrame)
+    給 georef（georef.TransformRegistry）時 DataFrame 會多 lon, lat 欄位；tiled=True 用切塊推論。
     """
-    model = load_model()
-    img_np = np.array(img)
-
-    results = model.predict(
-        source=img_np,
-        imgsz=imgsz,
-        conf=conf,
-        device="cpu",
-        classes=classes_ids,  # None = 不過濾
-        verbose=False,
-        save=False,
-    )
-    r = results[0]
+    det = run_inference_batch(
+        [img], imgsz, conf, classes_ids, filenames=[filename], batch_size=1, plot=True, georef=georef,
+        tiled=tiled,
+    )[0]
+    return det.plotted, det.to_dataframe()
 
-    plotted = r.plot()
-    plotted_rgb = Image.fromarray(plotted[..., ::-1])
 
-    rows = []
-    if r.boxes is not None:
-        for box in r.boxes:
-            xyxy = box.xyxy[0].tolist()
-            cls_id = int(box.cls)
-            rows.append(
-                {
-                    "file": filename,
-                    "cls": cls_id,
-                    "label": CLASS_MAP.get(cls_id, str(cls_id)),
-                    "conf": float(box.conf),
-                    "xmin": float(xyxy[0]),
-                    "ymin": float(xyxy[1]),
-                    "xmax": float(xyxy[2]),
-                    "ymax": float(xyxy[3]),
-                }
-            )
-    df = pd.DataFrame(rows)
-    return plotted_rgb, df
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="推論引擎工具：預先匯出 ONNX / 比較各引擎的 CPU 延遲")
+    parser.add_argument("images", nargs="*", help="測試影像（沒給就用空白圖）")
+    parser.add_argument("--bench", action="store_true", help="比較各引擎的 p50 / p95 延遲與吞吐量")
+    parser.add_argument("--export", action="store_true", help="只匯出 ONNX（部署前先做，worker 啟動時就不用匯出）")
+    parser.add_argument("--engines", nargs="+", default=list(ENGINES))
+    parser.add_argument("--imgsz", type=int, default=640)
+    parser.add_argument("--batch", type=int, default=1)
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    if not (args.bench or args.export):
+        parser.error("請指定 --bench 或 --export")
+    if args.export:
+        print(export_onnx(WEIGHTS_PATH, args.imgsz))
+    if args.bench:
+        imgs = [Image.open(p).convert("RGB") for p in args.images]
+        print(benchmark_engines(imgs, imgsz=args.imgsz, names=args.engines, runs=args.runs, batch_size=args.batch))
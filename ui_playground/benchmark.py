@@ -0,0 +1,256 @@
+# ui_playground/benchmark.py
+# 可重現的推論測速：固定一組 val 影像，跑 imgsz × batch × threads × engine 的所有組合，
+# 量 p50 / p95 / p99 延遲、img/s、最高記憶體，結果寫 JSON（+ 選擇性寫進 benchmarks 表）。
+# 每個組合在獨立的子程序裡跑，執行緒數、記憶體量測才不會互相影響。
+#
+#   python benchmark.py --out ../results/bench.json --db
+#   python benchmark.py --imgsz 640 --batch 1 8 --threads 2 4 --engines torch onnx --out bench.json
+#   python benchmark.py compare ../results/bench_main.json ../results/bench.json
+#   python benchmark.py compare commit:3f2a1bc commit:9e0d4aa      # 從 benchmarks 表比較兩個 commit
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+from perf_utils import peak_rss_mb, sample_val_images
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+sys.path.append(str(PROJECT_ROOT / "PostgreSQL"))
+
+DEFAULT_IMGSZ = [320, 640, 960, 1280]  # 同 app.py 的 imgsz slider 範圍
+DEFAULT_BATCH = [1, 4, 8]
+DEFAULT_THREADS = [1, 2, 4]
+DEFAULT_ENGINES = ["torch"]
+CONFIG_KEYS = ("engine", "imgsz", "batch", "threads")
+
+
+def _run_config(cfg):
+    """子程序：照 cfg 設好執行緒數與引擎，跑完回傳一列結果"""
+    threads = str(cfg["threads"])
+    for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "VISDRONE_INFER_THREADS"):
+        os.environ[var] = threads
+    os.environ["VISDRONE_ENGINE"] = cfg["engine"]
+
+    import backend
+    from infer_dir import decode_image
+
+    engine = backend.load_engine(cfg["engine"])
+    if engine.name != cfg["engine"]:
+        raise RuntimeError(f"引擎 {cfg['engine']} 無法載入")
+    images = [decode_image(p) for p in cfg["paths"]]
+    batch, imgsz = cfg["batch"], cfg["imgsz"]
+    batches = [images[i:i + batch] for i in range(0, len(images), batch)]
+
+    def run(chunk):
+        backend.run_inference_batch(chunk, imgsz, cfg["conf"], None, batch_size=batch, use_cache=False)
+
+    for chunk in batches[: cfg["warmup"]]:
+        run(chunk)
+    times = []
+    n_images = 0
+    for _ in range(cfg["rounds"]):
+        for chunk in batches:
+            t0 = time.perf_counter()
+            run(chunk)
+            times.append(time.perf_counter() - t0)
+            n_images += len(chunk)
+    times_ms = np.array(times) * 1000
+    return {
+        **{k: cfg[k] for k in CONFIG_KEYS},
+        "n_images": n_images,
+        "p50_ms": round(float(np.percentile(times_ms, 50)), 2),
+        "p95_ms": round(float(np.percentile(times_ms, 95)), 2),
+        "p99_ms": round(float(np.percentile(times_ms, 99)), 2),
+        "img_per_s": round(n_images / (times_ms.sum() / 1000), 2),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+
+def git_commit():
+    """目前的 commit（工作目錄有修改時加 -dirty），不是 git repo 就回傳 None"""
+    try:
+        sha = subprocess.run(["git", "rev-parse", "--short=12", "HEAD"], cwd=PROJECT_ROOT, capture_output=True,
+                             text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=PROJECT_ROOT,
+                               capture_output=True, text=True, check=True).stdout.strip()
+        return f"{sha}-dirty" if dirty else sha
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def run_matrix(paths, imgsz_list, batch_list, threads_list, engines, weights=None, rounds=3, warmup=2, conf=0.25,
+               timeout=1800):
+    """每個組合開一個子程序跑 _run_config，回傳結果列表（失敗的組合記下 error）"""
+    env = dict(os.environ)
+    if weights:
+        env["VISDRONE_WEIGHTS"] = str(weights)
+    results = []
+    configs = list(itertools.product(engines, imgsz_list, batch_list, threads_list))
+    for n, (engine, imgsz, batch, threads) in enumerate(configs, 1):
+        cfg = {"engine": engine, "imgsz": imgsz, "batch": batch, "threads": threads, "paths": paths,
+               "rounds": rounds, "warmup": warmup, "conf": conf}
+        label = f"[{n}/{len(configs)}] engine={engine} imgsz={imgsz} batch={batch} threads={threads}"
+        try:
+            proc = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "_worker"],
+                input=json.dumps(cfg),
+                env=env,
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                capture_output=True,
+                text=True,
+                timeout=timeout,
+            )
+            if proc.returncode != 0:
+                raise RuntimeError(proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else proc.returncode)
+            row = json.loads(proc.stdout.strip().splitlines()[-1])
+            print(f"{label}: p50 {row['p50_ms']} ms, p95 {row['p95_ms']} ms, {row['img_per_s']} img/s, "
+                  f"RSS {row['peak_rss_mb']} MB")
+        except Exception as e:
+            print(f"{label}: 失敗 {e}")
+            row = {"engine": engine, "imgsz": imgsz, "batch": batch, "threads": threads, "error": str(e)}
+        results.append(row)
+    return results
+
+
+# ========= 比較 =========
+def load_results(spec):
+    """
+    讀一組測速結果：JSON 檔路徑，或 commit:<sha> / weights:<sha256>（從 benchmarks 表取最新的）。
+    回傳 (說明, {(engine, imgsz, batch, threads): row})
+    """
+    if spec.startswith(("commit:", "weights:")):
+        from db_utils import fetch_benchmarks
+
+        kind, value = spec.split(":", 1)
+        rows = fetch_benchmarks(git_commit=value) if kind == "commit" else fetch_benchmarks(weights_sha256=value)
+        label = spec
+    else:
+        with open(spec, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        rows = data["results"]
+        meta = data.get("meta", {})
+        label = f"{spec}（commit {meta.get('git_commit')}，weights {str(meta.get('weights_sha256'))[:12]}）"
+    return label, {tuple(r[k] for k in CONFIG_KEYS): r for r in rows if "error" not in r}
+
+
+def compare(base, new, threshold=0.10):
+    """
+    比較兩組結果：延遲（p50 / p95）變慢或 img/s 下降超過 threshold 就標成 regression。
+    回傳 regression 的組合數。
+    """
+    base_label, base_rows = load_results(base)
+    new_label, new_rows = load_results(new)
+    print(f"base: {base_label}\nnew : {new_label}\n")
+    regressions = 0
+    for key in sorted(set(base_rows) & set(new_rows)):
+        b, n = base_rows[key], new_rows[key]
+        changes = {
+            "p50": n["p50_ms"] / b["p50_ms"] - 1,
+            "p95": n["p95_ms"] / b["p95_ms"] - 1,
+            "img/s": b["img_per_s"] / n["img_per_s"] - 1,  # 正值 = 變慢
+        }
+        bad = [name for name, c in changes.items() if c > threshold]
+        regressions += bool(bad)
+        flag = "❌ REGRESSION" if bad else ("✅ faster" if changes["p50"] < -threshold else "  ")
+        print(
+            f"{flag:14s} engine={key[0]:9s} imgsz={key[1]:<5d} batch={key[2]:<3d} threads={key[3]:<3d} "
+            f"p50 {b['p50_ms']:.1f}→{n['p50_ms']:.1f} ms ({changes['p50']:+.1%})  "
+            f"p95 {b['p95_ms']:.1f}→{n['p95_ms']:.1f} ms ({changes['p95']:+.1%})  "
+            f"{b['img_per_s']:.1f}→{n['img_per_s']:.1f} img/s"
+        )
+    only = set(base_rows) ^ set(new_rows)
+    if only:
+        print(f"\n只有其中一邊有的組合：{len(only)} 個（略過）")
+    print(f"\n{regressions} 個組合變慢超過 {threshold:.0%}")
+    return regressions
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "_worker":
+        print(json.dumps(_run_config(json.loads(sys.stdin.read()))))
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == "compare":
+        parser = argparse.ArgumentParser(description="比較兩次測速結果，找出效能退步")
+        parser.add_argument("base", help="JSON 檔，或 commit:<sha> / weights:<sha256>")
+        parser.add_argument("new")
+        parser.add_argument("--threshold", type=float, default=0.10, help="變慢超過這個比例算 regression")
+        args = parser.parse_args(sys.argv[2:])
+        sys.exit(1 if compare(args.base, args.new, args.threshold) else 0)
+
+    parser = argparse.ArgumentParser(description="推論測速：imgsz × batch × threads × engine")
+    parser.add_argument("--imgsz", type=int, nargs="+", default=DEFAULT_IMGSZ)
+    parser.add_argument("--batch", type=int, nargs="+", default=DEFAULT_BATCH)
+    parser.add_argument("--threads", type=int, nargs="+", default=DEFAULT_THREADS)
+    parser.add_argument("--engines", nargs="+", default=DEFAULT_ENGINES, help="torch / onnx / onnx-int8")
+    parser.add_argument("--weights", default=None, help="權重檔（預設同 backend 的 WEIGHTS_PATH）")
+    parser.add_argument("--images", type=int, default=32, help="固定抽樣的 val 影像張數")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--rounds", type=int, default=3, help="整組影像重複跑幾輪")
+    parser.add_argument("--warmup", type=int, default=2, help="計時前先跑幾個 batch")
+    parser.add_argument("--run-id", type=int, default=None, help="權重對應的 train_runs.id")
+    parser.add_argument("--out", default=None, help="輸出 JSON（預設 results/bench_<commit>.json）")
+    parser.add_argument("--db", action="store_true", help="同時寫進 benchmarks 表")
+    parser.add_argument("--notes", default=None)
+    args = parser.parse_args()
+
+    if args.weights:
+        weights = Path(args.weights)
+    else:
+        from backend import WEIGHTS_PATH
+
+        weights = WEIGHTS_PATH
+    paths = sample_val_images(args.images, seed=args.seed)
+    meta = {
+        "git_commit": git_commit(),
+        "weights_path": str(weights),
+        "weights_sha256": file_sha256(weights),
+        "train_run_id": args.run_id,
+        "host": platform.node(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "python": platform.python_version(),
+        "images": [os.path.basename(p) for p in paths],
+        "rounds": args.rounds,
+        "notes": args.notes,
+    }
+    print(f"commit {meta['git_commit']}，weights {weights}（{meta['weights_sha256'][:12]}），{len(paths)} 張 val 影像")
+
+    results = run_matrix(paths, args.imgsz, args.batch, args.threads, args.engines, weights=weights,
+                         rounds=args.rounds, warmup=args.warmup)
+
+    out = args.out or str(PROJECT_ROOT / "results" / f"bench_{meta['git_commit'] or 'nogit'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump({"meta": meta, "results": results}, f, ensure_ascii=False, indent=2)
+    print(f"saved {out}")
+
+    if args.db:
+        from db_utils import insert_benchmarks
+
+        ok_rows = [
+            {**{k: meta[k] for k in ("git_commit", "weights_path", "weights_sha256", "train_run_id", "host", "notes")},
+             **r}
+            for r in results
+            if "error" not in r
+        ]
+        print(f"[DB] benchmarks 寫入 {len(insert_benchmarks(ok_rows))} 筆")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+# ui_playground/convert_labels.py
+# VisDrone 標註 (x, y, w, h, score, class, truncation, occlusion) → YOLO 格式 labels/。
+# 取代 notebook 的 convert_split：影像寬高直接讀 JPEG/PNG header（不解碼），
+# 多 process 平行轉換，標註沒變的就跳過，label 檔先寫暫存檔再 rename。
+#
+#   python convert_labels.py
+#   python convert_labels.py --root D:/Sandy/VisDrone/datasets --splits VisDrone2019-DET-val --force
+import argparse
+import os
+import struct
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import yaml
+from PIL import Image
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+DATA_YAML = PROJECT_ROOT / "config" / "visdrone.yaml"
+DEFAULT_SPLITS = ("VisDrone2019-DET-train", "VisDrone2019-DET-val")
+VAL_SPLIT = "VisDrone2019-DET-val"
+IMAGE_EXTS = (".jpg", ".jpeg", ".png")
+NUM_CLASSES = 10  # YOLO 類別 0~9；VisDrone 的 0（ignored regions）與 11（others）不輸出
+
+# 有寬高資訊的 JPEG SOF marker（C4 = DHT、C8 = JPG、CC = DAC 不是）
+_JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def default_data_root():
+    """config/visdrone.yaml 裡的 path"""
+    with open(DATA_YAML, "r", encoding="utf-8") as f:
+        return yaml.safe_load(f)["path"]
+
+
+def _jpeg_size(f):
+    f.seek(2)
+    while True:
+        byte = f.read(1)
+        while byte and byte != b"\xff":
+            byte = f.read(1)
+        while byte == b"\xff":  # marker 前可以有多個 0xFF 填充
+            byte = f.read(1)
+        if not byte:
+            return None
+        marker = byte[0]
+        if marker in (0x01, 0xD8) or 0xD0 <= marker <= 0xD7:
+            continue  # 沒有長度欄位的 marker
+        if marker == 0xD9:
+            return None
+        length_bytes = f.read(2)
+        if len(length_bytes) < 2:
+            return None
+        (length,) = struct.unpack(">H", length_bytes)
+        if marker in _JPEG_SOF_MARKERS:
+            data = f.read(5)
+            if len(data) < 5:
+                return None
+            height, width = struct.unpack(">xHH", data)
+            return width, height
+        f.seek(length - 2, os.SEEK_CUR)
+
+
+def image_size(path):
+    """
+    只讀檔頭取得影像 (width, height)，不做 JPEG 解碼。
+    JPEG 找 SOF marker、PNG 讀 IHDR；其他格式交給 PIL（也只讀 header）。
+    """
+    with open(path, "rb") as f:
+        head = f.read(24)
+        if head[:8] == b"\x89PNG\r\n\x1a\n" and head[12:16] == b"IHDR":
+            return struct.unpack(">II", head[16:24])
+        if head[:2] == b"\xff\xd8":
+            size = _jpeg_size(f)
+            if size is not None:
+                return size
+    with Image.open(path) as img:
+        return img.size
+
+
+def parse_annotation(ann_path):
+    """
+    讀一個 VisDrone 標註檔，回傳 [(x, y, w, h, score, cls, truncation, occlusion), ...]（都是 int）。
+    欄位不足 6 個的列略過，缺的 truncation / occlusion 補 0。
+    """
+    rows = []
+    with open(ann_path, "r") as f:
+        for line in f:
+            p = line.strip().rstrip(",").split(",")
+            if len(p) < 6:
+                continue
+            vals = [int(float(v)) for v in p[:8]]
+            vals.extend([0] * (8 - len(vals)))
+            rows.append(tuple(vals))
+    return rows
+
+
+def to_yolo_lines(rows, w, h):
+    """VisDrone 框 → YOLO 的 "cls xc yc w h"（都除以影像寬高），過濾規則同 notebook"""
+    lines = []
+    if w <= 0 or h <= 0:
+        return lines
+    for x, y, bw, bh, score, cls_raw, _, _ in rows:
+        if score == 0:
+            continue
+        if bw <= 0 or bh <= 0:
+            continue
+        cls_yolo = cls_raw - 1
+        if not (0 <= cls_yolo < NUM_CLASSES):
+            continue
+        xc = (x + bw / 2) / w
+        yc = (y + bh / 2) / h
+        bw_n = bw / w
+        bh_n = bh / h
+        if not (0 <= xc <= 1 and 0 <= yc <= 1):
+            continue
+        if bw_n <= 0 or bh_n <= 0 or bw_n > 1 or bh_n > 1:
+            continue
+        lines.append(f"{cls_yolo} {xc:.6f} {yc:.6f} {bw_n:.6f} {bh_n:.6f}")
+    return lines
+
+
+def write_atomic(path, text):
+    """先寫同資料夾的暫存檔再 os.replace，中途被砍也不會留下寫一半的 label"""
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+def convert_one(task):
+    """
+    轉換一組 (img_path, ann_path, label_path, force)。
+    回傳 (狀態, 框數)；狀態為 'converted' / 'skipped' / 'empty' / 'error:...'
+    """
+    img_path, ann_path, label_path, force = task
+    try:
+        ann_mtime = os.stat(ann_path).st_mtime if os.path.exists(ann_path) else None
+        if not force and os.path.exists(label_path):
+            src_mtime = max(os.stat(img_path).st_mtime, ann_mtime or 0)
+            if os.stat(label_path).st_mtime >= src_mtime:
+                return "skipped", 0
+
+        if ann_mtime is None:
+            write_atomic(label_path, "")
+            return "empty", 0
+        w, h = image_size(img_path)
+        lines = to_yolo_lines(parse_annotation(ann_path), w, h)
+        write_atomic(label_path, "\n".join(lines))
+        return "converted", len(lines)
+    except Exception as e:
+        return f"error:{img_path}: {e}", 0
+
+
+def list_tasks(split_dir, force=False):
+    img_dir = os.path.join(split_dir, "images")
+    ann_dir = os.path.join(split_dir, "annotations")
+    labels_dir = os.path.join(split_dir, "labels")
+    os.makedirs(labels_dir, exist_ok=True)
+    with os.scandir(img_dir) as it:
+        names = sorted(e.name for e in it if e.is_file() and e.name.lower().endswith(IMAGE_EXTS))
+    tasks = []
+    for img_name in names:
+        stem = os.path.splitext(img_name)[0]
+        tasks.append(
+            (
+                os.path.join(img_dir, img_name),
+                os.path.join(ann_dir, stem + ".txt"),
+                os.path.join(labels_dir, stem + ".txt"),
+                force,
+            )
+        )
+    return tasks
+
+
+def convert_split(split_dir, workers=None, force=False):
+    """平行轉換一個 split，回傳統計 dict"""
+    t0 = time.perf_counter()
+    tasks = list_tasks(split_dir, force=force)
+    stats = {"images": len(tasks), "converted": 0, "skipped": 0, "empty": 0, "errors": 0, "boxes": 0}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for status, n_boxes in pool.map(convert_one, tasks, chunksize=64):
+            if status.startswith("error:"):
+                stats["errors"] += 1
+                print(f"[ERROR] {status[6:]}")
+                continue
+            stats[status] += 1
+            stats["boxes"] += n_boxes
+    stats["seconds"] = round(time.perf_counter() - t0, 2)
+    print(
+        f"處理 {os.path.basename(split_dir)}：{stats['images']} 張，轉換 {stats['converted']}、"
+        f"跳過 {stats['skipped']}、無標註 {stats['empty']}、錯誤 {stats['errors']}，"
+        f"新寫入 {stats['boxes']} 個框，{stats['seconds']}s"
+    )
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="VisDrone 標註轉 YOLO labels（平行 + 增量）")
+    parser.add_argument("--root", default=None, help="資料集根目錄（預設讀 config/visdrone.yaml 的 path）")
+    parser.add_argument("--splits", nargs="+", default=list(DEFAULT_SPLITS))
+    parser.add_argument("--workers", type=int, default=None, help="process 數（預設 = CPU 核心數）")
+    parser.add_argument("--force", action="store_true", help="全部重新轉換")
+    args = parser.parse_args()
+
+    root = args.root or default_data_root()
+    for split in args.splits:
+        convert_split(os.path.join(root, split), workers=args.workers, force=args.force)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+# ui_playground/evaluate.py
+# 直接拿偵測結果表（CSV / Parquet / detections 表）對 VisDrone 標註算 mAP，不用重跑模型：
+# 每張影像一個 IoU 矩陣（numpy 向量化）、多個 process 平行配對，最後依類別算 AP@0.5 與 AP@0.5:0.95（COCO 101 點）。
+# 標註來自 ann_cache 的欄位快取；VisDrone 的 ignored regions（類別 0 / score 0）與 others（類別 11）當忽略區域，
+# 落在裡面的偵測框與標註框都不算（同 VisDrone toolkit 的 dropObjectsInIgr）。
+#
+#   python evaluate.py ../results/detections_pixel.csv
+#   python evaluate.py ../results/detections_pixel.csv --conf 0.001 0.25 0.5   # 一次比較多個信心門檻
+#   python evaluate.py db --run-id 3 --merge --json ../results/eval_run3.json  # CLASS_MAP 合併後的類別
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from ann_cache import VISDRONE_NAMES, load_or_build
+from convert_labels import NUM_CLASSES, VAL_SPLIT, default_data_root
+
+IOU_THRESHOLDS = np.linspace(0.5, 0.95, 10)
+RECALL_POINTS = np.linspace(0.0, 1.0, 101)  # COCO 的 101 點內插
+IGNORE_IOA = 0.5  # 框有超過一半面積在忽略區域裡就不算
+MAX_DETS = 500  # 每張影像最多取幾個框（VisDrone toolkit 的設定）
+DET_COLUMNS = ["image", "cls", "score", "x1", "y1", "x2", "y2"]
+
+
+# ========= 讀偵測結果 =========
+def load_detections(source, run_id=None):
+    """CSV / Parquet 路徑，或 "db"（detections 表，可用 run_id 篩） → DataFrame(image, cls, score, x1, y1, x2, y2)"""
+    if source == "db":
+        from db_utils import fetch_detections
+
+        return pd.DataFrame(fetch_detections(run_id=run_id), columns=DET_COLUMNS)
+    if str(source).lower().endswith(".parquet"):
+        df = pd.read_parquet(source, columns=DET_COLUMNS)
+    else:
+        df = pd.read_csv(source, usecols=DET_COLUMNS)
+    if run_id is not None:
+        print("[EVAL] --run-id 只對 db 有用，忽略")
+    return df
+
+
+def class_groups(merge=False):
+    """
+    (YOLO 類別 id → 評估類別的查表, 評估類別名稱)。
+    merge=True 時依 backend.CLASS_MAP 合併（例如 car / van / truck / bus 都算 car），
+    偵測框與標註框都先轉成合併後的類別再配對。
+    """
+    if not merge:
+        return np.arange(NUM_CLASSES), list(VISDRONE_NAMES[1:NUM_CLASSES + 1])
+    from backend import CLASS_MAP
+
+    names = list(dict.fromkeys(CLASS_MAP[i] for i in range(NUM_CLASSES)))
+    return np.array([names.index(CLASS_MAP[i]) for i in range(NUM_CLASSES)]), names
+
+
+# ========= 向量化 IoU / 配對 =========
+def box_iou(a, b):
+    """(n, 4) 與 (m, 4) 的 xyxy 框 → (n, m) IoU"""
+    lt = np.maximum(a[:, None, :2], b[None, :, :2])
+    rb = np.minimum(a[:, None, 2:], b[None, :, 2:])
+    inter = np.clip(rb - lt, 0, None).prod(axis=2)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    return inter / np.maximum(area_a[:, None] + area_b[None, :] - inter, 1e-9)
+
+
+def box_ioa(a, b):
+    """(n, m)：a 的每個框有多少比例的面積落在 b 的框裡"""
+    lt = np.maximum(a[:, None, :2], b[None, :, :2])
+    rb = np.minimum(a[:, None, 2:], b[None, :, 2:])
+    inter = np.clip(rb - lt, 0, None).prod(axis=2)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    return inter / np.maximum(area_a[:, None], 1e-9)
+
+
+def _outside_ignore(boxes, ignore):
+    if not len(boxes) or not len(ignore):
+        return np.ones(len(boxes), dtype=bool)
+    return box_ioa(boxes, ignore).max(axis=1) <= IGNORE_IOA
+
+
+def match_image(task):
+    """
+    worker：一張影像的偵測框依分數由高到低，跟同類別、還沒被配走的標註框配對（COCO 的 greedy 規則），
+    10 個 IoU 門檻一起算。回傳 (scores (n,), cls (n,), tp (10, n) bool, 有效標註框的類別 (m,))。
+    """
+    det_xyxy, det_score, det_cls, gt_xyxy, gt_cls, ignore_xyxy, max_dets = task
+    keep = _outside_ignore(det_xyxy, ignore_xyxy)
+    det_xyxy, det_score, det_cls = det_xyxy[keep], det_score[keep], det_cls[keep]
+    order = np.argsort(-det_score, kind="stable")[:max_dets]
+    det_xyxy, det_score, det_cls = det_xyxy[order], det_score[order], det_cls[order]
+    keep = _outside_ignore(gt_xyxy, ignore_xyxy)
+    gt_xyxy, gt_cls = gt_xyxy[keep], gt_cls[keep]
+
+    n_t = len(IOU_THRESHOLDS)
+    rows = np.arange(n_t)
+    tp = np.zeros((n_t, len(det_score)), dtype=bool)
+    for c in np.unique(det_cls):
+        d_idx = np.flatnonzero(det_cls == c)
+        g_idx = np.flatnonzero(gt_cls == c)
+        if not len(g_idx):
+            continue
+        iou = box_iou(det_xyxy[d_idx], gt_xyxy[g_idx])
+        matched = np.zeros((n_t, len(g_idx)), dtype=bool)
+        for j, row in enumerate(iou):
+            cand = np.where(matched, -1.0, row[None, :])
+            best = cand.argmax(axis=1)
+            hit = cand[rows, best] >= IOU_THRESHOLDS
+            matched[rows[hit], best[hit]] = True
+            tp[:, d_idx[j]] = hit
+    return det_score, det_cls, tp, gt_cls
+
+
+def average_precision(tp, scores, n_gt):
+    """tp (10, N) → 每個 IoU 門檻的 AP (10,)，precision 取右側最大值後在 101 個 recall 點取樣"""
+    if n_gt == 0:
+        return np.full(len(tp), np.nan)
+    if tp.shape[1] == 0:
+        return np.zeros(len(tp))
+    order = np.argsort(-scores, kind="stable")
+    tp = tp[:, order]
+    ctp = np.cumsum(tp, axis=1)
+    cfp = np.cumsum(~tp, axis=1)
+    recall = ctp / n_gt
+    precision = ctp / np.maximum(ctp + cfp, 1e-9)
+    precision = np.flip(np.maximum.accumulate(np.flip(precision, axis=1), axis=1), axis=1)
+    ap = np.zeros(len(tp))
+    for t in range(len(tp)):
+        idx = np.searchsorted(recall[t], RECALL_POINTS, side="left")
+        valid = idx < tp.shape[1]
+        ap[t] = precision[t, idx[valid]].sum() / len(RECALL_POINTS)
+    return ap
+
+
+# ========= 整個 split =========
+def _gt_arrays(ann, lut):
+    """ann_cache 的欄位 → (xyxy (M, 4), 評估類別 (M,)，-1 = 忽略區域)"""
+    x = np.asarray(ann.columns["x"], dtype=np.float32)
+    y = np.asarray(ann.columns["y"], dtype=np.float32)
+    xyxy = np.stack([x, y, x + ann.columns["w"], y + ann.columns["h"]], axis=1).astype(np.float32)
+    cls = np.asarray(ann.columns["cls"], dtype=np.int64)
+    valid = ann.valid_mask()
+    group = np.full(len(cls), -1, dtype=np.int64)
+    group[valid] = lut[cls[valid] - 1]
+    return xyxy, group
+
+
+def match_split(det_df, ann, lut, max_dets=MAX_DETS, subset=False, workers=None):
+    """
+    所有偵測框跟標註配對（只做一次，之後換信心門檻不用重配：greedy 依分數由高到低，
+    把低分框拿掉不會改變高分框的配對結果）。
+    subset=True 只評估偵測結果裡出現過的影像（只跑了部分影像時用）。
+    """
+    index = ann.image_index()
+    img = det_df["image"].map(index)
+    unknown = int(img.isna().sum())
+    if unknown:
+        print(f"[EVAL] {unknown} 個框的影像不在標註裡，略過")
+    cls = det_df["cls"].to_numpy(dtype=np.int64)
+    keep = img.notna().to_numpy() & (cls >= 0) & (cls < NUM_CLASSES)
+    det_img = img.to_numpy()[keep].astype(np.int64)
+    order = np.argsort(det_img, kind="stable")
+    det_img = det_img[order]
+    det_xyxy = det_df[["x1", "y1", "x2", "y2"]].to_numpy(dtype=np.float32)[keep][order]
+    det_score = det_df["score"].to_numpy(dtype=np.float32)[keep][order]
+    det_cls = lut[cls[keep][order]]
+    det_offsets = np.searchsorted(det_img, np.arange(ann.n_images + 1))
+
+    gt_xyxy, gt_group = _gt_arrays(ann, lut)
+    gt_offsets = np.asarray(ann.img_offsets)
+    images = np.unique(det_img) if subset else np.arange(ann.n_images)
+
+    tasks = []
+    for i in images:
+        d0, d1 = det_offsets[i], det_offsets[i + 1]
+        g = slice(gt_offsets[i], gt_offsets[i + 1])
+        g_group = gt_group[g]
+        tasks.append((
+            det_xyxy[d0:d1], det_score[d0:d1], det_cls[d0:d1],
+            gt_xyxy[g][g_group >= 0], g_group[g_group >= 0], gt_xyxy[g][g_group < 0],
+            max_dets,
+        ))
+
+    if workers == 0:
+        results = [match_image(t) for t in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(match_image, tasks, chunksize=32))
+
+    return {
+        "scores": np.concatenate([r[0] for r in results]) if results else np.zeros(0, np.float32),
+        "cls": np.concatenate([r[1] for r in results]) if results else np.zeros(0, np.int64),
+        "tp": np.concatenate([r[2] for r in results], axis=1) if results else np.zeros((len(IOU_THRESHOLDS), 0), bool),
+        "n_gt": np.bincount(np.concatenate([r[3] for r in results] or [np.zeros(0, np.int64)]),
+                            minlength=lut.max() + 1),
+        "n_images": len(images),
+    }
+
+
+def summarize(matches, names, conf=0.0):
+    """配對結果 + 信心門檻 → 各類別的 AP50 / AP50-95 與 mAP"""
+    sel = matches["scores"] >= conf
+    scores, cls, tp = matches["scores"][sel], matches["cls"][sel], matches["tp"][:, sel]
+    per_class = []
+    for c, name in enumerate(names):
+        mine = cls == c
+        ap = average_precision(tp[:, mine], scores[mine], int(matches["n_gt"][c]))
+        per_class.append({
+            "class": name,
+            "n_gt": int(matches["n_gt"][c]),
+            "n_det": int(mine.sum()),
+            "ap50": None if np.isnan(ap[0]) else float(ap[0]),
+            "ap5095": None if np.isnan(ap[0]) else float(ap.mean()),
+        })
+    scored = [r for r in per_class if r["ap50"] is not None]
+    return {
+        "conf": conf,
+        "n_images": matches["n_images"],
+        "n_det": int(sel.sum()),
+        "map50": float(np.mean([r["ap50"] for r in scored])) if scored else None,
+        "map5095": float(np.mean([r["ap5095"] for r in scored])) if scored else None,
+        "classes": per_class,
+    }
+
+
+def evaluate(det_df, split_dir, conf=0.0, merge=False, max_dets=MAX_DETS, subset=False, workers=None,
+             use_db=True):
+    """一次完成：載入標註快取 → 配對 → 算 mAP（conf 可以是單一值或清單）"""
+    # workers=0 只代表配對不開 process；建標註快取一定要用 process pool（None = 核心數）
+    ann = load_or_build(split_dir, use_db=use_db, workers=workers or None)
+    lut, names = class_groups(merge)
+    matches = match_split(det_df, ann, lut, max_dets=max_dets, subset=subset, workers=workers)
+    confs = conf if isinstance(conf, (list, tuple)) else [conf]
+    reports = [summarize(matches, names, c) for c in confs]
+    return reports if isinstance(conf, (list, tuple)) else reports[0]
+
+
+def print_report(report):
+    print(f"\n=== conf >= {report['conf']}：{report['n_images']} 張影像、{report['n_det']} 個框 ===")
+    print(f"  {'class':<16}{'n_gt':>8}{'n_det':>8}{'AP50':>8}{'AP50-95':>9}")
+    for r in report["classes"]:
+        ap50 = f"{r['ap50']:.4f}" if r["ap50"] is not None else "-"
+        ap = f"{r['ap5095']:.4f}" if r["ap5095"] is not None else "-"
+        print(f"  {r['class']:<16}{r['n_gt']:>8}{r['n_det']:>8}{ap50:>8}{ap:>9}")
+    if report["map50"] is not None:
+        print(f"  {'mAP':<32}{report['map50']:>8.4f}{report['map5095']:>9.4f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="偵測結果（CSV / Parquet / DB）對 VisDrone 標註算 mAP，不重跑模型")
+    parser.add_argument("detections", help="CSV / Parquet 路徑，或 db（讀 detections 表）")
+    parser.add_argument("--run-id", type=int, default=None, help="db 時只取這個 run 的結果")
+    parser.add_argument("--root", default=None, help="資料集根目錄（預設讀 config/visdrone.yaml 的 path）")
+    parser.add_argument("--split", default=VAL_SPLIT)
+    parser.add_argument("--conf", type=float, nargs="+", default=[0.0], help="信心門檻，可給多個一起比較")
+    parser.add_argument("--merge", action="store_true", help="依 backend.CLASS_MAP 合併類別後再評估")
+    parser.add_argument("--max-dets", type=int, default=MAX_DETS, help="每張影像最多取幾個框")
+    parser.add_argument("--subset", action="store_true", help="只評估偵測結果裡有出現的影像")
+    parser.add_argument("--workers", type=int, default=None, help="配對用的 process 數，0 = 不開 process")
+    parser.add_argument("--no-db", action="store_true", help="標註快取不查 visdrone_files，直接用檔案系統判斷有沒有變")
+    parser.add_argument("--json", default=None, help="結果另存成 JSON")
+    args = parser.parse_args()
+
+    t0 = time.perf_counter()
+    det_df = load_detections(args.detections, run_id=args.run_id)
+    split_dir = os.path.join(args.root or default_data_root(), args.split)
+    reports = evaluate(
+        det_df,
+        split_dir,
+        conf=list(args.conf),
+        merge=args.merge,
+        max_dets=args.max_dets,
+        subset=args.subset,
+        workers=args.workers,
+        use_db=not args.no_db,
+    )
+    for report in reports:
+        print_report(report)
+    print(f"\n[EVAL] {len(det_df)} 個框，共 {time.perf_counter() - t0:.2f}s")
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(reports, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+# ui_playground/georef.py
+# pixel 座標 → 經緯度。取代 notebook 裡逐列呼叫 pixel_to_fake_latlon 的做法，
+# 整個座標陣列一次用 numpy 換算，每張影像可以有自己的 transform。
+#
+#   python georef.py ../results/detections_pixel.csv --out ../results/detections_fake_geo.csv
+#   python georef.py ../results/detections_pixel.csv --out geo.csv --metadata drone_meta.csv
+import argparse
+import json
+import math
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+EARTH_RADIUS_M = 6378137.0  # WGS84 赤道半徑
+
+
+@dataclass(frozen=True)
+class AffineTransform:
+    """
+    lon = a * x + b * y + c
+    lat = d * x + e * y + f
+    （跟 GDAL geotransform 同一個概念，適合已經正射校正過的影像）
+    """
+
+    a: float
+    b: float
+    c: float
+    d: float
+    e: float
+    f: float
+
+    @classmethod
+    def fake(cls, lon0=121.0, lat0=25.0, dx=0.00001, dy=0.00001):
+        """notebook 原本的假座標：左上角 (121.0, 25.0)，每個 pixel 1e-5 度，影像 y 向下 = 緯度向下"""
+        return cls(dx, 0.0, lon0, 0.0, -dy, lat0)
+
+    def to_lonlat(self, x, y):
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        return self.a * x + self.b * y + self.c, self.d * x + self.e * y + self.f
+
+
+@dataclass(frozen=True, eq=False)
+class HomographyTransform:
+    """3x3 單應矩陣：把影像平面投影到地面（傾斜拍攝也適用）"""
+
+    matrix: np.ndarray
+
+    @classmethod
+    def from_gcps(cls, pixels, lonlats):
+        """
+        用地面控制點（至少 4 組 pixel ↔ 經緯度）以 normalized DLT 解出單應矩陣。
+        pixels、lonlats 都是 (N, 2)。
+        """
+        src = np.asarray(pixels, dtype=np.float64)
+        dst = np.asarray(lonlats, dtype=np.float64)
+        if src.shape != dst.shape or src.ndim != 2 or src.shape[1] != 2 or len(src) < 4:
+            raise ValueError("from_gcps 需要至少 4 組 (x, y) ↔ (lon, lat)")
+
+        def normalizer(pts):
+            mean = pts.mean(axis=0)
+            scale = math.sqrt(2) / max(np.sqrt(((pts - mean) ** 2).sum(axis=1)).mean(), 1e-12)
+            return np.array([[scale, 0, -scale * mean[0]], [0, scale, -scale * mean[1]], [0, 0, 1]])
+
+        t_src, t_dst = normalizer(src), normalizer(dst)
+        s = (t_src @ np.c_[src, np.ones(len(src))].T).T
+        d = (t_dst @ np.c_[dst, np.ones(len(dst))].T).T
+
+        n = len(src)
+        a = np.zeros((2 * n, 9))
+        a[0::2, 0:3] = s
+        a[0::2, 6:9] = -d[:, [0]] * s
+        a[1::2, 3:6] = s
+        a[1::2, 6:9] = -d[:, [1]] * s
+        _, _, vt = np.linalg.svd(a)
+        h = vt[-1].reshape(3, 3)
+        h = np.linalg.inv(t_dst) @ h @ t_src
+        return cls(h / h[2, 2])
+
+    def to_lonlat(self, x, y):
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        h = self.matrix
+        w = h[2, 0] * x + h[2, 1] * y + h[2, 2]
+        return (h[0, 0] * x + h[0, 1] * y + h[0, 2]) / w, (h[1, 0] * x + h[1, 1] * y + h[1, 2]) / w
+
+
+@dataclass(frozen=True)
+class CameraTransform:
+    """
+    垂直向下拍攝（nadir）的相機模型：
+    用拍攝點經緯度、離地高度、水平視角、機頭方位角（正北順時針）換算，
+    地面視為平面，適合一般空拍高度（幾十～幾百公尺）。
+    """
+
+    lon: float
+    lat: float
+    altitude_m: float
+    hfov_deg: float
+    heading_deg: float
+    width: int
+    height: int
+
+    def to_lonlat(self, x, y):
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        # 每個 pixel 在地面上幾公尺（ground sample distance）
+        gsd = 2.0 * self.altitude_m * math.tan(math.radians(self.hfov_deg) / 2.0) / self.width
+        right = (x - self.width / 2.0) * gsd
+        forward = (self.height / 2.0 - y) * gsd
+        h = math.radians(self.heading_deg)
+        east = right * math.cos(h) + forward * math.sin(h)
+        north = -right * math.sin(h) + forward * math.cos(h)
+        lat = self.lat + np.degrees(north / EARTH_RADIUS_M)
+        lon = self.lon + np.degrees(east / (EARTH_RADIUS_M * math.cos(math.radians(self.lat))))
+        return lon, lat
+
+
+FAKE_TRANSFORM = AffineTransform.fake()
+
+_AFFINE_KEYS = ("a", "b", "c", "d", "e", "f")
+_CAMERA_KEYS = ("lon", "lat", "altitude_m", "hfov_deg", "heading_deg")
+
+
+def transform_from_dict(meta, size=None):
+    """
+    從 dict 建 transform（sidecar JSON / metadata CSV 的一列）：
+    {"type": "affine", "a": ..., ..., "f": ...}
+    {"type": "homography", "gcps": [[x, y, lon, lat], ...]}
+    {"type": "camera", "lon": ..., "lat": ..., "altitude_m": ..., "hfov_deg": ..., "heading_deg": ...,
+     "width": ..., "height": ...}（width/height 沒給就用 size）
+    """
+    kind = meta.get("type")
+    if kind is None:
+        kind = "affine" if all(k in meta for k in _AFFINE_KEYS) else "camera"
+    if kind == "affine":
+        return AffineTransform(*(float(meta[k]) for k in _AFFINE_KEYS))
+    if kind == "homography":
+        gcps = np.asarray(meta["gcps"], dtype=np.float64)
+        return HomographyTransform.from_gcps(gcps[:, :2], gcps[:, 2:4])
+    if kind == "camera":
+        width = meta.get("width") or (size[0] if size else None)
+        height = meta.get("height") or (size[1] if size else None)
+        if width is None or height is None:
+            raise ValueError("camera transform 需要影像 width / height")
+        return CameraTransform(*(float(meta[k]) for k in _CAMERA_KEYS), int(width), int(height))
+    raise ValueError(f"不支援的 transform 類型：{kind}")
+
+
+class TransformRegistry:
+    """
+    影像檔名 → transform 的查表，解析結果放在 LRU 快取裡：
+    1. register() / load_metadata_csv() 明確指定的
+    2. 影像旁邊的 <stem>.geo.json（有給 image_path 才會找）
+    3. default（預設是 notebook 的假座標）
+    """
+
+    def __init__(self, default=FAKE_TRANSFORM, maxsize=4096):
+        self.default = default
+        self.maxsize = maxsize
+        self._explicit = {}
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def register(self, image, transform):
+        with self._lock:
+            self._explicit[image] = transform
+            self._cache.pop(image, None)
+
+    def load_metadata_csv(self, path):
+        """
+        每列一張影像的 metadata CSV（欄位 image + affine 的 a~f，或相機的
+        lon, lat, altitude_m, hfov_deg, heading_deg[, width, height]），回傳載入筆數。
+        """
+        meta = pd.read_csv(path)
+        rows = {}
+        for row in meta.to_dict("records"):
+            row = {k: v for k, v in row.items() if not (isinstance(v, float) and math.isnan(v))}
+            rows[row.pop("image")] = row
+        with self._lock:
+            self._explicit.update(rows)
+            self._cache.clear()
+        return len(meta)
+
+    def get(self, image, image_path=None, size=None):
+        with self._lock:
+            transform = self._cache.get(image)
+            if transform is not None:
+                self._cache.move_to_end(image)
+                return transform
+
+        transform = self._explicit.get(image)
+        if isinstance(transform, dict):
+            transform = transform_from_dict(transform, size)
+        if transform is None and image_path is not None:
+            sidecar = Path(image_path).with_suffix(".geo.json")
+            if sidecar.exists():
+                with open(sidecar, "r", encoding="utf-8") as f:
+                    transform = transform_from_dict(json.load(f), size)
+        if transform is None:
+            transform = self.default
+
+        with self._lock:
+            self._cache[image] = transform
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return transform
+
+
+DEFAULT_REGISTRY = TransformRegistry()
+
+
+def box_centers(xyxy):
+    """(N, 4) 的 x1, y1, x2, y2 → 中心點 (xc, yc)"""
+    xyxy = np.asarray(xyxy, dtype=np.float64).reshape(-1, 4)
+    return (xyxy[:, 0] + xyxy[:, 2]) / 2.0, (xyxy[:, 1] + xyxy[:, 3]) / 2.0
+
+
+def georeference_boxes(xyxy, transform):
+    """一張影像的框 → (N, 2) 的 [lon, lat]"""
+    xc, yc = box_centers(xyxy)
+    lon, lat = transform.to_lonlat(xc, yc)
+    return np.column_stack([lon, lat])
+
+
+def georeference_table(df, registry=DEFAULT_REGISTRY, image_col="image"):
+    """
+    在 detections 表（image, x1, y1, x2, y2, ...）加上 xc, yc, lon, lat。
+    同一個 transform 的所有列一次算完（預設假座標時整張表只要一次 numpy 運算）。
+    """
+    out = df.copy()
+    xc = (out["x1"].to_numpy(np.float64) + out["x2"].to_numpy(np.float64)) / 2.0
+    yc = (out["y1"].to_numpy(np.float64) + out["y2"].to_numpy(np.float64)) / 2.0
+    lon = np.empty(len(out))
+    lat = np.empty(len(out))
+
+    codes, images = pd.factorize(out[image_col])
+    # 依影像排序後，每張影像的列是 order[bounds[c]:bounds[c + 1]]
+    order = np.argsort(codes, kind="stable")
+    bounds = np.concatenate([[0], np.cumsum(np.bincount(codes, minlength=len(images)))])
+
+    # 每個不同的 transform 各算一次
+    groups = {}
+    for code, name in enumerate(images):
+        transform = registry.get(name)
+        groups.setdefault(id(transform), (transform, []))[1].append(order[bounds[code]:bounds[code + 1]])
+    for transform, slices in groups.values():
+        idx = np.concatenate(slices)
+        lon[idx], lat[idx] = transform.to_lonlat(xc[idx], yc[idx])
+
+    out["xc"] = xc
+    out["yc"] = yc
+    out["lon"] = lon
+    out["lat"] = lat
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description="detections CSV 的 pixel 座標 → 經緯度")
+    parser.add_argument("csv_path", help="例如 results/detections_pixel.csv")
+    parser.add_argument("--out", required=True, help="輸出 CSV（多了 xc, yc, lon, lat 欄位）")
+    parser.add_argument("--metadata", help="每張影像的 transform metadata CSV")
+    args = parser.parse_args()
+
+    registry = TransformRegistry()
+    if args.metadata:
+        print(f"載入 {registry.load_metadata_csv(args.metadata)} 筆影像 metadata")
+    df = georeference_table(pd.read_csv(args.csv_path), registry)
+    df.to_csv(args.out, index=False)
+    print(f"saved {args.out}（{len(df)} 筆）")
+
+
+if __name__ == "__main__":
+    main()
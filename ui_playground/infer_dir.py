@@ -0,0 +1,268 @@
+# ui_playground/infer_dir.py
+# 整個資料夾（或 visdrone_files 的一個 split）串流跑 YOLO，結果分段寫進 CSV，可中斷續跑。
+#
+#   python infer_dir.py D:/Sandy/VisDrone/datasets/VisDrone2019-DET-val/images --out ../results/detections_pixel.csv
+#   python infer_dir.py --split val --out ../results/detections_pixel.csv --db
+import argparse
+import itertools
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from backend import INFER_BATCH_SIZE, INFER_ENGINE, MODEL_RUN_ID, WEIGHTS_PATH, detections_table, run_inference_batch, safe_log
+from georef import TransformRegistry
+
+IMAGE_EXTS = (".jpg", ".jpeg", ".png")
+# 跟 notebook 產生的 detections_pixel.csv / detections_fake_geo.csv 同欄位
+OUT_COLUMNS = ["image", "x1", "y1", "x2", "y2", "score", "cls"]
+GEO_OUT_COLUMNS = OUT_COLUMNS + ["xc", "yc", "lon", "lat"]
+
+
+def list_images(folder):
+    """資料夾底下的影像（排序固定，續跑時才能用「已完成幾張」定位）"""
+    with os.scandir(folder) as it:
+        paths = [e.path for e in it if e.is_file() and e.name.lower().endswith(IMAGE_EXTS)]
+    return sorted(paths)
+
+
+def list_images_from_db(split):
+    """從 visdrone_files 取某個 split 的影像路徑"""
+    from db_utils import pooled_conn
+
+    with pooled_conn() as conn, conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT abs_path FROM visdrone_files
+            WHERE split = %s AND file_type = 'image'
+            ORDER BY rel_path;
+            """,
+            (split,),
+        )
+        return [row[0] for row in cur.fetchall()]
+
+
+def decode_image(path):
+    """讀檔 + JPEG 解碼成 RGB ndarray（cv2 解碼時會釋放 GIL，可以多執行緒平行）"""
+    buf = np.fromfile(path, dtype=np.uint8)  # 用 fromfile 才能讀中文路徑
+    img = cv2.imdecode(buf, cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError(f"無法解碼影像：{path}")
+    return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+
+def prefetch_decoded(paths, workers, depth):
+    """
+    依序產生 (path, img 或 Exception)；背景執行緒最多先解碼 depth 張，
+    模型在算的時候下一批已經在讀檔解碼，記憶體也不會隨資料集變大。
+    """
+    it = iter(paths)
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="decode") as pool:
+        window = deque((p, pool.submit(decode_image, p)) for p in itertools.islice(it, depth))
+        while window:
+            path, fut = window.popleft()
+            nxt = next(it, None)
+            if nxt is not None:
+                window.append((nxt, pool.submit(decode_image, nxt)))
+            try:
+                yield path, fut.result()
+            except Exception as e:
+                yield path, e
+
+
+class CheckpointedCsvWriter:
+    """
+    分段 append 到 CSV，每段寫完就 fsync 並更新 <out>.ckpt.json：
+    {"done": 已處理影像數, "offset": CSV 有效長度, "params": 推論參數}
+    被中斷後重跑，會把 CSV 截到 offset（丟掉寫一半的列），從 done 張之後接著跑。
+    """
+
+    def __init__(self, out_path, params, resume=True, columns=OUT_COLUMNS):
+        self.out_path = out_path
+        self.columns = columns
+        self.ckpt_path = f"{out_path}.ckpt.json"
+        self.params = params
+        self.done = 0
+        self.rows = 0
+
+        ckpt = self._load_ckpt() if resume else None
+        if ckpt is not None and ckpt.get("params") == params and os.path.exists(out_path):
+            self.done = ckpt["done"]
+            self.rows = ckpt.get("rows", 0)
+            with open(out_path, "r+b") as f:
+                f.truncate(ckpt["offset"])
+            self._f = open(out_path, "a", newline="", encoding="utf-8")
+        else:
+            if ckpt is not None:
+                print("[CKPT] 參數和上次不同，從頭開始。")
+            os.makedirs(os.path.dirname(os.path.abspath(out_path)), exist_ok=True)
+            self._f = open(out_path, "w", newline="", encoding="utf-8")
+            self._f.write(",".join(columns) + "\n")
+            self._commit()
+
+    def _load_ckpt(self):
+        try:
+            with open(self.ckpt_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _commit(self):
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        state = {"done": self.done, "rows": self.rows, "offset": self._f.tell(), "params": self.params}
+        tmp = f"{self.ckpt_path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(tmp, self.ckpt_path)
+
+    def write_chunk(self, table, n_images):
+        """寫一段結果（detections_table 的 DataFrame），並把 n_images 張算進已完成"""
+        if len(table):
+            table[self.columns].to_csv(self._f, header=False, index=False)
+        self.done += n_images
+        self.rows += len(table)
+        self._commit()
+
+    def finish(self):
+        self._f.close()
+        os.remove(self.ckpt_path)
+
+
+def run_directory(paths, out_path, imgsz=640, conf=0.25, classes=None, batch_size=INFER_BATCH_SIZE,
+                  decode_workers=4, chunk_images=256, resume=True, to_db=False, run_id=MODEL_RUN_ID,
+                  georef=None, tiled=False):
+    """
+    串流推論：解碼執行緒池 → 批次推論 → 分段寫檔（+ 選擇性 COPY 進 detections）。
+    georef 給 TransformRegistry 時輸出多 xc, yc, lon, lat（同 detections_fake_geo.csv）。
+    tiled=True 用 backend 的切塊推論（適合 2000×1500 這種原圖、小物件多的情況）。
+    回傳 (處理影像數, 偵測框數)。
+    """
+    params = {
+        "weights": str(WEIGHTS_PATH),
+        "engine": INFER_ENGINE,
+        "imgsz": imgsz,
+        "conf": conf,
+        "classes": sorted(classes) if classes is not None else None,
+        "n_images": len(paths),
+        "geo": georef is not None,
+        "tiled": tiled,
+    }
+    columns = GEO_OUT_COLUMNS if georef is not None else OUT_COLUMNS
+    writer = CheckpointedCsvWriter(out_path, params, resume=resume, columns=columns)
+    if writer.done:
+        print(f"[CKPT] 從第 {writer.done}/{len(paths)} 張接著跑")
+    todo = paths[writer.done:]
+
+    copy_detections = None
+    if to_db:
+        from db_utils import copy_detections
+
+    t0 = time.perf_counter()
+    n_done = 0
+    pending_dets = []
+    pending_images = 0
+
+    def flush():
+        nonlocal pending_dets, pending_images
+        table = detections_table(pending_dets, run_id=run_id)
+        # 先 COPY 進 DB 再寫 checkpoint：COPY 失敗或中途被砍，重跑時這段會整段重做，
+        # 不會出現 CSV 有、detections 表卻永遠缺一段的情況
+        if copy_detections is not None and len(table):
+            copy_detections(table)
+        writer.write_chunk(table, pending_images)
+        pending_dets, pending_images = [], 0
+
+    stream = prefetch_decoded(todo, workers=decode_workers, depth=batch_size * 2)
+    while True:
+        batch = list(itertools.islice(stream, batch_size))
+        if not batch:
+            break
+        ok = [(p, img) for p, img in batch if not isinstance(img, Exception)]
+        for p, err in batch:
+            if isinstance(err, Exception):
+                print(f"[SKIP] {err}")
+        if ok:
+            dets = run_inference_batch(
+                [img for _, img in ok],
+                imgsz,
+                conf,
+                classes,
+                filenames=[os.path.basename(p) for p, _ in ok],
+                batch_size=batch_size,
+                use_cache=False,
+                georef=georef,
+                tiled=tiled,
+                image_paths=[p for p, _ in ok],
+            )
+            pending_dets.extend(dets)
+        pending_images += len(batch)
+        n_done += len(batch)
+
+        if pending_images >= chunk_images:
+            flush()
+            elapsed = time.perf_counter() - t0
+            print(f"[{writer.done}/{len(paths)}] {n_done / elapsed:.1f} img/s, 累計 {writer.rows} 個框")
+
+    flush()
+    writer.finish()
+    elapsed = time.perf_counter() - t0
+    print(f"✅ 完成 {len(paths)} 張，{writer.rows} 個框，本次 {n_done} 張耗時 {elapsed:.1f}s → {out_path}")
+    return len(paths), writer.rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="整個資料夾串流跑 YOLO 偵測，輸出 detections CSV")
+    parser.add_argument("source", nargs="?", help="影像資料夾")
+    parser.add_argument("--split", help="改從 visdrone_files 讀這個 split 的影像（train / val）")
+    parser.add_argument("--out", required=True, help="輸出 CSV 路徑")
+    parser.add_argument("--imgsz", type=int, default=640)
+    parser.add_argument("--conf", type=float, default=0.25)
+    parser.add_argument("--classes", type=int, nargs="*", default=None, help="只保留這些類別 id")
+    parser.add_argument("--batch", type=int, default=INFER_BATCH_SIZE, help="一次 forward 的張數")
+    parser.add_argument("--decode-workers", type=int, default=4, help="解碼執行緒數")
+    parser.add_argument("--chunk-images", type=int, default=256, help="每處理幾張寫一次檔 / checkpoint")
+    parser.add_argument("--restart", action="store_true", help="忽略 checkpoint 從頭跑")
+    parser.add_argument("--db", action="store_true", help="同時 COPY 進 detections 表")
+    parser.add_argument("--geo", action="store_true", help="加上框中心經緯度（影像旁有 <stem>.geo.json 就用它，否則假座標）")
+    parser.add_argument("--geo-metadata", help="每張影像的 transform metadata CSV（見 georef.py）")
+    parser.add_argument("--tiled", action="store_true", help="切塊推論（imgsz = 每個 tile 的模型輸入大小）")
+    args = parser.parse_args()
+
+    georef = None
+    if args.geo or args.geo_metadata:
+        georef = TransformRegistry()
+        if args.geo_metadata:
+            georef.load_metadata_csv(args.geo_metadata)
+
+    if args.split:
+        paths = list_images_from_db(args.split)
+    elif args.source:
+        paths = list_images(args.source)
+    else:
+        parser.error("請給影像資料夾，或用 --split 從 visdrone_files 讀")
+
+    safe_log("INFO", "infer_dir.py", f"開始資料夾推論，共 {len(paths)} 張 → {args.out}")
+    run_directory(
+        paths,
+        args.out,
+        imgsz=args.imgsz,
+        conf=args.conf,
+        classes=args.classes,
+        batch_size=args.batch,
+        decode_workers=args.decode_workers,
+        chunk_images=args.chunk_images,
+        resume=not args.restart,
+        to_db=args.db,
+        georef=georef,
+        tiled=args.tiled,
+    )
+    safe_log("INFO", "infer_dir.py", f"資料夾推論完成 → {args.out}")
+
+
+if __name__ == "__main__":
+    main()
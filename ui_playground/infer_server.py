@@ -0,0 +1,417 @@
+# ui_playground/infer_server.py
+# 本機推論伺服器：多個 worker process 各自載入模型（固定 torch 執行緒數），
+# 主程序用優先權佇列排程、每張圖一個 Future，佇列滿了就拒收（back-pressure）。
+# 參數相同的圖一次最多 BATCH_SIZE 張一起交給 worker（一次 forward）；
+# 推論結果快取的記憶體層放在主程序，所有 worker 共用，命中的圖不會排進佇列。
+# app.py 只負責送件和看進度，不在 Streamlit 的執行緒裡跑模型。
+#
+#   server = InferenceServer(workers=4, threads_per_worker=2)
+#   job = server.submit([img_bytes, ...], ["a.jpg", ...], imgsz=640, conf=0.25)
+#   while not job.done(): print(job.progress())
+#   dets = job.results()
+import heapq
+import itertools
+import multiprocessing as mp
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+# 預設 worker 數 = 核心數 / 每個 worker 的執行緒數
+INFER_WORKERS = int(os.getenv("VISDRONE_INFER_WORKERS", "0"))
+WORKER_THREADS = int(os.getenv("VISDRONE_WORKER_THREADS", "2"))
+# 主程序最多排幾張圖（還沒送進 worker 的），超過就拒收新工作
+MAX_PENDING = int(os.getenv("VISDRONE_INFER_MAX_PENDING", "512"))
+MAX_STARTUP_FAILURES = 3
+# 一次交給 worker 的最多張數（同 backend.INFER_BATCH_SIZE，這裡不能 import backend）
+BATCH_SIZE = int(os.getenv("VISDRONE_INFER_BATCH", "8"))
+# 湊 batch 時最多往佇列後面看幾筆（參數不同的先跳過，之後放回去）
+BATCH_LOOKAHEAD = 4
+
+
+def default_workers(threads_per_worker=WORKER_THREADS):
+    return INFER_WORKERS or max(1, (os.cpu_count() or 1) // max(1, threads_per_worker))
+
+
+def _worker_main(worker_id, task_q, result_q, threads):
+    """
+    worker process：先設好執行緒數再 import backend（torch / onnxruntime 在 import 時就讀環境變數），
+    載入並暖機模型後回報 ready（附上引擎名稱，主程序算快取 key 用），接著一批一批處理。
+    """
+    for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "VISDRONE_INFER_THREADS"):
+        os.environ[var] = str(threads)
+    import io
+
+    from PIL import Image
+
+    import backend
+    import metrics
+
+    engine = backend.load_engine()
+    result_q.put(("ready", worker_id, engine.name))
+    while True:
+        tasks = task_q.get()
+        if tasks is None:
+            break
+        params = tasks[0][4]  # 同一批的參數都一樣
+        decoded = []  # (task_id, filename, digest, img)
+        # 各階段耗時跟著結果送回主程序，統計與 metrics 端點都在主程序；
+        # 整批的 span 只附在第一張上，histogram 才不會重複計算
+        with metrics.trace() as req:
+            for task_id, img_bytes, filename, digest, _ in tasks:
+                try:
+                    with metrics.span("decode"):
+                        img = Image.open(io.BytesIO(img_bytes)).convert("RGB")
+                except Exception as e:
+                    result_q.put(("error", task_id, f"{type(e).__name__}: {e}"))
+                    continue
+                decoded.append((task_id, filename, digest, img))
+            if not decoded:
+                continue
+            try:
+                dets = backend.run_inference_batch(
+                    [img for *_, img in decoded],
+                    params["imgsz"],
+                    params["conf"],
+                    params["classes"],
+                    filenames=[filename for _, filename, _, _ in decoded],
+                    batch_size=len(decoded),
+                    digests=[digest or backend.image_digest(img) for _, _, digest, img in decoded],
+                    tiled=params.get("tiled", False),
+                )
+            except Exception as e:
+                for task_id, *_ in decoded:
+                    result_q.put(("error", task_id, f"{type(e).__name__}: {e}"))
+                continue
+        for k, ((task_id, _, _, img), det) in enumerate(zip(decoded, dets)):
+            spans = req.spans if k == 0 else []
+            result_q.put(("ok", task_id, (det.xyxy, det.conf, det.cls, img.size, spans)))
+
+
+class InferenceJob:
+    """一次送件（通常是一個使用者的一批上傳）：每張圖一個 Future，可以隨時查進度"""
+
+    def __init__(self, filenames):
+        self.filenames = list(filenames)
+        self.futures = [Future() for _ in self.filenames]
+        self.submitted_at = time.perf_counter()
+        self.spans = []  # worker 回報的各階段耗時（metrics.Trace.spans 格式）
+        self._done = 0
+        self._lock = threading.Lock()
+        for fut in self.futures:
+            fut.add_done_callback(self._on_done)
+
+    def _on_done(self, _):
+        with self._lock:
+            self._done += 1
+
+    def __len__(self):
+        return len(self.futures)
+
+    def progress(self):
+        """(已完成張數, 總張數)"""
+        with self._lock:
+            return self._done, len(self.futures)
+
+    def done(self):
+        return self.progress()[0] == len(self.futures)
+
+    def cancel(self):
+        """還沒送進 worker 的圖就不跑了"""
+        for fut in self.futures:
+            fut.cancel()
+
+    def results(self, timeout=None):
+        """依送件順序回傳 list[Detections]（某張失敗就丟出那張的例外）"""
+        return [fut.result(timeout=timeout) for fut in self.futures]
+
+
+class InferenceServer:
+    """
+    worker process 池 + 主程序的排程執行緒：
+    - 佇列是 heap，key = (priority, 該 job 的第幾張, 送件序號)：
+      同優先權的 job 輪流出圖，大批上傳不會擋住後來只傳一張的人
+    - 每個 worker 同時只有一批在跑，排程在送出那一刻才決定順序，優先權才有意義；
+      一批 = 佇列最前面那張 + 後面參數相同的，最多 BATCH_SIZE 張
+    - 推論結果快取的記憶體層在主程序（所有 worker 共用），disk 層由 worker 寫
+    - worker 掛掉時，它手上那批標成失敗並重開一個 worker
+    """
+
+    def __init__(self, workers=None, threads_per_worker=WORKER_THREADS, max_pending=MAX_PENDING,
+                 batch_size=BATCH_SIZE):
+        self.threads_per_worker = threads_per_worker
+        self.batch_size = max(1, batch_size)
+        self.n_workers = workers or default_workers(threads_per_worker)
+        self.max_pending = max_pending
+        self._ctx = mp.get_context("spawn")  # Streamlit 有很多執行緒，fork 不安全
+        self._result_q = self._ctx.Queue()
+        self._heap = []
+        self._seq = itertools.count()
+        self._task_ids = itertools.count()
+        self._cond = threading.Condition()
+        self._futures = {}  # task_id -> (Future, filename, InferenceJob, 快取 key 或 None)
+        self._workers = {}  # worker_id -> [process, task_queue, 手上那批的 task_id 集合, ready]
+        self._engine_name = None  # worker 回報的引擎名稱，知道之後才能在主程序查快取
+        self._stopping = False
+        self._startup_failures = 0
+        self._broken = None  # 所有 worker 都啟動失敗時的原因
+        self.stats = {"submitted": 0, "completed": 0, "failed": 0, "rejected": 0, "restarts": 0, "cache_hits": 0,
+                      "batches": 0}
+
+        for worker_id in range(self.n_workers):
+            self._start_worker(worker_id)
+        self._dispatcher = threading.Thread(target=self._dispatch_loop, name="infer-dispatch", daemon=True)
+        self._collector = threading.Thread(target=self._collect_loop, name="infer-collect", daemon=True)
+        self._dispatcher.start()
+        self._collector.start()
+
+    def _start_worker(self, worker_id):
+        task_q = self._ctx.Queue()
+        proc = self._ctx.Process(
+            target=_worker_main,
+            args=(worker_id, task_q, self._result_q, self.threads_per_worker),
+            name=f"infer-worker-{worker_id}",
+            daemon=True,
+        )
+        proc.start()
+        self._workers[worker_id] = [proc, task_q, set(), False]
+
+    # ---------- 送件 ----------
+    def submit(self, images, filenames, imgsz=640, conf=0.25, classes=None, tiled=False, priority=0,
+               digests=None, timeout=0):
+        """
+        送一批影像（原始 bytes，不用先解碼）進佇列，回傳 InferenceJob。
+        priority 越小越先跑。佇列放不下時等 timeout 秒，還是放不下就丟 queue.Full。
+        """
+        images = list(images)
+        if len(images) != len(filenames):
+            raise ValueError("filenames 的數量必須和 images 一樣")
+        params = {"imgsz": imgsz, "conf": conf, "classes": classes, "tiled": tiled}
+        job = InferenceJob(filenames)
+        keys, hits = self._cache_lookup(job, digests, params)
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            if self._broken:
+                raise RuntimeError(f"推論伺服器無法使用：{self._broken}")
+            while self._heap and len(self._heap) + len(images) - hits > self.max_pending:
+                remaining = deadline - time.monotonic()
+                if self._stopping or remaining <= 0:
+                    self.stats["rejected"] += 1
+                    raise queue.Full(f"推論佇列已滿（{len(self._heap)}/{self.max_pending}）")
+                self._cond.wait(remaining)
+            for k, (img_bytes, name, fut) in enumerate(zip(images, filenames, job.futures)):
+                if fut.done():
+                    continue  # 快取命中
+                task_id = next(self._task_ids)
+                digest = digests[k] if digests is not None else None
+                self._futures[task_id] = (fut, name, job, keys[k])
+                heapq.heappush(self._heap, (priority, k, next(self._seq), (task_id, img_bytes, name, digest, params)))
+            self.stats["submitted"] += len(images)
+            self.stats["cache_hits"] += hits
+            self._cond.notify_all()
+        return job
+
+    def _cache_lookup(self, job, digests, params):
+        """
+        送件前先查主程序的推論結果快取（記憶體層 + disk 層），命中的 Future 直接完成。
+        回傳 (每張的快取 key 或 None, 命中張數)；還不知道 worker 的引擎（都還沒 ready）就不查。
+        """
+        keys = [None] * len(job)
+        if digests is None or self._engine_name is None:
+            return keys, 0
+        from backend import RESULT_CACHE, Detections, cache_mode, make_cache_key
+
+        mode = cache_mode(self._engine_name, params["tiled"])
+        hits = 0
+        for k, (digest, name, fut) in enumerate(zip(digests, job.filenames, job.futures)):
+            if not digest:
+                continue
+            keys[k] = make_cache_key(digest, params["imgsz"], params["conf"], params["classes"], mode=mode)
+            cached = RESULT_CACHE.get(keys[k])
+            if cached is not None and fut.set_running_or_notify_cancel():
+                xyxy, scores, cls_ids = cached
+                fut.set_result(Detections(file=name, xyxy=xyxy, conf=scores, cls=cls_ids))
+                hits += 1
+        return keys, hits
+
+    def wait_ready(self, timeout=None):
+        """等所有 worker 載入完模型（回傳是否都 ready）"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while not all(w[3] for w in self._workers.values()):
+                if self._broken:
+                    return False
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return self._broken is None
+
+    def queue_depth(self):
+        with self._cond:
+            return len(self._heap)
+
+    # ---------- 排程 ----------
+    def _idle_worker(self):
+        for worker_id, (proc, _, current, ready) in self._workers.items():
+            if ready and not current and proc.is_alive():
+                return worker_id
+        return None
+
+    def _check_workers(self):
+        """把掛掉的 worker 手上的工作標成失敗並重開（呼叫時要持有 _cond）"""
+        for worker_id, (proc, _, current, ready) in list(self._workers.items()):
+            if proc.is_alive() or self._stopping:
+                continue
+            for task_id in current:
+                self._fail(task_id, RuntimeError(f"worker {worker_id} 異常結束（exitcode={proc.exitcode}）"))
+            if not ready:
+                # 模型還沒載入就掛了（權重不存在、套件壞掉…），一直重開也沒用
+                self._startup_failures += 1
+                if self._startup_failures >= MAX_STARTUP_FAILURES:
+                    del self._workers[worker_id]
+                    if not self._workers:
+                        self._broken = f"worker 啟動失敗 {self._startup_failures} 次（exitcode={proc.exitcode}）"
+                        for entry in self._heap:
+                            self._fail(entry[-1][0], RuntimeError(self._broken))
+                        self._heap.clear()
+                    continue
+            self.stats["restarts"] += 1
+            self._start_worker(worker_id)
+
+    def _fail(self, task_id, exc):
+        fut, *_ = self._futures.pop(task_id, (None,))
+        if fut is not None and not fut.done():
+            fut.set_exception(exc)
+        self.stats["failed"] += 1
+
+    def _dispatch_loop(self):
+        while True:
+            with self._cond:
+                if self._stopping:
+                    return
+                self._check_workers()
+                worker_id = self._idle_worker() if self._heap else None
+                if worker_id is None:
+                    self._cond.wait(0.5)
+                    continue
+                batch = self._take_batch()
+                if not batch:
+                    continue
+                self._workers[worker_id][2] = {task[0] for task in batch}
+                self._workers[worker_id][1].put(batch)
+                self.stats["batches"] += 1
+                self._cond.notify_all()  # 佇列空出位置，等著送件的可以進來了
+
+    def _take_batch(self):
+        """
+        從佇列最前面取一批參數相同的 task（呼叫時要持有 _cond）：
+        第一張一定是優先權最高的，後面最多再看 BATCH_LOOKAHEAD * batch_size 筆，參數不同的放回去。
+        """
+        batch, skipped = [], []
+        budget = self.batch_size * BATCH_LOOKAHEAD
+        while self._heap and len(batch) < self.batch_size and budget > 0:
+            entry = heapq.heappop(self._heap)
+            task = entry[-1]
+            budget -= 1
+            if batch and task[4] != batch[0][4]:
+                skipped.append(entry)
+                continue
+            fut = self._futures[task[0]][0]
+            if not fut.set_running_or_notify_cancel():
+                self._futures.pop(task[0], None)  # job 被取消了
+                continue
+            batch.append(task)
+        for entry in skipped:
+            heapq.heappush(self._heap, entry)
+        return batch
+
+    def _collect_loop(self):
+        import metrics
+        from backend import RESULT_CACHE, Detections
+
+        while True:
+            try:
+                kind, key, payload = self._result_q.get(timeout=0.5)
+            except queue.Empty:
+                if self._stopping:
+                    return
+                continue
+            with self._cond:
+                if kind == "ready":
+                    self._workers[key][3] = True
+                    self._engine_name = payload
+                    self._startup_failures = 0
+                    self._cond.notify_all()
+                    continue
+                for w in self._workers.values():
+                    w[2].discard(key)
+                fut, name, job, cache_key = self._futures.pop(key, (None, None, None, None))
+                if kind == "ok":
+                    self.stats["completed"] += 1
+                else:
+                    self.stats["failed"] += 1
+                self._cond.notify_all()
+            if fut is None:
+                continue
+            if kind == "ok":
+                xyxy, conf, cls, _, spans = payload
+                metrics.record(spans)
+                job.spans.extend(spans)
+                det = Detections(file=name, xyxy=xyxy, conf=conf, cls=cls)
+                if cache_key is not None:
+                    RESULT_CACHE.put(cache_key, det, disk=False)  # disk 層 worker 已經寫過
+                fut.set_result(det)
+            else:
+                fut.set_exception(RuntimeError(payload))
+
+    # ---------- 關閉 ----------
+    def shutdown(self, timeout=10):
+        with self._cond:
+            self._stopping = True
+            pending = [entry[-1][0] for entry in self._heap]
+            self._heap.clear()
+            for task_id in pending:
+                self._fail(task_id, RuntimeError("推論伺服器已關閉"))
+            self._cond.notify_all()
+        for proc, task_q, _, _ in self._workers.values():
+            task_q.put(None)
+        deadline = time.monotonic() + timeout
+        for proc, _, _, _ in self._workers.values():
+            proc.join(max(0.0, deadline - time.monotonic()))
+            if proc.is_alive():
+                proc.terminate()
+        self._dispatcher.join(timeout=1)
+        self._collector.join(timeout=1)
+
+
+def main():
+    """簡單壓測：同一批影像在不同 worker 數下的吞吐量"""
+    import argparse
+
+    parser = argparse.ArgumentParser(description="推論伺服器吞吐量測試")
+    parser.add_argument("images", nargs="+")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, default_workers()])
+    parser.add_argument("--threads", type=int, default=WORKER_THREADS)
+    parser.add_argument("--imgsz", type=int, default=640)
+    args = parser.parse_args()
+
+    payload = []
+    for path in args.images:
+        with open(path, "rb") as f:
+            payload.append(f.read())
+    names = [os.path.basename(p) for p in args.images]
+    for n in args.workers:
+        server = InferenceServer(workers=n, threads_per_worker=args.threads, max_pending=len(payload))
+        server.wait_ready()
+        t0 = time.perf_counter()
+        job = server.submit(payload, names, imgsz=args.imgsz)
+        boxes = sum(len(d) for d in job.results())
+        elapsed = time.perf_counter() - t0
+        print(f"workers={n} threads={args.threads}: {len(payload) / elapsed:.1f} img/s（{boxes} 個框）")
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
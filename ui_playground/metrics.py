@@ -0,0 +1,335 @@
+# ui_playground/metrics.py
+# 熱路徑的分段計時：每個階段（讀檔、解碼、前處理、forward…）包一個 span，
+# 在 process 內累積成 histogram，
+#   - 本機 HTTP 端點輸出 Prometheus 文字格式（GET /metrics）
+#   - 每隔一段時間把這段期間的統計壓成一列一列寫進 metrics 表（走 db_utils 的背景寫入器）
+# 不用掛 profiler 也看得出慢的請求時間花在哪。
+#
+#   with span("forward", engine="onnx"):
+#       sess.run(...)
+#
+#   with trace() as req:        # 收集同一個執行緒裡這次請求的所有 span
+#       ...
+#   print(req.elapsed, req.summary())
+import atexit
+import bisect
+import os
+import socket
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+sys.path.append(str(PROJECT_ROOT / "PostgreSQL"))
+
+# 0 = 不開 HTTP 端點；只綁 127.0.0.1
+METRICS_PORT = int(os.getenv("VISDRONE_METRICS_PORT", "9108"))
+METRICS_HOST = os.getenv("VISDRONE_METRICS_HOST", "127.0.0.1")
+# 多久把一段期間的統計寫進 metrics 表（秒），0 = 不寫 DB
+METRICS_FLUSH_SECONDS = float(os.getenv("VISDRONE_METRICS_FLUSH_SECONDS", "60"))
+
+# histogram 的上界（秒），最後還有一個 +Inf
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRIC_NAME = "visdrone_stage_seconds"
+
+
+class Histogram:
+    """單一 (stage, labels) 的累積 histogram；另外記一份「上次 flush 之後」的視窗統計"""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._flushed_counts = [0] * (len(BUCKETS) + 1)
+        self._flushed_sum = 0.0
+        self._window_max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self._window_max:
+            self._window_max = seconds
+
+    def take_window(self):
+        """回傳 (各 bucket 的次數, 總秒數, 最大值) 並開始新的視窗"""
+        counts = [a - b for a, b in zip(self.counts, self._flushed_counts)]
+        total = self.sum - self._flushed_sum
+        window_max = self._window_max
+        self._flushed_counts = list(self.counts)
+        self._flushed_sum = self.sum
+        self._window_max = 0.0
+        return counts, total, window_max
+
+
+def bucket_quantile(counts, q, max_value=None):
+    """從 bucket 次數估百分位數（bucket 內線性內插，跟 Prometheus 的 histogram_quantile 一樣）"""
+    n = sum(counts)
+    if n == 0:
+        return None
+    rank = q * n
+    seen = 0
+    for i, c in enumerate(counts):
+        if c and seen + c >= rank:
+            lower = BUCKETS[i - 1] if i > 0 else 0.0
+            upper = BUCKETS[i] if i < len(BUCKETS) else (max_value or lower)
+            if max_value is not None:
+                upper = min(upper, max_value)
+            return lower + (upper - lower) * (rank - seen) / c
+        seen += c
+    return max_value
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hists = {}  # (stage, labels) -> Histogram，labels 是排序過的 ((key, value), ...)
+        self._gauges = {}  # name -> (fn, help)
+
+    def observe(self, stage, seconds, labels=()):
+        key = (stage, labels)
+        with self._lock:
+            hist = self._hists.get(key)
+            if hist is None:
+                hist = self._hists[key] = Histogram()
+            hist.observe(seconds)
+
+    def register_gauge(self, name, fn, help_text=""):
+        """輸出時才呼叫 fn() 取值（例如推論佇列長度）"""
+        with self._lock:
+            self._gauges[name] = (fn, help_text)
+
+    def render(self):
+        """Prometheus text exposition format"""
+        lines = [
+            f"# HELP {METRIC_NAME} 各處理階段的耗時",
+            f"# TYPE {METRIC_NAME} histogram",
+        ]
+        with self._lock:
+            hists = [(key, list(h.counts), h.count, h.sum) for key, h in sorted(self._hists.items())]
+            gauges = list(self._gauges.items())
+        for (stage, labels), counts, count, total in hists:
+            base = ",".join([f'stage="{stage}"'] + [f'{k}="{v}"' for k, v in labels])
+            cumulative = 0
+            for upper, c in zip(BUCKETS + (float("inf"),), counts):
+                cumulative += c
+                le = "+Inf" if upper == float("inf") else repr(upper)
+                lines.append(f'{METRIC_NAME}_bucket{{{base},le="{le}"}} {cumulative}')
+            lines.append(f"{METRIC_NAME}_sum{{{base}}} {total:.6f}")
+            lines.append(f"{METRIC_NAME}_count{{{base}}} {count}")
+        for name, (fn, help_text) in gauges:
+            try:
+                value = float(fn())
+            except Exception:
+                continue
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def take_rows(self, window_seconds):
+        """
+        這個視窗內有資料的每個 (stage, labels) 壓成一列：
+        (host, pid, stage, labels, window_seconds, count, sum_ms, max_ms, p50_ms, p95_ms)
+        """
+        host, pid = socket.gethostname(), os.getpid()
+        rows = []
+        with self._lock:
+            for (stage, labels), hist in sorted(self._hists.items()):
+                counts, total, window_max = hist.take_window()
+                n = sum(counts)
+                if n == 0:
+                    continue
+                p50 = bucket_quantile(counts, 0.5, window_max)
+                p95 = bucket_quantile(counts, 0.95, window_max)
+                rows.append((
+                    host,
+                    pid,
+                    stage,
+                    ",".join(f"{k}={v}" for k, v in labels) or None,
+                    round(window_seconds, 3),
+                    n,
+                    total * 1000,
+                    window_max * 1000,
+                    p50 * 1000,
+                    p95 * 1000,
+                ))
+        return rows
+
+
+REGISTRY = Registry()
+_local = threading.local()
+
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def observe(stage, seconds, **labels):
+    """記一筆耗時（秒）；目前執行緒有 trace() 的話也一併記進去"""
+    if getattr(_local, "muted", False):
+        return
+    key = _label_key(labels)
+    REGISTRY.observe(stage, seconds, key)
+    active = getattr(_local, "trace", None)
+    if active is not None:
+        active.spans.append((stage, key, seconds))
+
+
+@contextmanager
+def span(stage, **labels):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - t0, **labels)
+
+
+@contextmanager
+def muted():
+    """區塊內這個執行緒的 span 都不記（暖機那種不代表真實請求的呼叫）"""
+    outer = getattr(_local, "muted", False)
+    _local.muted = True
+    try:
+        yield
+    finally:
+        _local.muted = outer
+
+
+def record(spans):
+    """
+    併入別的 process 量到的 span（infer_server 的 worker 回傳的 Trace.spans），
+    只進 histogram，不會再記進目前的 trace。
+    """
+    for stage, key, seconds in spans:
+        REGISTRY.observe(stage, seconds, tuple(key))
+
+
+class Trace:
+    """一次請求內所有 span 的明細"""
+
+    def __init__(self):
+        self.spans = []  # [(stage, labels, seconds), ...]
+        self.started = time.perf_counter()
+        self.elapsed = None
+
+    def extend(self, spans):
+        self.spans.extend(spans)
+
+    def totals(self):
+        """stage -> 總秒數（同一階段出現多次會加總），依耗時由大到小"""
+        out = {}
+        for stage, _, seconds in self.spans:
+            out[stage] = out.get(stage, 0.0) + seconds
+        return dict(sorted(out.items(), key=lambda kv: -kv[1]))
+
+    def summary(self):
+        """給 safe_log 的 detail 用：一行一個階段"""
+        return "\n".join(f"{stage}: {seconds * 1000:.1f} ms" for stage, seconds in self.totals().items())
+
+
+@contextmanager
+def trace():
+    """收集這個執行緒在 with 區塊裡的所有 span（可以巢狀，內層結束後 span 也會記到外層）"""
+    outer = getattr(_local, "trace", None)
+    current = Trace()
+    _local.trace = current
+    try:
+        yield current
+    finally:
+        current.elapsed = time.perf_counter() - current.started
+        _local.trace = outer
+        if outer is not None:
+            outer.extend(current.spans)
+
+
+# ========= 輸出：HTTP 端點 + 定期寫 DB =========
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass  # 不要每次被抓就印一行
+
+
+_started = {}
+_start_lock = threading.Lock()
+
+
+def start_http_server(port=METRICS_PORT, host=METRICS_HOST):
+    """背景執行緒開 Prometheus 端點（重複呼叫只會開一次），回傳 server 或 None"""
+    with _start_lock:
+        if "http" in _started or not port:
+            return _started.get("http")
+        try:
+            server = ThreadingHTTPServer((host, port), _MetricsHandler)
+        except OSError as e:
+            print(f"[METRICS] 無法開啟 {host}:{port}：{e}")
+            return None
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+        print(f"[METRICS] http://{host}:{port}/metrics")
+        _started["http"] = server
+        return server
+
+
+_last_flush = time.monotonic()
+
+
+def flush():
+    """把上次 flush 之後的統計寫進 metrics 表，回傳寫入的列數"""
+    global _last_flush
+    from db_utils import write_metrics_async
+
+    now = time.monotonic()
+    rows = REGISTRY.take_rows(now - _last_flush)
+    _last_flush = now
+    write_metrics_async(rows)
+    return len(rows)
+
+
+def _flush_quietly():
+    try:
+        flush()
+    except Exception as e:
+        print(f"[METRICS] 寫入 metrics 失敗：{e}")
+
+
+def _flush_loop(interval):
+    while True:
+        time.sleep(interval)
+        _flush_quietly()
+
+
+def start_flusher(interval=METRICS_FLUSH_SECONDS):
+    """背景執行緒定期 flush（重複呼叫只會開一次）；沒有 DB 工具就不開"""
+    with _start_lock:
+        if "flush" in _started or interval <= 0:
+            return
+        try:
+            from db_utils import get_writer
+        except ImportError as e:
+            print(f"[METRICS] 沒有 db_utils，不寫 metrics 表：{e}")
+            return
+        # 先建立寫入器：atexit 後註冊的先跑，結束時最後一段統計會在寫入器 drain 之前排進去
+        get_writer()
+        atexit.register(_flush_quietly)
+        threading.Thread(target=_flush_loop, args=(interval,), name="metrics-flush", daemon=True).start()
+        _started["flush"] = True
+
+
+def start_exporters():
+    """app 啟動時呼叫：HTTP 端點 + 定期寫 DB"""
+    start_http_server()
+    start_flusher()
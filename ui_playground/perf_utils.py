@@ -0,0 +1,30 @@
+# ui_playground/perf_utils.py
+# 測速 / 量化 / 訓練 telemetry 共用的小工具：固定 seed 的 val 影像抽樣、最高常駐記憶體。
+# import 這裡不會連帶載入 label 轉換或測速腳本（抽樣要讀資料集設定時才 import convert_labels）。
+import os
+import random
+import sys
+
+
+def sample_val_images(n, seed=0, root=None):
+    """從 val split 隨機（固定 seed）挑 n 張影像路徑（量化校正、測速都用同一組）"""
+    from convert_labels import IMAGE_EXTS, VAL_SPLIT, default_data_root
+
+    img_dir = os.path.join(root or default_data_root(), VAL_SPLIT, "images")
+    with os.scandir(img_dir) as it:
+        paths = sorted(e.path for e in it if e.is_file() and e.name.lower().endswith(IMAGE_EXTS))
+    return random.Random(seed).sample(paths, min(n, len(paths)))
+
+
+def peak_rss_mb():
+    """目前程序的最高常駐記憶體（MB）"""
+    try:
+        import resource
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux 單位是 KB，macOS 是 bytes
+        return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+    except ImportError:
+        import psutil  # Windows 沒有 resource
+
+        return psutil.Process().memory_info().peak_wset / 1024 / 1024
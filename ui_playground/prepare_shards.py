@@ -0,0 +1,238 @@
+# ui_playground/prepare_shards.py
+# 訓練前的一次性前處理：每張影像只解碼、縮放一次，寫成固定大小的 uint8 shard（.npy，可 memmap），
+# 標籤從 ann_cache 的欄位快取直接算成 YOLO 格式的索引。訓練時 shard_dataset.ShardDataset 直接切 memmap，
+# 每個 epoch 不用再讀 JPEG、解碼、解析 txt。
+# shard 放在 <split>/shards/<imgsz>/，meta.json 記資料集指紋（同 ann_cache），標註或影像變了就重建。
+#
+#   python prepare_shards.py                        # train、val，imgsz 640
+#   python prepare_shards.py --imgsz 960 --splits VisDrone2019-DET-train
+#   store = load_or_build("D:/Sandy/VisDrone/datasets/VisDrone2019-DET-train", 640)
+#   img = store.image(0)                             # (h, w, 3) BGR，memmap 的切片
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from ann_cache import dataset_fingerprint, load_or_build as load_annotations
+from convert_labels import DEFAULT_SPLITS, NUM_CLASSES, default_data_root
+
+SHARD_VERSION = 1
+SHARDS_DIRNAME = "shards"
+SHARD_SIZE = 512  # 每個 shard 幾張（640 時一個 shard 約 630 MB）
+
+
+def shard_dir_for(split_dir, imgsz):
+    return Path(split_dir) / SHARDS_DIRNAME / str(int(imgsz))
+
+
+def yolo_labels(ann):
+    """
+    AnnotationCache → (labels (M, 5) float32 = cls, xc, yc, w, h（對原圖正規化）, 每張影像的 offsets (N + 1,))。
+    過濾規則跟 convert_labels.to_yolo_lines 一樣，只是整個 split 一次用 numpy 算。
+    """
+    img = ann.columns["img"].astype(np.int64)
+    x = ann.columns["x"].astype(np.float64)
+    y = ann.columns["y"].astype(np.float64)
+    bw = ann.columns["w"].astype(np.float64)
+    bh = ann.columns["h"].astype(np.float64)
+    cls = ann.columns["cls"].astype(np.int64) - 1
+    size = np.asarray(ann.img_size, dtype=np.float64)
+    iw, ih = size[img, 0], size[img, 1]
+
+    keep = (ann.columns["score"] != 0) & (bw > 0) & (bh > 0) & (cls >= 0) & (cls < NUM_CLASSES) & (iw > 0) & (ih > 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        xc, yc = (x + bw / 2) / iw, (y + bh / 2) / ih
+        wn, hn = bw / iw, bh / ih
+    keep &= (xc >= 0) & (xc <= 1) & (yc >= 0) & (yc <= 1) & (wn <= 1) & (hn <= 1)
+
+    labels = np.stack([cls, xc, yc, wn, hn], axis=1)[keep].astype(np.float32)
+    counts = np.bincount(img[keep], minlength=ann.n_images)
+    return labels, np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+
+def _decode_into(task):
+    """
+    worker：讀一張影像、等比例縮到長邊 = imgsz，寫進 shard 的第 slot 格（左上角對齊，其餘補 114），
+    回傳 (h0, w0, h, w)。影像是 BGR，跟 ultralytics 用 cv2.imread 讀進來的一樣。
+    """
+    import cv2
+
+    img_path, shard_path, slot, imgsz = task
+    im = cv2.imread(img_path)
+    if im is None:
+        print(f"[SHARD] 無法讀取 {img_path}")
+        return 0, 0, 0, 0
+    h0, w0 = im.shape[:2]
+    r = imgsz / max(h0, w0)
+    if r != 1:
+        h, w = min(imgsz, round(h0 * r)), min(imgsz, round(w0 * r))
+        im = cv2.resize(im, (w, h), interpolation=cv2.INTER_AREA if r < 1 else cv2.INTER_LINEAR)
+    h, w = im.shape[:2]
+    shard = np.load(shard_path, mmap_mode="r+")
+    shard[slot, :h, :w] = im
+    shard[slot, h:, :] = 114
+    shard[slot, :h, w:] = 114
+    shard.flush()
+    del shard
+    return h0, w0, h, w
+
+
+def _save_atomic(path, arr):
+    tmp = f"{path}.tmp.npy"
+    np.save(tmp, arr)
+    os.replace(tmp, path)
+
+
+def build_shards(split_dir, imgsz, shard_dir=None, fingerprint=None, workers=None, use_db=True):
+    """解碼 + 縮放整個 split 寫成 shard，標籤寫成索引；meta.json 最後寫，代表 shard 完整"""
+    t0 = time.perf_counter()
+    imgsz = int(imgsz)
+    shard_dir = Path(shard_dir or shard_dir_for(split_dir, imgsz))
+    shard_dir.mkdir(parents=True, exist_ok=True)
+    meta_path = shard_dir / "meta.json"
+    if meta_path.exists():
+        meta_path.unlink()
+    for old in shard_dir.glob("images-*.npy"):
+        old.unlink()
+
+    # 影像順序與標籤都用 ann_cache（同一份排序過的檔名）
+    ann = load_annotations(split_dir, use_db=use_db, workers=workers)
+    names = ann.image_names()
+    labels, label_offsets = yolo_labels(ann)
+
+    img_dir = os.path.join(split_dir, "images")
+    tasks = []
+    for start in range(0, len(names), SHARD_SIZE):
+        shard_path = shard_dir / f"images-{start // SHARD_SIZE:03d}.npy"
+        n = min(SHARD_SIZE, len(names) - start)
+        np.lib.format.open_memmap(shard_path, mode="w+", dtype=np.uint8, shape=(n, imgsz, imgsz, 3)).flush()
+        tasks.extend((os.path.join(img_dir, names[start + k]), str(shard_path), k, imgsz) for k in range(n))
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        shapes = np.array(list(pool.map(_decode_into, tasks, chunksize=16)), dtype=np.int32).reshape(-1, 4)
+
+    _save_atomic(shard_dir / "shapes.npy", shapes)
+    _save_atomic(shard_dir / "labels.npy", labels)
+    _save_atomic(shard_dir / "label_offsets.npy", label_offsets)
+    with open(shard_dir / "names.json.tmp", "w", encoding="utf-8") as f:
+        json.dump(names, f, ensure_ascii=False)
+    os.replace(shard_dir / "names.json.tmp", shard_dir / "names.json")
+
+    meta = {
+        "version": SHARD_VERSION,
+        "fingerprint": fingerprint if fingerprint is not None else dataset_fingerprint(split_dir, use_db=use_db),
+        "split_dir": str(split_dir),
+        "imgsz": imgsz,
+        "shard_size": SHARD_SIZE,
+        "n_images": len(names),
+        "n_labels": int(len(labels)),
+        "unreadable": int((shapes[:, 0] == 0).sum()),
+        "build_seconds": round(time.perf_counter() - t0, 2),
+    }
+    with open(shard_dir / "meta.json.tmp", "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    os.replace(shard_dir / "meta.json.tmp", meta_path)
+    gb = sum(p.stat().st_size for p in shard_dir.glob("images-*.npy")) / 1024 ** 3
+    print(
+        f"[SHARD] {os.path.basename(os.path.normpath(split_dir))} imgsz={imgsz}：{meta['n_images']} 張、"
+        f"{meta['n_labels']} 個框、{gb:.1f} GB，{meta['build_seconds']}s"
+    )
+    return ShardStore(shard_dir)
+
+
+class ShardStore:
+    """
+    已建立的 shard：影像是唯讀 memmap，標籤 / 形狀很小直接讀進記憶體。
+    pickle 時只帶路徑（DataLoader 的 worker 自己重新 memmap，不會把整個 shard 複製過去）。
+    """
+
+    def __init__(self, shard_dir):
+        self.shard_dir = Path(shard_dir)
+        with open(self.shard_dir / "meta.json", "r", encoding="utf-8") as f:
+            self.meta = json.load(f)
+        with open(self.shard_dir / "names.json", "r", encoding="utf-8") as f:
+            self.names = json.load(f)
+        self.shapes = np.load(self.shard_dir / "shapes.npy")
+        self.labels = np.load(self.shard_dir / "labels.npy")
+        self.label_offsets = np.load(self.shard_dir / "label_offsets.npy")
+        self._shards = None
+
+    def __getstate__(self):
+        return {"shard_dir": self.shard_dir}
+
+    def __setstate__(self, state):
+        self.__init__(state["shard_dir"])
+
+    def __len__(self):
+        return int(self.meta["n_images"])
+
+    @property
+    def imgsz(self):
+        return int(self.meta["imgsz"])
+
+    def image_paths(self):
+        img_dir = os.path.join(self.meta["split_dir"], "images")
+        return [os.path.join(img_dir, n) for n in self.names]
+
+    def image(self, i):
+        """第 i 張縮放後的影像 (h, w, 3) BGR（memmap 的切片，不複製）"""
+        if self._shards is None:
+            paths = sorted(self.shard_dir.glob("images-*.npy"))
+            self._shards = [np.load(p, mmap_mode="r") for p in paths]
+        shard = self.meta["shard_size"]
+        _, _, h, w = self.shapes[i]
+        return self._shards[i // shard][i % shard, :h, :w]
+
+    def original_shape(self, i):
+        """原圖 (h0, w0)"""
+        return int(self.shapes[i, 0]), int(self.shapes[i, 1])
+
+    def labels_for(self, i):
+        """第 i 張的 (n, 5) 標籤：cls, xc, yc, w, h（正規化）"""
+        return self.labels[self.label_offsets[i]:self.label_offsets[i + 1]]
+
+
+def load_or_build(split_dir, imgsz, use_db=True, workers=None, force=False):
+    """shard 存在、版本與資料集指紋都對得上就直接 memmap，否則重建"""
+    shard_dir = shard_dir_for(split_dir, imgsz)
+    fingerprint = dataset_fingerprint(split_dir, use_db=use_db)
+    meta_path = shard_dir / "meta.json"
+    if not force and meta_path.exists():
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("version") == SHARD_VERSION and meta.get("fingerprint") == fingerprint:
+            return ShardStore(shard_dir)
+        print(f"[SHARD] {os.path.basename(os.path.normpath(split_dir))} 的資料有變動，重新建立 shard")
+    return build_shards(split_dir, imgsz, shard_dir=shard_dir, fingerprint=fingerprint, workers=workers,
+                        use_db=use_db)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="把 VisDrone 影像預先解碼縮放成 memmap shard（訓練用）")
+    parser.add_argument("--root", default=None, help="資料集根目錄（預設讀 config/visdrone.yaml 的 path）")
+    parser.add_argument("--splits", nargs="+", default=list(DEFAULT_SPLITS))
+    parser.add_argument("--imgsz", type=int, default=640)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--no-db", action="store_true", help="不查 visdrone_files，直接用檔案系統判斷有沒有變")
+    parser.add_argument("--force", action="store_true", help="強制重建")
+    args = parser.parse_args()
+
+    root = args.root or default_data_root()
+    for split in args.splits:
+        store = load_or_build(os.path.join(root, split), args.imgsz, use_db=not args.no_db, workers=args.workers,
+                              force=args.force)
+        # 簡單量一下隨機讀取速度（訓練時 DataLoader 就是這樣讀）
+        idx = np.random.default_rng(0).integers(0, len(store), size=min(200, len(store)))
+        t0 = time.perf_counter()
+        for i in idx:
+            np.ascontiguousarray(store.image(int(i)))
+        ms = (time.perf_counter() - t0) * 1000 / max(1, len(idx))
+        print(f"  {split}：{len(store)} 張、{len(store.labels)} 個框，隨機讀一張 {ms:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
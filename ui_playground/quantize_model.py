@@ -0,0 +1,203 @@
+# ui_playground/quantize_model.py
+# best.pt → ONNX → INT8 量化，並在 VisDrone2019-DET-val 上量 mAP 與 CPU 延遲，
+# 結果記進 model_artifacts（連回來源的 train_runs），決定速度 / 準確度的取捨划不划算。
+# 產生的 static 模型會被 backend 的 onnx-int8 引擎自動使用（VISDRONE_ENGINE=onnx-int8）。
+#
+#   python quantize_model.py --mode static --calib 200 --run-id 3
+#   python quantize_model.py --mode dynamic --skip-eval
+import argparse
+import hashlib
+import os
+import re
+import time
+
+import numpy as np
+
+from backend import (
+    MODEL_RUN_ID,
+    WEIGHTS_PATH,
+    Int8OnnxEngine,
+    OnnxEngine,
+    TorchEngine,
+    benchmark_engines,
+    export_onnx,
+    letterbox,
+    quantize_dynamic_onnx,
+    quantized_path_for,
+    safe_log,
+)
+from convert_labels import DATA_YAML
+from infer_dir import decode_image
+from perf_utils import sample_val_images
+
+
+def _make_calibration_reader(paths, imgsz, input_name):
+    from onnxruntime.quantization import CalibrationDataReader
+
+    class ValCalibrationReader(CalibrationDataReader):
+        """每次給一張 letterbox 過的 val 影像（跟推論時的前處理一樣）"""
+
+        def __init__(self):
+            self._it = iter(paths)
+
+        def get_next(self):
+            path = next(self._it, None)
+            if path is None:
+                return None
+            boxed, _, _ = letterbox(decode_image(path), imgsz)
+            batch = boxed.transpose(2, 0, 1)[None].astype(np.float32) / 255.0
+            return {input_name: batch}
+
+    return ValCalibrationReader()
+
+
+def head_decode_nodes(model_path):
+    """
+    Detect head 裡負責解碼的節點（DFL、concat、sigmoid、座標換算）。
+    這些運算對量化誤差很敏感、計算量又小，留在 FP32；head 的卷積分支（cv2 / cv3）照樣量化。
+    """
+    import onnx
+
+    graph = onnx.load(str(model_path)).graph
+    indices = [int(m.group(1)) for n in graph.node if (m := re.match(r"/model\.(\d+)/", n.name))]
+    if not indices:
+        return []
+    prefix = f"/model.{max(indices)}/"
+    return [
+        n.name
+        for n in graph.node
+        if n.name.startswith(prefix) and "/cv2." not in n.name and "/cv3." not in n.name
+    ]
+
+
+def quantize_static_onnx(weights, imgsz, calib_paths):
+    """用 val 影像校正的靜態 INT8（QDQ 格式，per-channel 權重），回傳輸出路徑"""
+    import onnxruntime as ort
+    from onnxruntime.quantization import CalibrationMethod, QuantFormat, QuantType, quantize_static
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    src = export_onnx(weights, imgsz)
+    target = quantized_path_for(weights, imgsz, "static")
+    prep = target.with_name(f"{target.stem}.prep.onnx")
+    tmp = target.with_name(f"{target.stem}.tmp.onnx")
+
+    # 先做 shape inference / 圖最佳化，量化工具才知道每個 tensor 的形狀
+    quant_pre_process(str(src), str(prep))
+    input_name = ort.InferenceSession(str(prep), providers=["CPUExecutionProvider"]).get_inputs()[0].name
+    try:
+        quantize_static(
+            str(prep),
+            str(tmp),
+            _make_calibration_reader(calib_paths, imgsz, input_name),
+            quant_format=QuantFormat.QDQ,
+            per_channel=True,
+            activation_type=QuantType.QUInt8,
+            weight_type=QuantType.QInt8,
+            calibrate_method=CalibrationMethod.MinMax,
+            nodes_to_exclude=head_decode_nodes(prep),
+        )
+        os.replace(tmp, target)
+    finally:
+        prep.unlink(missing_ok=True)
+        tmp.unlink(missing_ok=True)
+    return target
+
+
+def evaluate_map(model_path, imgsz):
+    """用 ultralytics 的 val（支援 ONNX）在 val set 上量 (mAP50, mAP50-95)"""
+    from ultralytics import YOLO
+
+    metrics = YOLO(str(model_path), task="detect").val(
+        data=str(DATA_YAML), imgsz=imgsz, batch=1, device="cpu", plots=False, verbose=False
+    )
+    return float(metrics.box.map50), float(metrics.box.map)
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def record_artifact(kind, path, imgsz, run_id, calib_images=None, maps=(None, None), latency_ms=None):
+    """寫進 model_artifacts；沒有 DB 就只印出來"""
+    try:
+        from db_utils import insert_model_artifact
+
+        artifact_id = insert_model_artifact(
+            kind,
+            path,
+            file_sha256(path),
+            train_run_id=run_id,
+            size_bytes=os.path.getsize(path),
+            imgsz=imgsz,
+            calib_images=calib_images,
+            map50=maps[0],
+            map5095=maps[1],
+            latency_ms=latency_ms,
+        )
+        print(f"[DB] model_artifacts id={artifact_id} kind={kind}")
+    except Exception as e:
+        print(f"[DB] 無法寫入 model_artifacts（{kind}）：{e}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="YOLO 權重 INT8 量化 + val set 準確度 / 延遲比較")
+    parser.add_argument("--weights", default=str(WEIGHTS_PATH))
+    parser.add_argument("--imgsz", type=int, default=640)
+    parser.add_argument("--mode", choices=["static", "dynamic"], default="static")
+    parser.add_argument("--calib", type=int, default=200, help="static 量化的校正影像張數")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--run-id", type=int, default=MODEL_RUN_ID, help="來源權重的 train_runs.id")
+    parser.add_argument("--bench-runs", type=int, default=30)
+    parser.add_argument("--skip-eval", action="store_true", help="不跑 val mAP（只量化 + 測速）")
+    args = parser.parse_args()
+
+    t0 = time.perf_counter()
+    fp32_path = export_onnx(args.weights, args.imgsz)
+    calib_paths = sample_val_images(args.calib, seed=args.seed)
+    if args.mode == "static":
+        print(f"[QUANT] 靜態 INT8，校正影像 {len(calib_paths)} 張")
+        int8_path = quantize_static_onnx(args.weights, args.imgsz, calib_paths)
+    else:
+        int8_path = quantize_dynamic_onnx(args.weights, args.imgsz)
+    print(f"[QUANT] {int8_path}（{time.perf_counter() - t0:.1f}s）")
+
+    # 直接量這次產生的 fp32_path / int8_path（--weights 的模型），不經 load_engine：
+    # 那邊固定用 WEIGHTS_PATH，onnx-int8 也會優先挑 static 檔，記進 DB 的延遲會對不上這個檔案
+    engines = {
+        "torch": TorchEngine(args.weights),
+        "onnx": OnnxEngine(args.weights, model_path=fp32_path),
+        "onnx-int8": Int8OnnxEngine(args.weights, model_path=int8_path),
+    }
+    bench_imgs = [decode_image(p) for p in calib_paths[:1]]
+    bench = benchmark_engines(bench_imgs, imgsz=args.imgsz, runs=args.bench_runs, engines=engines).set_index("engine")
+    print(bench)
+    latency = bench["p50_ms"].to_dict()
+
+    fp32_maps = int8_maps = (None, None)
+    if not args.skip_eval:
+        fp32_maps = evaluate_map(fp32_path, args.imgsz)
+        int8_maps = evaluate_map(int8_path, args.imgsz)
+        print(f"mAP50 / mAP50-95：FP32 {fp32_maps[0]:.4f} / {fp32_maps[1]:.4f}，"
+              f"INT8 {int8_maps[0]:.4f} / {int8_maps[1]:.4f}")
+    if "onnx" in latency and "onnx-int8" in latency:
+        print(f"INT8 相對 ONNX FP32 加速 {latency['onnx'] / latency['onnx-int8']:.2f}×")
+
+    record_artifact("onnx-fp32", fp32_path, args.imgsz, args.run_id, maps=fp32_maps, latency_ms=latency.get("onnx"))
+    record_artifact(
+        f"onnx-int8-{args.mode}",
+        int8_path,
+        args.imgsz,
+        args.run_id,
+        calib_images=len(calib_paths) if args.mode == "static" else None,
+        maps=int8_maps,
+        latency_ms=latency.get("onnx-int8"),
+    )
+    safe_log("INFO", "quantize_model.py", f"INT8 量化完成 mode={args.mode} → {int8_path}", run_id=args.run_id)
+
+
+if __name__ == "__main__":
+    main()
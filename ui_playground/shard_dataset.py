@@ -0,0 +1,104 @@
+# ui_playground/shard_dataset.py
+# 讓 ultralytics 直接從 prepare_shards 的 memmap shard 訓練：
+# ShardDataset 取代 YOLODataset 讀檔 / 解碼 / 解析 label 的部分，增強（mosaic 等）照舊；
+# ShardTrainer 在建 dataset 時換成 ShardDataset（shard 不存在或過期會先建好）。
+#
+#   model.train(data=..., imgsz=640, trainer=ShardTrainer)
+from pathlib import Path
+
+import numpy as np
+from ultralytics.data.dataset import YOLODataset
+from ultralytics.models.yolo.detect import DetectionTrainer
+from ultralytics.utils import colorstr
+
+from prepare_shards import load_or_build
+
+
+class ShardDataset(YOLODataset):
+    """影像與標籤都來自 ShardStore；其他行為（增強、rect、batch shapes）跟 YOLODataset 一樣"""
+
+    def __init__(self, *args, store, **kwargs):
+        # 父類別的 __init__ 會呼叫 get_img_files / get_labels，要先設好
+        self.store = store
+        # dataset 的第 k 張 = shard 的第 _index[k] 張（讀不到的影像不放進來）
+        self._index = [i for i in range(len(store)) if store.shapes[i, 0] > 0]
+        super().__init__(*args, **kwargs)
+
+    def get_img_files(self, img_path):
+        if self.fraction < 1:
+            self._index = self._index[: round(len(self._index) * self.fraction)]
+        paths = self.store.image_paths()
+        return [paths[i] for i in self._index]
+
+    def get_labels(self):
+        labels = []
+        for i, im_file in zip(self._index, self.im_files):
+            lb = self.store.labels_for(i)
+            labels.append(
+                {
+                    "im_file": im_file,
+                    "shape": self.store.original_shape(i),
+                    "cls": lb[:, 0:1].copy(),
+                    "bboxes": lb[:, 1:5].copy(),
+                    "segments": [],
+                    "keypoints": None,
+                    "normalized": True,
+                    "bbox_format": "xywh",
+                    # set_rectangle() 會依長寬比重排 im_files / labels，shard 的位置要跟著 label 走
+                    "shard_idx": i,
+                }
+            )
+        self.im_files = [lb["im_file"] for lb in labels]
+        return labels
+
+    def load_image(self, i, rect_mode=True):
+        """
+        回傳 (影像, 原圖 (h0, w0), 縮放後 (h, w))，跟 BaseDataset.load_image 一樣。
+        shard 裡已經是長邊 = imgsz 的 BGR，只要從 memmap 複製出來。
+        """
+        shard_idx = self.labels[i]["shard_idx"]
+        im = np.ascontiguousarray(self.store.image(shard_idx))
+        if self.augment:
+            # mosaic 從 buffer 裡挑其他影像；memmap 隨機讀很便宜，buffer 只記 index、不留影像
+            self.buffer.append(i)
+            if 1 < len(self.buffer) >= self.max_buffer_length:
+                self.buffer.pop(0)
+        return im, self.store.original_shape(shard_idx), im.shape[:2]
+
+    def get_image_and_label(self, index):
+        # shard_idx 只給 load_image 用；mosaic 會丟掉不認識的欄位，留著的話 collate 時各張的欄位對不齊
+        label = super().get_image_and_label(index)
+        label.pop("shard_idx", None)
+        return label
+
+
+class ShardTrainer(DetectionTrainer):
+    """train / val 的 dataset 改從 shard 讀；不是 VisDrone split 目錄（沒有 annotations/）就照原本的方式"""
+
+    def build_dataset(self, img_path, mode="train", batch=None):
+        split_dir = Path(img_path).parent if isinstance(img_path, (str, Path)) else None
+        if split_dir is None or not (split_dir / "annotations").is_dir():
+            return super().build_dataset(img_path, mode=mode, batch=batch)
+
+        store = load_or_build(split_dir, self.args.imgsz)
+        model = getattr(self.model, "module", self.model)
+        gs = max(int(model.stride.max() if self.model else 0), 32)
+        # 參數跟 ultralytics 的 build_yolo_dataset 一樣，只是 dataset 類別換掉、不做影像快取
+        return ShardDataset(
+            img_path=img_path,
+            imgsz=self.args.imgsz,
+            batch_size=batch,
+            augment=mode == "train",
+            hyp=self.args,
+            rect=self.args.rect or mode == "val",
+            cache=False,
+            single_cls=self.args.single_cls or False,
+            stride=gs,
+            pad=0.0 if mode == "train" else 0.5,
+            prefix=colorstr(f"{mode} (shards): "),
+            task=self.args.task,
+            classes=self.args.classes,
+            data=self.data,
+            fraction=self.args.fraction if mode == "train" else 1.0,
+            store=store,
+        )
@@ -0,0 +1,206 @@
+# ui_playground/spatial_index.py
+# 經緯度偵測結果的空間索引（均勻網格 + numpy），
+# 回答「這個點 50 m 內的所有車」「這個範圍內每格有幾個行人」這類問題，不用整張表掃過一遍。
+#
+#   idx = GridIndex.from_table(pd.read_csv("../results/detections_fake_geo.csv"))
+#   ids, dist = idx.query_radius(121.006, 24.996, 50, cls=[3, 4, 5, 8])
+import math
+
+import numpy as np
+
+EARTH_RADIUS_M = 6378137.0
+_DEG_TO_M = math.pi / 180.0 * EARTH_RADIUS_M
+_KEY_OFFSET = 1 << 30  # 讓負的格子編號也變成正數，(ix + offset) << 32 不會溢位
+
+
+def _cell_key(ix, iy):
+    """(ix, iy) → 一個 int64 key；同一個 ix 的格子在排序後是連續的一段"""
+    return ((np.asarray(ix, dtype=np.int64) + _KEY_OFFSET) << 32) | (np.asarray(iy, dtype=np.int64) + _KEY_OFFSET)
+
+
+class GridIndex:
+    """
+    均勻網格空間索引：
+    - 經緯度先以第一批資料的中心做等距投影成公尺（城市尺度誤差很小）
+    - 主體依格子 key 排序，查詢時用 searchsorted 找出候選格子再精確過濾
+    - insert() 先放進未排序的 delta 區，查詢時一起掃；delta 太大才整體重排
+    """
+
+    def __init__(self, cell_m=50.0, rebuild_ratio=0.05, min_rebuild=10000):
+        self.cell_m = float(cell_m)
+        self.rebuild_ratio = rebuild_ratio
+        self.min_rebuild = min_rebuild
+        self.ref_lon = None
+        self.ref_lat = None
+        self._cos_ref = 1.0
+
+        # 排序好的主體
+        self._keys = np.zeros(0, dtype=np.int64)
+        self._x = np.zeros(0)
+        self._y = np.zeros(0)
+        self._cls = np.zeros(0, dtype=np.int16)
+        self._ids = np.zeros(0, dtype=np.int64)
+        # 還沒排序的新資料
+        self._delta = []
+        self._delta_len = 0
+        self._next_id = 0
+
+    @classmethod
+    def from_table(cls, df, cell_m=50.0, id_col=None):
+        """從有 lon, lat, cls 欄位的 DataFrame 建索引；id 預設是列的位置"""
+        index = cls(cell_m=cell_m)
+        ids = df[id_col].to_numpy() if id_col else None
+        index.insert(df["lon"].to_numpy(), df["lat"].to_numpy(), df["cls"].to_numpy(), ids=ids)
+        index.build()
+        return index
+
+    def __len__(self):
+        return len(self._ids) + self._delta_len
+
+    # ---------- 座標轉換 ----------
+    def _project(self, lon, lat):
+        lon = np.asarray(lon, dtype=np.float64)
+        lat = np.asarray(lat, dtype=np.float64)
+        return (lon - self.ref_lon) * self._cos_ref * _DEG_TO_M, (lat - self.ref_lat) * _DEG_TO_M
+
+    def _cell(self, v):
+        return np.floor(np.asarray(v) / self.cell_m).astype(np.int64)
+
+    # ---------- 寫入 ----------
+    def insert(self, lon, lat, cls, ids=None):
+        """加入一批點，回傳它們的 id"""
+        lon = np.asarray(lon, dtype=np.float64).ravel()
+        lat = np.asarray(lat, dtype=np.float64).ravel()
+        cls = np.asarray(cls, dtype=np.int16).ravel()
+        if not (len(lon) == len(lat) == len(cls)):
+            raise ValueError("lon, lat, cls 長度必須相同")
+        if len(lon) == 0:
+            return np.zeros(0, dtype=np.int64)
+        if ids is None:
+            ids = np.arange(self._next_id, self._next_id + len(lon), dtype=np.int64)
+        else:
+            ids = np.asarray(ids, dtype=np.int64).ravel()
+        self._next_id = max(self._next_id, int(ids.max()) + 1)
+
+        if self.ref_lon is None:
+            self.ref_lon = float(np.mean(lon))
+            self.ref_lat = float(np.mean(lat))
+            self._cos_ref = math.cos(math.radians(self.ref_lat))
+
+        x, y = self._project(lon, lat)
+        self._delta.append((x, y, cls, ids))
+        self._delta_len += len(ids)
+        if self._delta_len > max(self.min_rebuild, self.rebuild_ratio * len(self._ids)):
+            self.build()
+        return ids
+
+    def build(self):
+        """把 delta 併進主體並依格子 key 重新排序"""
+        if not self._delta:
+            return
+        x = np.concatenate([self._x] + [d[0] for d in self._delta])
+        y = np.concatenate([self._y] + [d[1] for d in self._delta])
+        cls = np.concatenate([self._cls] + [d[2] for d in self._delta])
+        ids = np.concatenate([self._ids] + [d[3] for d in self._delta])
+        keys = _cell_key(self._cell(x), self._cell(y))
+        order = np.argsort(keys, kind="stable")
+        self._keys, self._x, self._y, self._cls, self._ids = keys[order], x[order], y[order], cls[order], ids[order]
+        self._delta = []
+        self._delta_len = 0
+
+    # ---------- 查詢 ----------
+    def _candidates(self, x0, y0, x1, y1):
+        """公尺座標矩形 [x0, x1] × [y0, y1] 內的候選：回傳 (x, y, cls, ids) 陣列"""
+        ix0, ix1 = int(self._cell(x0)), int(self._cell(x1))
+        iy0, iy1 = int(self._cell(y0)), int(self._cell(y1))
+        parts = []
+        if len(self._keys):
+            ixs = np.arange(ix0, ix1 + 1)
+            lo = np.searchsorted(self._keys, _cell_key(ixs, iy0), side="left")
+            hi = np.searchsorted(self._keys, _cell_key(ixs, iy1), side="right")
+            lengths = hi - lo
+            total = int(lengths.sum())
+            if total:
+                # 把多段 [lo, hi) 接成一個 index 陣列
+                starts = np.repeat(lo - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths)
+                pos = starts + np.arange(total)
+                parts.append((self._x[pos], self._y[pos], self._cls[pos], self._ids[pos]))
+        parts.extend(self._delta)
+        if not parts:
+            return np.zeros(0), np.zeros(0), np.zeros(0, dtype=np.int16), np.zeros(0, dtype=np.int64)
+        x, y, cls, ids = (np.concatenate(p) for p in zip(*parts))
+        mask = (x >= x0) & (x <= x1) & (y >= y0) & (y <= y1)
+        return x[mask], y[mask], cls[mask], ids[mask]
+
+    @staticmethod
+    def _class_mask(cls_arr, cls):
+        if cls is None:
+            return np.ones(len(cls_arr), dtype=bool)
+        return np.isin(cls_arr, np.atleast_1d(cls))
+
+    def query_bbox(self, min_lon, min_lat, max_lon, max_lat, cls=None):
+        """經緯度矩形內的點 id（可用 cls 篩選單一或多個類別）"""
+        if self.ref_lon is None:
+            return np.zeros(0, dtype=np.int64)
+        x0, y0 = self._project(min_lon, min_lat)
+        x1, y1 = self._project(max_lon, max_lat)
+        _, _, c, ids = self._candidates(float(x0), float(y0), float(x1), float(y1))
+        return ids[self._class_mask(c, cls)]
+
+    def query_radius(self, lon, lat, radius_m, cls=None):
+        """距離 (lon, lat) radius_m 公尺內的點：回傳 (ids, 距離公尺)，由近到遠"""
+        if self.ref_lon is None:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        cx, cy = (float(v) for v in self._project(lon, lat))
+        x, y, c, ids = self._candidates(cx - radius_m, cy - radius_m, cx + radius_m, cy + radius_m)
+        dist = np.hypot(x - cx, y - cy)
+        mask = (dist <= radius_m) & self._class_mask(c, cls)
+        ids, dist = ids[mask], dist[mask]
+        order = np.argsort(dist, kind="stable")
+        return ids[order], dist[order]
+
+    def query_knn(self, lon, lat, k, cls=None, max_radius_m=None):
+        """最近的 k 個點：從一格的半徑開始，每次加倍直到找滿 k 個（或超過 max_radius_m）"""
+        if len(self) == 0 or k <= 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        # 資料範圍的對角線，超過就不用再擴大
+        self.build()
+        cx, cy = (float(v) for v in self._project(lon, lat))
+        span = math.hypot(
+            max(abs(self._x.max() - cx), abs(self._x.min() - cx)),
+            max(abs(self._y.max() - cy), abs(self._y.min() - cy)),
+        )
+        limit = span if max_radius_m is None else min(span, max_radius_m)
+        radius = self.cell_m
+        while True:
+            ids, dist = self.query_radius(lon, lat, radius, cls=cls)
+            if len(ids) >= k or radius >= limit:
+                return ids[:k], dist[:k]
+            radius = min(radius * 2, limit)
+
+    def aggregate(self, min_lon, min_lat, max_lon, max_lat, cell_m=None, n_classes=10, density=False):
+        """
+        矩形範圍切成 cell_m 公尺的格子，統計每格每個類別的數量。
+        回傳 (counts[ny, nx, n_classes], x_edges_lon, y_edges_lat)；
+        density=True 時改成每平方公里的數量。第 0 列是最南邊那排格子。
+        """
+        cell_m = float(cell_m or self.cell_m)
+        if self.ref_lon is None:
+            raise ValueError("索引是空的")
+        x0, y0 = (float(v) for v in self._project(min_lon, min_lat))
+        x1, y1 = (float(v) for v in self._project(max_lon, max_lat))
+        nx = max(1, int(math.ceil((x1 - x0) / cell_m)))
+        ny = max(1, int(math.ceil((y1 - y0) / cell_m)))
+
+        x, y, c, _ = self._candidates(x0, y0, x1, y1)
+        keep = (c >= 0) & (c < n_classes)
+        gx = np.minimum(((x[keep] - x0) / cell_m).astype(np.int64), nx - 1)
+        gy = np.minimum(((y[keep] - y0) / cell_m).astype(np.int64), ny - 1)
+        flat = (gy * nx + gx) * n_classes + c[keep]
+        counts = np.bincount(flat, minlength=ny * nx * n_classes).reshape(ny, nx, n_classes)
+        if density:
+            counts = counts / (cell_m * cell_m / 1e6)
+
+        x_edges = self.ref_lon + (x0 + np.arange(nx + 1) * cell_m) / (self._cos_ref * _DEG_TO_M)
+        y_edges = self.ref_lat + (y0 + np.arange(ny + 1) * cell_m) / _DEG_TO_M
+        return counts, x_edges, y_edges
@@ -0,0 +1,315 @@
+# ui_playground/sweep.py
+# 超參數掃描：把 grid / random 的設定排成佇列，同時開好幾個 train_visdrone.py process，
+# 每個 process 分到固定的 CPU 核心 / 執行緒數，有 slot 空出來就排下一組。
+# 每個 run 都有自己的 train_runs 列與 runs/train/run_{id}/；每個 epoch 的 mAP 從 train_epochs 讀，
+# 跑了 grace 個 epoch 之後還低於其他 run 同一個 epoch 的中位數，就放 STOP 檔提早結束（median stopping）。
+#
+#   python sweep.py ../config/sweep_lr.yaml --parallel 4
+#   python sweep.py spec.yaml --parallel 3 --threads 4 --device cpu --grace-epochs 5
+#
+# spec（YAML）：
+#   name: lr_imgsz
+#   mode: grid            # grid = 所有組合；random = 隨機抽 trials 組
+#   trials: 8             # random 才用
+#   seed: 0
+#   base: {epochs: 30, batch: 16}
+#   params:
+#     lr0: [0.01, 0.005, 0.002]                 # grid / random 都可以用清單
+#     imgsz: [640, 960]
+#     # lr0: {low: 0.0005, high: 0.02, log: true} # random 才能用範圍
+import argparse
+import inspect
+import itertools
+import json
+import math
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Optional
+
+import yaml
+
+import train_visdrone  # 也會把 PostgreSQL/ 加到匯入路徑
+from db_utils import fetch_train_epochs, insert_train_run
+from prepare_shards import load_or_build
+from train_visdrone import DATA_YAML, RUNS_DIR, STOP_FILENAME, safe_log
+
+SWEEPS_DIR = RUNS_DIR / "sweeps"
+# train_visdrone.main 裡可以掃的參數（其餘的是 sweep 自己決定的）
+SWEEPABLE = {"model_name", "epochs", "imgsz", "batch", "lr0", "use_shards"}
+
+
+def _sample(spec, rng):
+    if isinstance(spec, list):
+        return rng.choice(spec)
+    if isinstance(spec, dict):
+        low, high = float(spec["low"]), float(spec["high"])
+        value = math.exp(rng.uniform(math.log(low), math.log(high))) if spec.get("log") else rng.uniform(low, high)
+        return int(round(value)) if spec.get("int") else value
+    return spec
+
+
+def expand_spec(spec):
+    """spec dict → 設定清單（每組是 train_visdrone.main 的 keyword 參數）"""
+    params = spec.get("params") or {}
+    unknown = set(params) | set(spec.get("base") or {})
+    unknown -= SWEEPABLE
+    if unknown:
+        raise ValueError(f"不能掃的參數：{', '.join(sorted(unknown))}（可用：{', '.join(sorted(SWEEPABLE))}）")
+    base = dict(spec.get("base") or {})
+    mode = spec.get("mode", "grid")
+    if mode == "grid":
+        for name, values in params.items():
+            if not isinstance(values, list):
+                raise ValueError(f"grid 模式的 {name} 要是清單")
+        names = list(params)
+        return [{**base, **dict(zip(names, combo))} for combo in itertools.product(*(params[n] for n in names))]
+    if mode == "random":
+        rng = random.Random(spec.get("seed", 0))
+        return [{**base, **{n: _sample(s, rng) for n, s in params.items()}} for _ in range(int(spec["trials"]))]
+    raise ValueError(f"不支援的 mode：{mode}")
+
+
+def median_stop(curve, peer_curves, grace_epochs, min_peers):
+    """
+    median stopping rule：這個 run 到目前為止最好的 mAP50-95，
+    比其他 run 在同一個 epoch 數時的最好值的中位數還低 → 該停了。
+    還沒跑滿 grace_epochs 或能比的 run 不夠多就不判斷。
+    """
+    e = len(curve)
+    if e < grace_epochs:
+        return False
+    peers = [max(p[:e]) for p in peer_curves if len(p) >= e]
+    if len(peers) < min_peers:
+        return False
+    return max(curve) < statistics.median(peers)
+
+
+@dataclass
+class Trial:
+    index: int
+    config: dict
+    run_id: Optional[int] = None
+    proc: Optional[subprocess.Popen] = None
+    slot: Optional[int] = None
+    status: str = "queued"  # queued / running / stopping / finished / stopped / failed
+    curve: list = field(default_factory=list)  # 每個 epoch 的 val mAP50-95
+    started: Optional[float] = None
+    seconds: Optional[float] = None
+
+    @property
+    def run_dir(self):
+        return RUNS_DIR / f"run_{self.run_id}"
+
+
+class SweepScheduler:
+    def __init__(self, name, configs, parallel, threads, workers, device=None, grace_epochs=5, min_peers=2,
+                 poll_seconds=30):
+        self.name = name
+        self.trials = [Trial(i, cfg) for i, cfg in enumerate(configs)]
+        self.parallel = parallel
+        self.threads = threads
+        self.workers = workers
+        self.device = device
+        self.grace_epochs = grace_epochs
+        self.min_peers = min_peers
+        self.poll_seconds = poll_seconds
+        self.sweep_dir = SWEEPS_DIR / name
+        self.sweep_dir.mkdir(parents=True, exist_ok=True)
+        self._free_slots = list(range(parallel))
+
+    def _cores_for(self, slot):
+        """slot k 固定用第 k 段核心，互不搶（核心不夠分就不綁）"""
+        n_cpu = os.cpu_count() or 1
+        if self.threads * self.parallel > n_cpu:
+            return None
+        return set(range(slot * self.threads, (slot + 1) * self.threads))
+
+    @staticmethod
+    def _merged(cfg):
+        """設定補上 train_visdrone.main 的預設值"""
+        defaults = {k: v.default for k, v in inspect.signature(train_visdrone.main).parameters.items()}
+        return {**defaults, **cfg}
+
+    def _prepare_shards(self):
+        """
+        開跑前先把每個用得到的 imgsz 的 shard 建好：不然第一輪的 N 個 process 會同時
+        build_shards 同一個 <split>/shards/<imgsz>/，互相刪掉對方正在寫的檔案。
+        """
+        merged = [self._merged(t.config) for t in self.trials]
+        sizes = sorted({int(m["imgsz"]) for m in merged if m["use_shards"]})
+        if not sizes:
+            return
+        with open(DATA_YAML, "r", encoding="utf-8") as f:
+            data = yaml.safe_load(f)
+        # 跟 ShardTrainer.build_dataset 一樣：split 目錄 = images 目錄的上一層
+        split_dirs = [(Path(data["path"]) / data[key]).parent for key in ("train", "val")]
+        for imgsz in sizes:
+            for split_dir in split_dirs:
+                load_or_build(split_dir, imgsz)
+
+    def _launch(self, trial):
+        cfg = trial.config
+        merged = self._merged(cfg)
+        trial.run_id = insert_train_run(
+            model_name=merged["model_name"],
+            data_yaml=str(DATA_YAML),
+            epochs=merged["epochs"],
+            imgsz=merged["imgsz"],
+            batch=merged["batch"],
+            lr0=merged["lr0"],
+            notes=f"sweep {self.name} #{trial.index}: {json.dumps(cfg, ensure_ascii=False)}",
+        )
+        cmd = [
+            sys.executable,
+            str(Path(__file__).with_name("train_visdrone.py")),
+            "--run-id", str(trial.run_id),
+            "--threads", str(self.threads),
+            "--workers", str(self.workers),
+            "--model", str(merged["model_name"]),
+            "--epochs", str(merged["epochs"]),
+            "--imgsz", str(merged["imgsz"]),
+            "--batch", str(merged["batch"]),
+            "--lr0", str(merged["lr0"]),
+            "--shards" if merged["use_shards"] else "--no-shards",
+        ]
+        if self.device is not None:
+            cmd += ["--device", str(self.device)]
+        env = dict(os.environ)
+        for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+            env[var] = str(self.threads)
+        trial.slot = self._free_slots.pop(0)
+        log = open(self.sweep_dir / f"trial_{trial.index:03d}_run_{trial.run_id}.log", "w", encoding="utf-8")
+        trial.proc = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT, env=env,
+                                      cwd=str(Path(__file__).parent))
+        log.close()  # 子程序有自己的 handle
+        cores = self._cores_for(trial.slot)
+        if cores and hasattr(os, "sched_setaffinity"):
+            # DataLoader 的 worker 之後才 fork 出來，會繼承同一組核心
+            os.sched_setaffinity(trial.proc.pid, cores)
+        trial.status = "running"
+        trial.started = time.perf_counter()
+        print(f"[SWEEP] #{trial.index} → run_{trial.run_id}（slot {trial.slot}）{cfg}")
+
+    def _refresh_curve(self, trial):
+        try:
+            rows = fetch_train_epochs(trial.run_id)
+        except Exception as e:
+            print(f"[SWEEP] 讀不到 run_{trial.run_id} 的 train_epochs：{e}")
+            return
+        trial.curve = [r["map5095"] for r in rows if r["map5095"] is not None]
+
+    def _request_stop(self, trial):
+        trial.run_dir.mkdir(parents=True, exist_ok=True)
+        (trial.run_dir / STOP_FILENAME).touch()
+        trial.status = "stopping"
+        print(f"[SWEEP] #{trial.index} run_{trial.run_id} 在 epoch {len(trial.curve)} 的 mAP50-95 "
+              f"{max(trial.curve):.4f} 低於中位數，提早結束")
+        safe_log("INFO", "sweep.py", f"sweep {self.name}：run_{trial.run_id} 低於中位數，提早結束",
+                 run_id=trial.run_id)
+
+    def _poll(self):
+        active = [t for t in self.trials if t.status in ("running", "stopping")]
+        for trial in active:
+            self._refresh_curve(trial)
+            code = trial.proc.poll()
+            if code is None:
+                continue
+            trial.seconds = time.perf_counter() - trial.started
+            if code != 0:
+                trial.status = "failed"
+            else:
+                trial.status = "stopped" if trial.status == "stopping" else "finished"
+            self._free_slots.append(trial.slot)
+            self._free_slots.sort()
+            print(f"[SWEEP] #{trial.index} run_{trial.run_id} {trial.status}（exit {code}，{trial.seconds / 60:.1f} 分）")
+
+        for trial in self.trials:
+            if trial.status != "running":
+                continue
+            peers = [t.curve for t in self.trials if t is not trial and t.curve]
+            if median_stop(trial.curve, peers, self.grace_epochs, self.min_peers):
+                self._request_stop(trial)
+
+    def run(self):
+        self._prepare_shards()
+        queue = list(self.trials)
+        try:
+            while True:
+                self._poll()
+                while queue and self._free_slots:
+                    self._launch(queue.pop(0))
+                if not queue and all(t.status in ("finished", "stopped", "failed") for t in self.trials):
+                    break
+                time.sleep(self.poll_seconds)
+        except KeyboardInterrupt:
+            print("[SWEEP] 中斷，結束所有還在跑的訓練")
+            for t in self.trials:
+                if t.proc is not None and t.proc.poll() is None:
+                    t.proc.terminate()
+            raise
+        finally:
+            self.write_summary()
+        return self.trials
+
+    def write_summary(self):
+        rows = []
+        for t in self.trials:
+            rows.append({
+                "index": t.index,
+                "run_id": t.run_id,
+                "status": t.status,
+                "config": t.config,
+                "epochs_run": len(t.curve),
+                "best_map5095": max(t.curve) if t.curve else None,
+                "minutes": round(t.seconds / 60, 1) if t.seconds else None,
+            })
+        rows.sort(key=lambda r: -(r["best_map5095"] or -1))
+        with open(self.sweep_dir / "summary.json", "w", encoding="utf-8") as f:
+            json.dump(rows, f, ensure_ascii=False, indent=2)
+        print(f"\n=== sweep {self.name}（{self.sweep_dir / 'summary.json'}）===")
+        for r in rows:
+            score = f"{r['best_map5095']:.4f}" if r["best_map5095"] is not None else "   -  "
+            print(f"  run_{r['run_id']}  {r['status']:<9} mAP50-95={score}  epochs={r['epochs_run']:<3} {r['config']}")
+        return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="平行超參數掃描（grid / random + median stopping）")
+    parser.add_argument("spec", help="掃描設定 YAML")
+    parser.add_argument("--parallel", type=int, default=2, help="同時跑幾個訓練")
+    parser.add_argument("--threads", type=int, default=None, help="每個訓練的 CPU 執行緒數（預設 = 核心數 / parallel）")
+    parser.add_argument("--workers", type=int, default=None, help="每個訓練的 DataLoader worker 數（預設 = threads / 2）")
+    parser.add_argument("--device", default=None)
+    parser.add_argument("--grace-epochs", type=int, default=5, help="至少跑幾個 epoch 才判斷要不要停")
+    parser.add_argument("--min-peers", type=int, default=2, help="至少要有幾個 run 可以比才判斷")
+    parser.add_argument("--poll", type=float, default=30, help="幾秒檢查一次進度")
+    args = parser.parse_args()
+
+    with open(args.spec, "r", encoding="utf-8") as f:
+        spec = yaml.safe_load(f)
+    configs = expand_spec(spec)
+    name = spec.get("name") or Path(args.spec).stem
+    threads = args.threads or max(1, (os.cpu_count() or 1) // args.parallel)
+    workers = args.workers if args.workers is not None else max(1, threads // 2)
+    print(f"[SWEEP] {name}：{len(configs)} 組設定，同時 {args.parallel} 個，每個 {threads} 執行緒 / {workers} worker")
+    SweepScheduler(
+        name,
+        configs,
+        parallel=args.parallel,
+        threads=threads,
+        workers=workers,
+        device=args.device,
+        grace_epochs=args.grace_epochs,
+        min_peers=args.min_peers,
+        poll_seconds=args.poll,
+    ).run()
+
+
+if __name__ == "__main__":
+    main()
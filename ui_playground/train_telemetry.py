@@ -0,0 +1,122 @@
+# ui_playground/train_telemetry.py
+# 訓練過程的每個 epoch 一列寫進 train_epochs（走 db_utils 的背景批次寫入器，不會拖慢訓練）：
+# img/s、等 DataLoader 的時間 vs 計算時間、epoch 總時間、最高記憶體、loss、val mAP。
+# 用 ultralytics 的 callback 掛上去，不用改 trainer。
+#
+#   telemetry = EpochTelemetry(run_id)
+#   telemetry.attach(model)
+#   results = model.train(...)
+#   map50, map5095 = telemetry.final_maps(results)
+import time
+
+from perf_utils import peak_rss_mb
+
+
+class EpochTelemetry:
+    """
+    每個 batch 記兩段時間：
+    - 等資料：上一個 batch 結束（或 epoch 開始）→ 這個 batch 拿到手
+    - 計算：batch 拿到手 → forward / backward / optimizer step 做完
+    GPU 是非同步的，計算時間是 CPU 這邊看到的 wall time。
+    """
+
+    def __init__(self, run_id):
+        self.run_id = run_id
+        self.epochs = []  # 寫出去的每一列（dict），訓練完可以直接拿來找最佳 mAP
+        self._t_epoch = self._t_mark = self._t_train_end = None
+        self._wait = self._compute = 0.0
+        self._batches = 0
+
+    def attach(self, model):
+        model.add_callback("on_train_epoch_start", self.on_train_epoch_start)
+        model.add_callback("on_train_batch_start", self.on_train_batch_start)
+        model.add_callback("on_train_batch_end", self.on_train_batch_end)
+        model.add_callback("on_train_epoch_end", self.on_train_epoch_end)
+        model.add_callback("on_fit_epoch_end", self.on_fit_epoch_end)
+        return self
+
+    # ---------- callbacks ----------
+    def on_train_epoch_start(self, trainer):
+        self._t_epoch = self._t_mark = time.perf_counter()
+        self._t_train_end = None
+        self._wait = self._compute = 0.0
+        self._batches = 0
+
+    def on_train_batch_start(self, trainer):
+        now = time.perf_counter()
+        self._wait += now - self._t_mark
+        self._t_mark = now
+
+    def on_train_batch_end(self, trainer):
+        now = time.perf_counter()
+        self._compute += now - self._t_mark
+        self._t_mark = now
+        self._batches += 1
+
+    def on_train_epoch_end(self, trainer):
+        self._t_train_end = time.perf_counter()
+
+    def on_fit_epoch_end(self, trainer):
+        """驗證也跑完了（trainer.metrics 已更新），整理成一列送出"""
+        if self._t_epoch is None:
+            return
+        now = time.perf_counter()
+        train_end = self._t_train_end or now
+        train_seconds = train_end - self._t_epoch
+        n_images = len(trainer.train_loader.dataset)
+        metrics = trainer.metrics or {}
+        losses = {}
+        if getattr(trainer, "tloss", None) is not None:
+            losses = trainer.label_loss_items(trainer.tloss, prefix="train")
+        row = {
+            "run_id": self.run_id,
+            "epoch": trainer.epoch + 1,
+            "epoch_seconds": now - self._t_epoch,
+            "train_seconds": train_seconds,
+            "val_seconds": now - train_end,
+            "data_wait_seconds": self._wait,
+            "compute_seconds": self._compute,
+            "n_batches": self._batches,
+            "n_images": n_images,
+            "img_per_s": n_images / train_seconds if train_seconds > 0 else None,
+            "peak_rss_mb": peak_rss_mb(),
+            "box_loss": losses.get("train/box_loss"),
+            "cls_loss": losses.get("train/cls_loss"),
+            "dfl_loss": losses.get("train/dfl_loss"),
+            "map50": metrics.get("metrics/mAP50(B)"),
+            "map5095": metrics.get("metrics/mAP50-95(B)"),
+            "precision": metrics.get("metrics/precision(B)"),
+            "recall": metrics.get("metrics/recall(B)"),
+            "lr": (getattr(trainer, "lr", None) or {}).get("lr/pg0"),
+        }
+        row = {k: float(v) if hasattr(v, "item") else v for k, v in row.items()}
+        self.epochs.append(row)
+        print(
+            f"[TELEMETRY] epoch {row['epoch']}: {row['epoch_seconds']:.1f}s，"
+            f"{row['img_per_s'] or 0:.1f} img/s，等資料 {self._wait:.1f}s / 計算 {self._compute:.1f}s"
+        )
+        try:
+            from db_utils import write_train_epoch_async
+
+            write_train_epoch_async(row)
+        except Exception as e:
+            print(f"[DB] 無法寫入 train_epochs：{e}")
+
+    # ---------- 訓練結束 ----------
+    def best_epoch(self):
+        """mAP50-95 最高的那一列（沒有驗證結果就回傳 None）"""
+        scored = [r for r in self.epochs if r["map5095"] is not None]
+        return max(scored, key=lambda r: r["map5095"]) if scored else None
+
+    def final_maps(self, results=None):
+        """
+        (best_map50, best_map5095)：優先用 model.train() 回傳的最終驗證（best.pt 在 val 上），
+        沒有的話用各 epoch 裡 mAP50-95 最高的那一個。
+        """
+        box = getattr(results, "box", None)
+        if box is not None:
+            return float(box.map50), float(box.map)
+        best = self.best_epoch()
+        if best is None:
+            return None, None
+        return best["map50"], best["map5095"]
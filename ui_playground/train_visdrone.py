@@ -1,4 +1,5 @@
 from pathlib import Path
+import argparse
 import sys
 import traceback
 
@@ -9,7 +10,9 @@ PROJECT_ROOT = Path(__file__).resolve().parents[1]
 POSTGRESQL_DIR = PROJECT_ROOT / "PostgreSQL"
 sys.path.append(str(POSTGRESQL_DIR))
 
-from db_utils import insert_train_run, update_train_run_finished, write_log
+from db_utils import insert_train_run, shutdown_writer, update_train_run_finished, write_log
+from shard_dataset import ShardTrainer
+from train_telemetry import EpochTelemetry
 
 # ====== 這裡填你這次訓練的設定 ======
 MODEL_NAME = "yolov8n.pt"  # 或者使用你已有的 best.pt 當起始
@@ -21,9 +24,14 @@ LR0 = 0.01
 TRAIN_IMGS = None  # 如果你知道訓練集張數可以填，先留 None 也可以
 VAL_IMGS = None
 NOTES = "baseline training from Colab settings"  # 備註，可自由填
+# True = 從 prepare_shards 預先解碼好的 memmap shard 讀影像（第一次會先建，資料沒變就一直沿用），
+# False = 照 ultralytics 原本的方式每個 epoch 讀 JPEG
+USE_SHARDS = True
 
 # 權重輸出位置，會變成 runs/train/run_xxx/weights/best.pt
 RUNS_DIR = PROJECT_ROOT / "runs" / "train"
+# run 目錄裡出現這個檔案，目前的 epoch 跑完就提早結束（sweep.py 用它停掉沒希望的 run）
+STOP_FILENAME = "STOP"
 
 
 def safe_log(level, source, message, run_id=None, detail=None):
@@ -33,40 +41,74 @@ def safe_log(level, source, message, run_id=None, detail=None):
         print(f"[LOG ERROR] {e}")
 
 
-def main():
+def _stop_if_requested(trainer):
+    """每個 epoch 結束時檢查 STOP 檔；設 trainer.stop 後 ultralytics 會照常存權重、做最後驗證再結束"""
+    if (Path(trainer.save_dir) / STOP_FILENAME).exists():
+        print(f"[TRAIN] 偵測到 {STOP_FILENAME}，epoch {trainer.epoch + 1} 後提早結束")
+        trainer.stop = True
+
+
+def main(
+    model_name=MODEL_NAME,
+    epochs=EPOCHS,
+    imgsz=IMGSZ,
+    batch=BATCH,
+    lr0=LR0,
+    notes=NOTES,
+    use_shards=USE_SHARDS,
+    run_id=None,
+    threads=None,
+    workers=8,
+    device=None,
+):
+    """
+    跑一次訓練。參數沒給就用檔案上方的設定；sweep.py 會用不同的參數同時開好幾個 process。
+    run_id 給了就沿用那筆 train_runs（由呼叫端先建好），threads 限制 torch 的 CPU 執行緒數。
+    """
+    if threads:
+        import torch
+
+        torch.set_num_threads(threads)
+
     # 1. 在 DB 裡建立一筆訓練紀錄，拿到 run_id
-    run_id = insert_train_run(
-        model_name=MODEL_NAME,
-        data_yaml=str(DATA_YAML),
-        epochs=EPOCHS,
-        imgsz=IMGSZ,
-        batch=BATCH,
-        lr0=LR0,
-        train_imgs=TRAIN_IMGS,
-        val_imgs=VAL_IMGS,
-        notes=NOTES,
-    )
+    if run_id is None:
+        run_id = insert_train_run(
+            model_name=model_name,
+            data_yaml=str(DATA_YAML),
+            epochs=epochs,
+            imgsz=imgsz,
+            batch=batch,
+            lr0=lr0,
+            train_imgs=TRAIN_IMGS,
+            val_imgs=VAL_IMGS,
+            notes=notes,
+        )
     safe_log("INFO", "train_visdrone.py", f"開始訓練 run_id={run_id}", run_id=run_id)
 
     try:
         # 2. 建 YOLO 模型 & 開始訓練
-        model = YOLO(MODEL_NAME)
+        model = YOLO(model_name)
+        # 每個 epoch 的吞吐量 / loss / mAP 寫進 train_epochs
+        telemetry = EpochTelemetry(run_id).attach(model)
+        model.add_callback("on_fit_epoch_end", _stop_if_requested)
         results = model.train(
             data=str(DATA_YAML),
-            epochs=EPOCHS,
-            imgsz=IMGSZ,
-            batch=BATCH,
-            lr0=LR0,
+            epochs=epochs,
+            imgsz=imgsz,
+            batch=batch,
+            lr0=lr0,
+            workers=workers,
+            device=device,
             project=str(RUNS_DIR),
             name=f"run_{run_id}",  # 每次訓練的資料夾用 run_id 區分
+            trainer=ShardTrainer if use_shards else None,
         )
 
         # 3. 推測 best.pt 的路徑
         weights_path = RUNS_DIR / f"run_{run_id}" / "weights" / "best.pt"
 
-        # （進階）如果你有從 results 裡抓 mAP，也可以填進來
-        best_map50 = None
-        best_map5095 = None
+        # 最終驗證（best.pt）的 mAP；拿不到就用各 epoch 裡最好的
+        best_map50, best_map5095 = telemetry.final_maps(results)
 
         # 4. 更新 DB，標記這次訓練已完成
         update_train_run_finished(
@@ -79,7 +121,7 @@ def main():
         safe_log(
             "INFO",
             "train_visdrone.py",
-            f"訓練完成 run_id={run_id}, weights={weights_path}",
+            f"訓練完成 run_id={run_id}, weights={weights_path}, mAP50={best_map50}, mAP50-95={best_map5095}",
             run_id=run_id,
         )
 
@@ -88,7 +130,27 @@ def main():
         err_detail = traceback.format_exc()
         safe_log("ERROR", "train_visdrone.py", err_msg, run_id=run_id, detail=err_detail)
         raise  # 讓錯誤照樣丟出來，你在 Terminal 可以看到
+    finally:
+        shutdown_writer()  # 等 train_epochs 還在佇列裡的列寫完
+    return run_id
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="YOLO 訓練（沒給的參數用檔案上方的設定）")
+    parser.add_argument("--model", dest="model_name", default=MODEL_NAME)
+    parser.add_argument("--epochs", type=int, default=EPOCHS)
+    parser.add_argument("--imgsz", type=int, default=IMGSZ)
+    parser.add_argument("--batch", type=int, default=BATCH)
+    parser.add_argument("--lr0", type=float, default=LR0)
+    parser.add_argument("--notes", default=NOTES)
+    parser.add_argument("--run-id", type=int, default=None, help="沿用已經建好的 train_runs.id")
+    parser.add_argument("--threads", type=int, default=None, help="torch 的 CPU 執行緒數")
+    parser.add_argument("--workers", type=int, default=8, help="DataLoader 的 worker 數")
+    parser.add_argument("--device", default=None, help="cpu / 0 / 0,1 …（預設由 ultralytics 自動選）")
+    parser.add_argument("--shards", dest="use_shards", action=argparse.BooleanOptionalAction, default=USE_SHARDS,
+                        help="從 prepare_shards 的 memmap shard 讀影像")
+    return parser.parse_args(argv)
 
 
 if __name__ == "__main__":
-    main()
+    main(**vars(parse_args()))
@@ -0,0 +1,446 @@
+# ui_playground/video_infer.py
+# 影片 / 連續影格（VisDrone VID、MOT 的 sequences/<name>/*.jpg）推論：
+# 背景執行緒解碼，只有關鍵影格（每 N 格，或畫面切換時）跑完整偵測，
+# 中間的影格用輕量的 IoU tracker 內插（或外推）框的位置，並給每個物件 track_id。
+# 結果逐段寫進 CSV，也可以同時 COPY 進 detections（frame / track_id 欄位）。
+#
+#   python video_infer.py clip.mp4 --out ../results/clip_tracks.csv --every 5
+#   python video_infer.py D:/Sandy/VisDrone/VID/sequences/uav0000086_00000_v --fps 30 --out seq.csv --db
+import argparse
+import os
+import queue
+import threading
+import time
+from dataclasses import dataclass
+
+import cv2
+import numpy as np
+import pandas as pd
+
+from backend import MODEL_RUN_ID, run_inference_batch, safe_log
+from infer_dir import decode_image, list_images
+
+OUT_COLUMNS = ["frame", "image", "track_id", "keyframe", "x1", "y1", "x2", "y2", "score", "cls"]
+
+
+# ========= 解碼 =========
+class FrameReader:
+    """
+    背景執行緒解碼，依序產生 (frame_idx, RGB ndarray 或 None)。
+    retrieve_every > 1 時，不是它倍數的影格只 grab() 不解碼（回傳 None），
+    沒開畫面切換偵測時可以省掉大部分的解碼時間；retrieve() 失敗或讀不到 / 解不開的影格也是 None。
+    """
+
+    def __init__(self, source, fps=None, retrieve_every=1, max_frames=None, queue_size=64):
+        self.source = source
+        self.retrieve_every = max(1, retrieve_every)
+        self.max_frames = max_frames
+        self._q = queue.Queue(maxsize=queue_size)
+        self._stop = threading.Event()
+
+        if os.path.isdir(source):
+            self._paths = list_images(source)
+            self._cap = None
+            self.fps = fps or 30.0
+            self.n_frames = len(self._paths)
+        else:
+            self._paths = None
+            self._cap = cv2.VideoCapture(source)
+            if not self._cap.isOpened():
+                raise ValueError(f"無法開啟影片：{source}")
+            self.fps = fps or self._cap.get(cv2.CAP_PROP_FPS) or 30.0
+            self.n_frames = int(self._cap.get(cv2.CAP_PROP_FRAME_COUNT)) or None
+        if max_frames is not None and self.n_frames is not None:
+            self.n_frames = min(self.n_frames, max_frames)
+
+        self._thread = threading.Thread(target=self._run, name="video-decode", daemon=True)
+        self._thread.start()
+
+    def _frames(self):
+        if self._paths is not None:
+            for idx, path in enumerate(self._paths):
+                if idx % self.retrieve_every != 0:
+                    yield idx, None
+                    continue
+                try:
+                    frame = decode_image(path)
+                except (OSError, ValueError) as e:
+                    # 跟影片 retrieve() 失敗一樣回 None，壞掉的一格讓 tracker 內插過去，不中斷整段
+                    print(f"[SKIP] {e}")
+                    frame = None
+                yield idx, frame
+            return
+        idx = 0
+        while self._cap.grab():
+            if idx % self.retrieve_every == 0:
+                ok, bgr = self._cap.retrieve()
+                yield idx, cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB) if ok else None
+            else:
+                yield idx, None
+            idx += 1
+
+    def _run(self):
+        try:
+            for idx, frame in self._frames():
+                if self._stop.is_set() or (self.max_frames is not None and idx >= self.max_frames):
+                    break
+                self._q.put((idx, frame))
+        except Exception as e:
+            self._q.put(e)
+        finally:
+            if self._cap is not None:
+                self._cap.release()
+            self._q.put(None)
+
+    def __iter__(self):
+        while True:
+            item = self._q.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def close(self):
+        self._stop.set()
+        # 讓卡在 put() 的解碼執行緒可以結束
+        while self._thread.is_alive():
+            try:
+                self._q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+
+def scene_signature(frame, size=(64, 36)):
+    """縮成很小的灰階圖，用來比較兩格畫面差多少"""
+    small = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+    return small.mean(axis=2, dtype=np.float32)
+
+
+# ========= 追蹤 =========
+def box_iou(a, b):
+    """(N, 4) × (M, 4) 的 IoU 矩陣"""
+    a = np.asarray(a, dtype=np.float32).reshape(-1, 4)
+    b = np.asarray(b, dtype=np.float32).reshape(-1, 4)
+    w = (np.minimum(a[:, None, 2], b[None, :, 2]) - np.maximum(a[:, None, 0], b[None, :, 0])).clip(0)
+    h = (np.minimum(a[:, None, 3], b[None, :, 3]) - np.maximum(a[:, None, 1], b[None, :, 1])).clip(0)
+    inter = w * h
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    return inter / np.maximum(area_a[:, None] + area_b[None, :] - inter, 1e-6)
+
+
+def _center_distance(a, b):
+    """(N, 4) × (M, 4) 的中心點距離，除以 a 框的對角線長"""
+    ca = (a[:, :2] + a[:, 2:]) / 2
+    cb = (b[:, :2] + b[:, 2:]) / 2
+    diag = np.hypot(a[:, 2] - a[:, 0], a[:, 3] - a[:, 1])
+    return np.hypot(*(ca[:, None, :] - cb[None, :, :]).transpose(2, 0, 1)) / np.maximum(diag, 1e-6)[:, None]
+
+
+@dataclass
+class Track:
+    track_id: int
+    xyxy: np.ndarray  # 最後一次對到偵測框時的位置
+    cls: int
+    score: float
+    frame: int  # 最後一次對到偵測框的影格
+    velocity: np.ndarray  # 每格的位移（x1, y1, x2, y2）
+    hits: int = 1
+    misses: int = 0
+
+    def predict(self, frame_idx):
+        """等速模型推算 frame_idx 的位置"""
+        return self.xyxy + self.velocity * (frame_idx - self.frame)
+
+
+class IouTracker:
+    """
+    只在關鍵影格更新的 IoU tracker：
+    - 用等速模型把每條 track 推到目前影格，跟偵測框做同類別的貪婪 IoU 配對，
+      剩下的再用中心點距離（max_center_distance 倍的框對角線內）配一次
+    - 配到的更新位置與速度；沒配到的偵測開新 track；連續 max_misses 個關鍵影格沒配到就結束
+    """
+
+    def __init__(self, iou_threshold=0.3, max_center_distance=1.0, max_misses=2, velocity_smoothing=0.5):
+        self.iou_threshold = iou_threshold
+        self.max_center_distance = max_center_distance
+        self.max_misses = max_misses
+        self.velocity_smoothing = velocity_smoothing
+        self.tracks = []
+        self._next_id = 1
+
+    def update(self, frame_idx, xyxy, conf, cls):
+        """
+        用關鍵影格的偵測結果更新，回傳：
+        - det_track_ids：每個偵測框對應的 track_id
+        - matched：[(track, 上次的影格, 上次的框), ...]，給呼叫端內插中間影格
+        """
+        xyxy = np.asarray(xyxy, dtype=np.float32).reshape(-1, 4)
+        det_ids = np.zeros(len(xyxy), dtype=np.int64)
+        matched = []
+        used_tracks, used_dets = set(), set()
+
+        if self.tracks and len(xyxy):
+            pred = np.stack([t.predict(frame_idx) for t in self.tracks])
+            iou = box_iou(pred, xyxy)
+            track_cls = np.array([t.cls for t in self.tracks])
+            iou[track_cls[:, None] != np.asarray(cls)[None, :]] = 0.0
+            ti, di = np.nonzero(iou >= self.iou_threshold)
+            pairs = [(int(ti[k]), int(di[k])) for k in np.argsort(-iou[ti, di], kind="stable")]
+
+            # 第二輪：關鍵影格間隔大、物件移動快時 IoU 可能是 0，
+            # 改用中心點距離（以框的大小正規化）配對，第一次配上之後就有速度可以預測了
+            dist = _center_distance(pred, xyxy)
+            dist[track_cls[:, None] != np.asarray(cls)[None, :]] = np.inf
+            ti, di = np.nonzero(dist <= self.max_center_distance)
+            pairs += [(int(ti[k]), int(di[k])) for k in np.argsort(dist[ti, di], kind="stable")]
+
+            for t, d in pairs:
+                if t in used_tracks or d in used_dets:
+                    continue
+                used_tracks.add(t)
+                used_dets.add(d)
+                track = self.tracks[t]
+                prev_frame, prev_box = track.frame, track.xyxy
+                v = (xyxy[d] - prev_box) / max(1, frame_idx - prev_frame)
+                a = self.velocity_smoothing if track.hits > 1 else 1.0
+                track.velocity = a * v + (1.0 - a) * track.velocity
+                track.xyxy, track.frame = xyxy[d].copy(), frame_idx
+                track.score, track.hits, track.misses = float(conf[d]), track.hits + 1, 0
+                det_ids[d] = track.track_id
+                matched.append((track, prev_frame, prev_box))
+
+        survivors = []
+        for t, track in enumerate(self.tracks):
+            if t not in used_tracks:
+                track.misses += 1
+                if track.misses > self.max_misses:
+                    continue
+            survivors.append(track)
+        for d in range(len(xyxy)):
+            if d in used_dets:
+                continue
+            track = Track(self._next_id, xyxy[d].copy(), int(cls[d]), float(conf[d]), frame_idx,
+                          np.zeros(4, dtype=np.float32))
+            self._next_id += 1
+            survivors.append(track)
+            det_ids[d] = track.track_id
+        self.tracks = survivors
+        return det_ids, matched
+
+    def reset(self):
+        """清掉所有 track（track_id 繼續往上編，不會跟之前的重複）"""
+        self.tracks = []
+
+    def extrapolate(self, frame_idx):
+        """上個關鍵影格有對到的 track 推到 frame_idx：(ids, xyxy, score, cls)"""
+        live = [t for t in self.tracks if t.misses == 0]
+        if not live:
+            return np.zeros(0, dtype=np.int64), np.zeros((0, 4), dtype=np.float32), np.zeros(0), np.zeros(0)
+        return (
+            np.array([t.track_id for t in live], dtype=np.int64),
+            np.stack([t.predict(frame_idx) for t in live]).astype(np.float32),
+            np.array([t.score for t in live], dtype=np.float32),
+            np.array([t.cls for t in live], dtype=np.int16),
+        )
+
+
+# ========= 輸出 =========
+class TrackWriter:
+    """逐格收集結果，每 flush_frames 格 append 一次 CSV（+ 選擇性 COPY 進 detections）"""
+
+    def __init__(self, out_path, image_name, to_db=False, run_id=MODEL_RUN_ID, flush_frames=300):
+        self.out_path = out_path
+        self.image_name = image_name
+        self.run_id = run_id
+        self.flush_frames = flush_frames
+        self.rows = 0
+        self._parts = []
+        self._frames_since_flush = 0
+        self._copy = None
+        if to_db:
+            from db_utils import copy_detections
+
+            self._copy = copy_detections
+        if out_path:
+            os.makedirs(os.path.dirname(os.path.abspath(out_path)), exist_ok=True)
+            with open(out_path, "w", newline="", encoding="utf-8") as f:
+                f.write(",".join(OUT_COLUMNS) + "\n")
+
+    def add(self, frame_idx, track_ids, xyxy, score, cls, keyframe):
+        if len(track_ids):
+            self._parts.append((frame_idx, keyframe, track_ids, xyxy, score, cls))
+        self._frames_since_flush += 1
+        if self._frames_since_flush >= self.flush_frames:
+            self.flush()
+
+    def flush(self):
+        self._frames_since_flush = 0
+        if not self._parts:
+            return
+        counts = [len(p[2]) for p in self._parts]
+        xyxy = np.concatenate([p[3] for p in self._parts])
+        df = pd.DataFrame(
+            {
+                "frame": np.repeat([p[0] for p in self._parts], counts),
+                "image": self.image_name,
+                "track_id": np.concatenate([p[2] for p in self._parts]),
+                "keyframe": np.repeat([p[1] for p in self._parts], counts),
+                "x1": xyxy[:, 0],
+                "y1": xyxy[:, 1],
+                "x2": xyxy[:, 2],
+                "y2": xyxy[:, 3],
+                "score": np.concatenate([p[4] for p in self._parts]),
+                "cls": np.concatenate([p[5] for p in self._parts]).astype(np.int64),
+            }
+        )
+        self._parts = []
+        self.rows += len(df)
+        if self.out_path:
+            df.to_csv(self.out_path, mode="a", header=False, index=False, float_format="%.4f")
+        if self._copy is not None:
+            self._copy(df.drop(columns=["keyframe"]), run_id=self.run_id)
+
+
+# ========= 主流程 =========
+def _emit_interpolated(writer, frames, key_idx, matched):
+    """
+    在兩個關鍵影格之間，對這次有配到的 track 做線性內插：
+    從它上次對到的位置（可能更早，中間漏掉過）走到這次的位置。
+    """
+    if not matched:
+        for idx in frames:
+            writer.add(idx, np.zeros(0, dtype=np.int64), np.zeros((0, 4), dtype=np.float32), np.zeros(0),
+                       np.zeros(0), keyframe=False)
+        return
+    ids = np.array([t.track_id for t, _, _ in matched], dtype=np.int64)
+    start_box = np.stack([b for _, _, b in matched]).astype(np.float32)
+    end_box = np.stack([t.xyxy for t, _, _ in matched]).astype(np.float32)
+    start_frame = np.array([f for _, f, _ in matched], dtype=np.float32)
+    scores = np.array([t.score for t, _, _ in matched], dtype=np.float32)
+    cls = np.array([t.cls for t, _, _ in matched], dtype=np.int16)
+    span = np.maximum(key_idx - start_frame, 1.0)
+    for idx in frames:
+        w = ((idx - start_frame) / span)[:, None]
+        writer.add(idx, ids, start_box + (end_box - start_box) * w, scores, cls, keyframe=False)
+
+
+def process_video(source, out_path=None, every=5, scene_threshold=0.15, imgsz=640, conf=0.25, classes=None,
+                  interpolate=True, to_db=False, fps=None, max_frames=None, tiled=False, run_id=MODEL_RUN_ID):
+    """
+    處理一段影片 / 影格資料夾，回傳統計 dict。
+    interpolate=True：兩個關鍵影格之間的框用前後兩次偵測線性內插（輸出會延遲 every 格）；
+    False：用等速模型往前外推，每格立刻輸出（即時串流用）。
+    scene_threshold：小灰階圖的平均差異（0~1）超過它就當成畫面切換、立刻重新偵測；0 = 不偵測。
+    """
+    reader = FrameReader(source, fps=fps, retrieve_every=1 if scene_threshold > 0 else every,
+                         max_frames=max_frames)
+    name = os.path.basename(os.path.normpath(source))
+    writer = TrackWriter(out_path, name, to_db=to_db, run_id=run_id)
+    tracker = IouTracker()
+    stats = {"frames": 0, "keyframes": 0, "scene_cuts": 0, "decode_failures": 0}
+    pending = []  # 上一個關鍵影格之後、還沒輸出的影格
+    last_key = None
+    last_sig = None
+
+    t0 = time.perf_counter()
+    try:
+        for idx, frame in reader:
+            stats["frames"] += 1
+            is_key = last_key is None or idx - last_key >= every
+            if is_key and frame is None:
+                # 沒有畫面（解碼失敗，或只 grab 沒解碼的影格）：當成一般影格內插 / 外推，下一張有畫面的再偵測
+                if idx % reader.retrieve_every == 0:
+                    stats["decode_failures"] += 1
+                is_key = False
+            if not is_key and scene_threshold > 0 and frame is not None:
+                if float(np.abs(scene_signature(frame) - last_sig).mean()) / 255.0 > scene_threshold:
+                    is_key = True
+                    stats["scene_cuts"] += 1
+                    # 換場景了：切換前的影格用外推補完，舊的 track 不要接到新畫面上
+                    for p in pending:
+                        writer.add(p, *tracker.extrapolate(p), keyframe=False)
+                    pending = []
+                    tracker.reset()
+            if not is_key:
+                if interpolate:
+                    pending.append(idx)
+                else:
+                    writer.add(idx, *tracker.extrapolate(idx), keyframe=False)
+                continue
+
+            det = run_inference_batch([frame], imgsz, conf, classes, filenames=[f"{name}#{idx}"], use_cache=False,
+                                      tiled=tiled)[0]
+            stats["keyframes"] += 1
+            track_ids, matched = tracker.update(idx, det.xyxy, det.conf, det.cls)
+            if interpolate and pending:
+                _emit_interpolated(writer, pending, idx, matched)
+                pending = []
+            writer.add(idx, track_ids, det.xyxy, det.conf, det.cls, keyframe=True)
+            last_key = idx
+            if scene_threshold > 0:
+                last_sig = scene_signature(frame)
+
+            if stats["keyframes"] % 50 == 0:
+                elapsed = time.perf_counter() - t0
+                print(f"[{idx + 1}/{reader.n_frames or '?'}] {stats['frames'] / elapsed:.1f} fps")
+        # 最後一個關鍵影格之後的影格沒有下一次偵測可以內插，改用外推
+        for idx in pending:
+            writer.add(idx, *tracker.extrapolate(idx), keyframe=False)
+        writer.flush()
+    finally:
+        reader.close()
+
+    elapsed = time.perf_counter() - t0
+    stats.update(
+        rows=writer.rows,
+        seconds=round(elapsed, 2),
+        fps=round(stats["frames"] / elapsed, 2) if elapsed else None,
+        realtime_factor=round(stats["frames"] / elapsed / reader.fps, 2) if elapsed else None,
+    )
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="影片 / 影格序列推論：關鍵影格偵測 + IoU tracker 內插")
+    parser.add_argument("source", help="影片檔或影格資料夾")
+    parser.add_argument("--out", help="輸出 CSV")
+    parser.add_argument("--every", type=int, default=5, help="每幾格做一次完整偵測")
+    parser.add_argument("--scene-threshold", type=float, default=0.15, help="畫面切換門檻（0 = 不偵測）")
+    parser.add_argument("--imgsz", type=int, default=640)
+    parser.add_argument("--conf", type=float, default=0.25)
+    parser.add_argument("--classes", type=int, nargs="*", default=None)
+    parser.add_argument("--tiled", action="store_true", help="關鍵影格用切塊推論")
+    parser.add_argument("--extrapolate", action="store_true", help="不等下一個關鍵影格，用等速外推（即時用）")
+    parser.add_argument("--fps", type=float, default=None, help="影格資料夾的 fps（影片會自己讀）")
+    parser.add_argument("--max-frames", type=int, default=None)
+    parser.add_argument("--db", action="store_true", help="同時 COPY 進 detections 表")
+    args = parser.parse_args()
+    if not args.out and not args.db:
+        parser.error("--out 和 --db 至少要給一個")
+
+    safe_log("INFO", "video_infer.py", f"開始影片推論 {args.source}")
+    stats = process_video(
+        args.source,
+        out_path=args.out,
+        every=args.every,
+        scene_threshold=args.scene_threshold,
+        imgsz=args.imgsz,
+        conf=args.conf,
+        classes=args.classes,
+        interpolate=not args.extrapolate,
+        to_db=args.db,
+        fps=args.fps,
+        max_frames=args.max_frames,
+        tiled=args.tiled,
+    )
+    print(
+        f"✅ {stats['frames']} 格（關鍵影格 {stats['keyframes']}、畫面切換 {stats['scene_cuts']}），"
+        f"{stats['rows']} 筆，{stats['fps']} fps（即時的 {stats['realtime_factor']}×）"
+    )
+    safe_log("INFO", "video_infer.py", f"影片推論完成 {args.source}", detail=str(stats))
+
+
+if __name__ == "__main__":
+    main()